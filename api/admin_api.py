@@ -17,6 +17,7 @@ from database.user_models_researcher import Researcher, StudyRelation
 from libs.internal_types import ResearcherRequest
 from libs.schedules import repopulate_all_survey_scheduled_events
 from libs.timezone_dropdown import ALL_TIMEZONES
+from services.scripts_runner import create_task_reconcile_study_data_quantity_stats
 
 
 """######################### Study Administration ###########################"""
@@ -38,6 +39,8 @@ def set_study_timezone(request: ResearcherRequest, study_id=None):
     # All scheduled events for this study need to be recalculated
     # this causes chaos, relative and absolute surveys will be regenerated if already sent.
     repopulate_all_survey_scheduled_events(study)
+    # the data quantity stats and dashboard heatmaps are by day in the study's timezone
+    create_task_reconcile_study_data_quantity_stats(study)
     messages.warning(request, (f"Timezone {study.timezone_name} has been applied."))
     return redirect(f'/edit_study/{study_id}')
 
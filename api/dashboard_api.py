@@ -1,23 +1,25 @@
 import json
-from collections import defaultdict
 from datetime import date, datetime, timedelta, tzinfo
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple
 
-from dateutil.tz import UTC
+from django.db.models import Max, Min
 from django.shortcuts import get_object_or_404, render
 from django.utils.timezone import make_aware
 
 from authentication.admin_authentication import authenticate_researcher_study_access
 from constants.common_constants import API_DATE_FORMAT
 from constants.dashboard_constants import COMPLETE_DATA_STREAM_DICT, DASHBOARD_DATA_STREAMS
-from database.dashboard_models import DashboardColorSetting, DashboardGradient, DashboardInflection
-from database.data_access_models import ChunkRegistry
+from database.dashboard_models import (DashboardColorSetting, DashboardDataQuantity,
+    DashboardGradient, DashboardInflection)
 from database.study_models import Study
 from database.user_models_participant import Participant
 from libs.internal_types import ParticipantQuerySet, ResearcherRequest
 from middleware.abort_middleware import abort
 
 
+# the beiwe launch date, earlier dates are from devices with bad clocks (e.g. 1/1/1970)
+EARLIEST_POSSIBLE_DATA = date(year=2014, month=8, day=1)
+
 DATETIME_FORMAT_ERROR = f"Dates and times provided to this endpoint must be formatted like this: " \
                         f"2010-11-22 ({API_DATE_FORMAT})"
 
@@ -92,22 +94,25 @@ def parse_data_streams(
     request: ResearcherRequest, study: Study, data_stream: str, participant_objects: ParticipantQuerySet
 ):
     start, end = extract_date_args_from_request(request, study.timezone)
-    first_day, last_day = dashboard_chunkregistry_date_query(study, data_stream)
+    first_day, last_day = dashboard_date_range_query(study, data_stream)
     data_exists = False
     unique_dates = []
     byte_streams = {}
     if first_day is not None:
-        stream_data = dashboard_chunkregistry_query(participant_objects, data_stream=data_stream)
-        unique_dates, _, _ = get_unique_dates(start, end, first_day, last_day)
+        unique_dates = get_unique_dates(start, end, first_day, last_day)
+        stream_data = dashboard_data_quantity_query(
+            unique_dates, study=study, data_stream=data_stream
+        )
         
         # get the byte streams per date for each patient for a specific data stream for those dates
-        byte_streams = dict(
-            (participant.patient_id,
-                [get_bytes_date_match(stream_data[participant.patient_id], date) for date in unique_dates])
+        byte_streams = {
+            participant.patient_id: [
+                stream_data.get((participant.pk, a_date), 0) for a_date in unique_dates
+            ]
             for participant in participant_objects
-        )
+        }
         # check if there is data to display
-        data_exists = len([data for patient in byte_streams for data in byte_streams[patient] if data is not None]) > 0
+        data_exists = len(byte_streams) > 0
     
     return data_exists, first_day, last_day, unique_dates, byte_streams
 
@@ -118,22 +123,18 @@ def dashboard_participant_page(request: ResearcherRequest, study_id, patient_id)
     study = get_object_or_404(Study, pk=study_id)
     participant = get_object_or_404(Participant, patient_id=patient_id, study_id=study_id)
     
-    # query is optimized for bulk participants, so this is a little weird
-    chunk_data = dashboard_chunkregistry_query(participant)
-    chunks = chunk_data[participant.patient_id] if participant.patient_id in chunk_data else {}
-    
     # ----------------- dates for bytes data streams -----------------------
-    if chunks:
+    first_day, last_day = dashboard_date_range_query(study, participant=participant)
+    if first_day is not None:
         start, end = extract_date_args_from_request(request, study.timezone)
-        first_day, last_day = dashboard_chunkregistry_date_query(study, participant=participant)
-        unique_dates, first_date_data_entry, last_date_data_entry = get_unique_dates(
-            start, end, first_day, last_day, chunks
-        )
+        unique_dates = get_unique_dates(start, end, first_day, last_day)
+        first_date_data_entry, last_date_data_entry = first_day, last_day
         next_url, past_url = create_next_past_urls(
             first_date_data_entry, last_date_data_entry, start=start, end=end
         )
+        stream_data = dashboard_data_quantity_query(unique_dates, participant=participant)
         byte_streams: Dict[str, List[int]] = {
-            stream: [get_bytes_data_stream_match(chunks, date, stream) for date in unique_dates]
+            stream: [stream_data.get((stream, a_date), 0) for a_date in unique_dates]
                 for stream in DASHBOARD_DATA_STREAMS
         }
     else:
@@ -167,21 +168,8 @@ def dashboard_participant_page(request: ResearcherRequest, study_id, patient_id)
     )
 
 
-def get_unique_dates(start: datetime, end: datetime, first_day: date, last_day: date, chunks=None):
-    """ create a list of all the unique days in which data was recorded for this study """
-    first_date_data_entry = last_date_data_entry = None
-    
-    if chunks:
-        # chunks are sourced from dashboard_chunkregistry_query, so should be in the study timezone
-        all_dates = sorted(
-            chunk["time_bin"].date() for chunk in chunks if chunk["time_bin"].date() >= first_day
-            # must be >= first day bc there are some point for 1970 that get filtered out bc obv are garbage
-        )
-        
-        # create a list of all of the valid days in this study
-        first_date_data_entry = all_dates[0]
-        last_date_data_entry = all_dates[-1]
-    
+def get_unique_dates(start: datetime, end: datetime, first_day: date, last_day: date) -> List[date]:
+    """ create a list of the days to display, within the days in which data was recorded """
     # validate start date is before end date
     if start and end and (end.date() - start.date()).days < 0:
         temp = start
@@ -211,7 +199,7 @@ def get_unique_dates(start: datetime, end: datetime, first_day: date, last_day:
         end_num = (end.date() - start.date()).days + 1
         unique_dates = [(start.date() + timedelta(days=date)) for date in range(end_num)]
     
-    return unique_dates, first_date_data_entry, last_date_data_entry
+    return unique_dates
 
 
 def create_next_past_urls(first_day: date, last_day: date, start: datetime, end: datetime) -> Tuple[str, str]:
@@ -251,84 +239,42 @@ def create_next_past_urls(first_day: date, last_day: date, start: datetime, end:
     return next_url, past_url
 
 
-def get_bytes_data_stream_match(chunks: List[Dict[str, datetime]], a_date: date, stream: str):
-    """ Returns byte value for correct chunk based on data stream and type comparisons. """
-    # these time_bin datetime objects should be in the appropriate timezone
-    return sum(
-        chunk.get("bytes", 0) or 0 for chunk in chunks
-        if chunk["time_bin"].date() == a_date and chunk["data_stream"] == stream
-    )
-
-
-def get_bytes_date_match(stream_data: List[Dict[str, datetime]], a_date: date) -> int or None:
-    """ Returns byte value for correct stream based on ate. """
-    return sum(
-        data_point.get("bytes", 0) or 0 for data_point in stream_data
-        if (data_point["time_bin"]).date() == a_date
-    )
-
-
-def dashboard_chunkregistry_date_query(
+def dashboard_date_range_query(
     study: Study, data_stream: str = None, participant: Participant = None
-):
-    """ Gets the first and last days in the study excluding 1/1/1970 bc that is obviously an error
-    and makes the frontend annoying to use """
-    earlist_possible_data = datetime(year=2014, month=8, day=1, tzinfo=UTC)  # beiwe launch date
+) -> Tuple[Optional[date], Optional[date]]:
+    """ Gets the first and last days (in the study timezone) with data of a study's data stream or
+    of a participant, excluding days before beiwe existed. """
     kwargs = {"study_id": study.id}
     if data_stream:
         kwargs["data_type"] = data_stream
     if participant:
         kwargs["participant"] = participant
     
-    # this process as queries with .first() and .last() is slow even as size of all_time_bins grows.
-    all_time_bins: List[datetime] = list(
-        ChunkRegistry.objects.filter(**kwargs)
-        .exclude(time_bin__lt=earlist_possible_data)
-        .order_by("time_bin")
-        .values_list("time_bin", flat=True)
-    )
-    
-    # default behavior for 1 or 0 time_bins
-    if len(all_time_bins) < 1:
-        return None, None
-    
-    # and get as study timezone... which might be unnecessary
-    return all_time_bins[0].astimezone(study.timezone).date(), \
-           all_time_bins[-1].astimezone(study.timezone).date()
-
-
-# Fixme: start and end dates are never used
-def dashboard_chunkregistry_query(
-    participants: Union[ParticipantQuerySet, Participant], data_stream: str = None
-):
-    """ Queries ChunkRegistry based on the provided parameters and returns a list of dictionaries
-    with 3 keys: bytes, data_stream, and time_bin. """
-    if isinstance(participants, Participant):
-        timezone: tzinfo = participants.study.timezone
-        kwargs = {"participant": participants}
+    date_range = DashboardDataQuantity.objects.filter(
+        date__gte=EARLIEST_POSSIBLE_DATA, bytes__gt=0, **kwargs
+    ).aggregate(first_day=Min("date"), last_day=Max("date"))
+    return date_range["first_day"], date_range["last_day"]
+
+
+def dashboard_data_quantity_query(
+    dates: List[date], study: Study = None, data_stream: str = None,
+    participant: Participant = None,
+) -> Dict[Tuple[Any, date], int]:
+    """ Reads the heatmap cells of the displayed days, either of a study's data stream, keyed by
+    (participant pk, date), or of a participant, keyed by (data stream, date). """
+    if not dates:
+        return {}
+    query = DashboardDataQuantity.objects.filter(date__range=(dates[0], dates[-1]))
+    if participant:
+        query = query.filter(participant=participant)
+        key_field = "data_type"
     else:
-        timezone: tzinfo = participants.first().study.timezone
-        kwargs = {"participant_id__in": participants}
-    
-    if data_stream:
-        kwargs["data_type"] = data_stream
-    
-    # rename the data_type and file_size fields in the db query itself for speed
-    chunks = ChunkRegistry.objects.filter(**kwargs).extra(
-        select={'data_stream': 'data_type', 'bytes': 'file_size'}
-    ).values("participant__patient_id", "bytes", "data_stream", "time_bin")
-    
-    patient_id_to_datapoints = defaultdict(list)
-    for chunk in chunks:
-        chunk["time_bin"] = chunk["time_bin"].astimezone(timezone)
-        patient_id_to_datapoints[chunk.pop("participant__patient_id")].append(chunk)
-    
-    # populate participants with no data, values don't need to be present.
-    if not isinstance(participants, Participant):
-        for participant in participants:
-            patient_id_to_datapoints[participant.patient_id]
-    
-    return dict(patient_id_to_datapoints)
+        query = query.filter(study=study, data_type=data_stream)
+        key_field = "participant_id"
+    return {
+        (key, a_date): total_bytes
+        for key, a_date, total_bytes in query.values_list(key_field, "date", "bytes")
+    }
 
 
 def extract_date_args_from_request(request: ResearcherRequest, timezone: tzinfo) -> Tuple[datetime, datetime]:
@@ -1,24 +1,30 @@
 import json
 from datetime import datetime
+from typing import List, Optional, Tuple
 
 import orjson
 from dateutil import tz
 from django.db import transaction
 from django.db.models import QuerySet
-from django.http.response import FileResponse
+from django.http.response import FileResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.utils.timezone import make_aware
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_http_methods, require_POST
 
 from authentication.data_access_authentication import api_study_credential_check
 from constants.common_constants import API_TIME_FORMAT
-from constants.data_access_api_constants import CHUNK_FIELDS
-from constants.data_stream_constants import ALL_DATA_STREAMS
+from constants.data_access_api_constants import (CHUNK_FIELDS, COMPRESSION_NONE,
+    COMPRESSION_OPTIONS, DATA_FILES_MAX_BATCH_SIZE, DATA_MANIFEST_PAGE_SIZE, OUTPUT_FORMAT_CSV,
+    OUTPUT_FORMAT_OPTIONS)
+from constants.data_stream_constants import DATA_ACCESS_STREAMS
 from database.data_access_models import ChunkRegistry
 from database.profiling_models import DataAccessRecord
 from database.user_models_participant import Participant
+from libs.columnar_export import (COLUMNAR_EXPORT_AVAILABLE, COLUMNAR_EXPORT_ORDERING,
+    ColumnarExportGenerator)
 from libs.internal_types import ApiStudyResearcherRequest
-from libs.streaming_zip import ZipGenerator
+from libs.streaming_zip import TimeWindow, ZipGenerator
+from libs.utils.effiicient_paginator import DataManifestPaginator
 from middleware.abort_middleware import abort
 
 
@@ -37,10 +43,20 @@ def get_data(request: ApiStudyResearcherRequest):
     JSON blobs: data streams, users - default to all
     Strings: date-start, date-end - format as "YYYY-MM-DDThh:mm:ss"
     optional: top-up = a file (registry.dat)
+    optional: sync_cursor = the sync_cursor file of the previous download, or the empty string for
+        the first download.  Only files created or updated since that download are returned, and
+        the zip file contains a new sync_cursor file instead of a registry file.
+    optional: compression = "none" (default, a zip file), "deflate" (a compressed zip file), or
+        "zstd" (a zstd-compressed tar file)
+    optional: trim_rows = "true" to receive only the rows within date-start and date-end, instead
+        of every (hourly) file that starts within them.  Trimmed files are left out of the registry.
+    optional: output_format = "csv" (default, the hourly csv files), "parquet", or "arrow" (arrow
+        ipc).  Parquet and arrow files contain a participant's data stream, typed, instead of an
+        hour of it.  They can't be combined with a registry or a sync_cursor.
     cases handled:
         missing creds or study, invalid researcher or study, researcher does not have access
         researcher creds are invalid
-    Returns a zip file of all data files found by the query. """
+    Returns a zip (or tar.zst) file of all data files found by the query. """
     query_args = {}
     
     try:
@@ -48,23 +64,29 @@ def get_data(request: ApiStudyResearcherRequest):
         determine_users_for_db_query(request, query_args)
         determine_time_range_for_db_query(request, query_args)
         registry_dict = parse_registry(request)
+        compression = determine_compression(request)
+        sync_cursor = parse_sync_cursor(request)
+        time_window = determine_time_window(request, query_args)
+        output_format = determine_output_format(request, registry_dict, sync_cursor)
     except Exception as e:
-        post = dict(request.POST)
-        post["access_key"] = post["secret_key"] = "sanitized"  # guaranteed to be present
-        DataAccessRecord.objects.create(
-            researcher=request.api_researcher,
-            username=request.api_researcher.username,
-            query_params=orjson.dumps(post).decode(),
-            error="did not pass query validation, " + str(e),
-        )
+        record_query_validation_error(request, e)
         raise
+    
     # Do query! (this is actually a generator, it can only be iterated over once)
     get_these_files = handle_database_query(
-        request.api_study.pk, query_args, registry_dict=registry_dict
+        request.api_study.pk, query_args, registry_dict=registry_dict, sync_cursor=sync_cursor,
+        time_window=time_window,
+        order_by=None if output_format == OUTPUT_FORMAT_CSV else COLUMNAR_EXPORT_ORDERING,
     )
     
     # make a record of the query, we are only tracking queries that make it to this point
     query_args["study_pk"] = request.api_study.pk  # add the study pk
+    if sync_cursor is not None:
+        query_args["sync_cursor"] = sync_cursor
+    if time_window is not None:
+        query_args["trim_rows"] = True
+    if output_format != OUTPUT_FORMAT_CSV:
+        query_args["output_format"] = output_format
     record = DataAccessRecord.objects.create(
         researcher=request.api_researcher,
         query_params=orjson.dumps(query_args).decode(),
@@ -72,15 +94,114 @@ def get_data(request: ApiStudyResearcherRequest):
         username=request.api_researcher.username,
     )
     
+    if output_format == OUTPUT_FORMAT_CSV:
+        streaming_zip_file = ZipGenerator(
+            get_these_files,
+            construct_registry='web_form' not in request.POST and sync_cursor is None,
+            compression=compression,
+            sync_cursor=sync_cursor,
+            time_window=time_window,
+        )
+    else:
+        streaming_zip_file = ColumnarExportGenerator(
+            get_these_files, output_format, compression=compression, time_window=time_window
+        )
+    return stream_data_download(request, streaming_zip_file, record)
+
+
+@require_POST
+@api_study_credential_check(block_test_studies=True)
+@transaction.non_atomic_requests
+def get_data_manifest(request: ApiStudyResearcherRequest):
+    """ Required: access key, access secret, study_id
+    JSON blobs: data streams, users - default to all
+    Strings: date-start, date-end - format as "YYYY-MM-DDThh:mm:ss"
+    Returns a json list of the data files found by the query, with their chunk_id, file_name (the
+    path of the file in a data download), chunk_path, chunk_hash, file_size, data_type,
+    participant_id, and time_bin.  The files can then be downloaded in batches with get_data_files,
+    which can run in parallel and be retried independently. """
+    query_args = {}
+    try:
+        determine_data_streams_for_db_query(request, query_args)
+        determine_users_for_db_query(request, query_args)
+        determine_time_range_for_db_query(request, query_args)
+    except Exception as e:
+        record_query_validation_error(request, e)
+        raise
+    
+    paginator = DataManifestPaginator(
+        ChunkRegistry.get_chunks_time_range(request.api_study.pk, **query_args),
+        page_size=DATA_MANIFEST_PAGE_SIZE,
+        values=CHUNK_FIELDS,
+    )
+    
+    # make a record of the query, as in get_data
+    query_params = {"study_pk": request.api_study.pk, "manifest": True, **query_args}
+    DataAccessRecord.objects.create(
+        researcher=request.api_researcher,
+        query_params=orjson.dumps(query_params).decode(),
+        username=request.api_researcher.username,
+        time_end=timezone.now(),
+    )
+    return StreamingHttpResponse(
+        paginator.stream_orjson_paginate(), content_type="application/json"
+    )
+
+
+@require_POST
+@api_study_credential_check(block_test_studies=True)
+@transaction.non_atomic_requests
+def get_data_files(request: ApiStudyResearcherRequest):
+    """ Required: access key, access secret, study_id
+    JSON blob: chunk_ids - a list of up to DATA_FILES_MAX_BATCH_SIZE chunk_ids from the manifest
+    optional: compression, as in get_data
+    Returns a zip (or tar.zst) file of those data files, named as in get_data.  Files that have been
+    deleted since the manifest was retrieved are left out. """
+    try:
+        chunk_ids = parse_chunk_ids(request)
+        compression = determine_compression(request)
+    except Exception as e:
+        record_query_validation_error(request, e)
+        raise
+    
+    get_these_files = ChunkRegistry.objects \
+        .filter(study_id=request.api_study.pk, pk__in=chunk_ids) \
+        .order_by("pk").values(*CHUNK_FIELDS).iterator()
+    
+    query_params = {"study_pk": request.api_study.pk, "chunk_ids": chunk_ids}
+    record = DataAccessRecord.objects.create(
+        researcher=request.api_researcher,
+        query_params=orjson.dumps(query_params).decode(),
+        username=request.api_researcher.username,
+    )
     streaming_zip_file = ZipGenerator(
-        get_these_files, construct_registry='web_form' not in request.POST
+        get_these_files, construct_registry=False, compression=compression
     )
+    return stream_data_download(request, streaming_zip_file, record)
+
+
+def record_query_validation_error(request: ApiStudyResearcherRequest, error: Exception):
+    """ Makes a record of a data download that failed validation. """
+    post = dict(request.POST)
+    post["access_key"] = post["secret_key"] = "sanitized"  # guaranteed to be present
+    DataAccessRecord.objects.create(
+        researcher=request.api_researcher,
+        username=request.api_researcher.username,
+        query_params=orjson.dumps(post).decode(),
+        error="did not pass query validation, " + str(error),
+    )
+
+
+def stream_data_download(
+    request: ApiStudyResearcherRequest, streaming_zip_file: ZipGenerator, record: DataAccessRecord
+) -> FileResponse:
+    """ Returns the streaming response of a data download. """
     try:
         streaming_response = FileResponse(
             streaming_zip_file,
-            content_type="application/zip",
+            content_type=streaming_zip_file.content_type,
             as_attachment='web_form' in request.POST,
-            filename="data.zip",
+            filename=streaming_zip_file.file_name,
         )
         # for unknown reasons this call never happens in django's responding process, and so the
         # headers, which includes the file name, are never set.
@@ -114,6 +235,81 @@ def parse_registry(request: ApiStudyResearcherRequest):
     return ret
 
 
+def parse_chunk_ids(request: ApiStudyResearcherRequest) -> List[int]:
+    """ Parses the json list of chunk ids, throws a 400 if it is invalid or too long. """
+    try:
+        chunk_ids = json.loads(request.POST["chunk_ids"])
+    except (KeyError, ValueError):
+        log("bad chunk_ids")
+        return abort(400, "bad chunk_ids")
+    
+    if not isinstance(chunk_ids, list) or not all(isinstance(pk, int) for pk in chunk_ids):
+        log("chunk_ids was not a list of integers")
+        return abort(400, "bad chunk_ids")
+    if len(chunk_ids) > DATA_FILES_MAX_BATCH_SIZE:
+        log("too many chunk_ids")
+        return abort(400, f"at most {DATA_FILES_MAX_BATCH_SIZE} chunk_ids")
+    return chunk_ids
+
+
+def parse_sync_cursor(request: ApiStudyResearcherRequest) -> Optional[str]:
+    """ Returns the provided sync cursor, or None if there isn't one.  Throws a 400 if the sync
+    cursor is invalid. """
+    sync_cursor = request.POST.get("sync_cursor", None)
+    if sync_cursor is None:
+        return None
+    
+    try:
+        ChunkRegistry.decode_sync_cursor(sync_cursor)
+    except ValueError:
+        log("bad sync cursor")
+        return abort(400, "bad sync cursor")
+    return sync_cursor
+
+
+def determine_compression(request: ApiStudyResearcherRequest) -> str:
+    """ Returns the requested compression, throws a 400 if it is not an option. """
+    compression = request.POST.get("compression", COMPRESSION_NONE)
+    if compression not in COMPRESSION_OPTIONS:
+        log("bad compression:", compression)
+        return abort(400, "bad compression")
+    return compression
+
+
+def determine_time_window(request: ApiStudyResearcherRequest, query: dict) -> Optional[TimeWindow]:
+    """ Returns the TimeWindow of the query if row level trimming was requested, or None.  Throws a
+    400 if the trim_rows parameter is invalid. """
+    trim_rows = request.POST.get("trim_rows", "false")
+    if trim_rows not in ("true", "false"):
+        log("bad trim_rows:", trim_rows)
+        return abort(400, "bad trim_rows")
+    if trim_rows == "false":
+        return None
+    return TimeWindow(query.get("start"), query.get("end"))
+
+
+def determine_output_format(
+    request: ApiStudyResearcherRequest, registry_dict: Optional[dict], sync_cursor: Optional[str]
+) -> str:
+    """ Returns the requested output format, throws a 400 if it is not an option, if it is not
+    available, or if it is a columnar format and there is a registry or sync cursor. """
+    output_format = request.POST.get("output_format", OUTPUT_FORMAT_CSV)
+    if output_format not in OUTPUT_FORMAT_OPTIONS:
+        log("bad output format:", output_format)
+        return abort(400, "bad output_format")
+    if output_format == OUTPUT_FORMAT_CSV:
+        return output_format
+    
+    if not COLUMNAR_EXPORT_AVAILABLE:
+        log("pyarrow is not installed")
+        return abort(400, "output_format is not available on this server")
+    # registries and sync cursors track the hourly files
+    if registry_dict or sync_cursor is not None:
+        log("columnar output format with a registry or sync cursor")
+        return abort(400, "output_format can't be combined with a registry or sync_cursor")
+    return output_format
+
+
 def str_to_datetime(time_string):
     """ Translates a time string to a datetime object, raises a 400 if the format is wrong."""
     try:
@@ -144,7 +340,7 @@ def determine_data_streams_for_db_query(request: ApiStudyResearcherRequest, quer
             query_dict['data_types'] = request.POST.getlist('data_streams')
         
         for data_stream in query_dict['data_types']:
-            if data_stream not in ALL_DATA_STREAMS:
+            if data_stream not in DATA_ACCESS_STREAMS:
                 log("invalid data stream:", data_stream)
                 return abort(404, "bad data stream")
 
@@ -162,10 +358,14 @@ def determine_users_for_db_query(request: ApiStudyResearcherRequest, query: dict
         except Exception:
             return abort(400, "bad patient id")
         
-        # Ensure that all user IDs are patient_ids of actual Participants
-        if Participant.objects.filter(patient_id__in=query['user_ids']).count() != len(query['user_ids']):
+        # Ensure that all user IDs are patient_ids of actual Participants, and resolve them to
+        # participant pks once so that the chunk query doesn't have to join on Participant.
+        participants = Participant.objects.filter(patient_id__in=query['user_ids'])
+        participant_ids = list(participants.values_list("pk", flat=True))
+        if len(participant_ids) != len(query['user_ids']):
             log("invalid participant")
             return abort(404, "bad patient id")
+        query['participant_ids'] = participant_ids
 
 
 def determine_time_range_for_db_query(request: ApiStudyResearcherRequest, query: dict):
@@ -178,12 +378,29 @@ def determine_time_range_for_db_query(request: ApiStudyResearcherRequest, query:
         query['end'] = str_to_datetime(request.POST['time_end'])
 
 
-def handle_database_query(study_id: int, query_dict: dict, registry_dict: dict = None) -> QuerySet:
-    """ Runs the database query and returns a QuerySet. """
-    chunks = ChunkRegistry.get_chunks_time_range(study_id, **query_dict)
+def handle_database_query(
+    study_id: int, query_dict: dict, registry_dict: dict = None, sync_cursor: str = None,
+    time_window: TimeWindow = None, order_by: Tuple[str] = None,
+) -> QuerySet:
+    """ Runs the database query and returns a QuerySet.  If there is a time window the query
+    includes the chunk that contains its start, which will be trimmed. """
+    if time_window is None:
+        chunks = ChunkRegistry.get_chunks_time_range(study_id, **query_dict)
+    else:
+        query_dict = {k: v for k, v in query_dict.items() if k not in ("start", "end")}
+        chunks = time_window.filter_chunks(
+            ChunkRegistry.get_chunks_time_range(study_id, **query_dict)
+        )
+    fields = CHUNK_FIELDS
+    if sync_cursor is not None:
+        chunks = ChunkRegistry.filter_by_sync_cursor(chunks, sync_cursor)
+        fields = CHUNK_FIELDS + ("last_updated",)
+    if order_by is not None:
+        chunks = chunks.order_by(*order_by)
+    
     # the simple case where there isn't a registry uploaded
     if not registry_dict:
-        return chunks.values(*CHUNK_FIELDS).iterator()
+        return chunks.values(*fields).iterator()
     
     # If there is a registry, we need to filter on the chunks
     # Get all chunks whose path and hash are both in the registry
@@ -199,4 +416,4 @@ def handle_database_query(study_id: int, query_dict: dict, registry_dict: dict =
     ]
     
     # add the exclude and return the queryset
-    return chunks.exclude(pk__in=registered_chunk_pks).values(*CHUNK_FIELDS).iterator()
+    return chunks.exclude(pk__in=registered_chunk_pks).values(*fields).iterator()
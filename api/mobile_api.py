@@ -11,7 +11,7 @@ from django.utils import timezone
 
 from authentication.participant_authentication import (authenticate_participant,
     authenticate_participant_registration, minimal_validation)
-from config.settings import UPLOAD_LOGGING_ENABLED
+from config.settings import DEFER_UPLOAD_DECRYPTION, UPLOAD_LOGGING_ENABLED
 from constants.celery_constants import ANDROID_FIREBASE_CREDENTIALS, IOS_FIREBASE_CREDENTIALS
 from constants.message_strings import (DEVICE_CHECKED_IN, DEVICE_IDENTIFIERS_HEADER,
     INVALID_EXTENSION_ERROR, NO_FILE_ERROR, UNKNOWN_ERROR)
@@ -24,8 +24,8 @@ from libs.encryption import (DecryptionKeyInvalidError, DeviceDataDecryptor,
     IosDecryptionKeyDuplicateError, IosDecryptionKeyNotFoundError, RemoteDeleteFileScenario)
 from libs.http_utils import determine_os_api
 from libs.internal_types import ParticipantRequest, ScheduledEventQuerySet
-from libs.participant_file_uploads import (upload_and_create_file_to_process_and_log,
-    upload_problem_file)
+from libs.participant_file_uploads import (ingest_raw_upload,
+    upload_and_create_file_to_process_and_log, upload_problem_file)
 from libs.s3 import get_client_public_key_string, s3_upload
 from libs.schedules import (decompose_datetime_to_timings, export_weekly_survey_timings,
     repopulate_all_survey_scheduled_events)
@@ -89,6 +89,10 @@ def upload(request: ParticipantRequest, OS_API=""):
         log("400, FileToProcess.test_file_path_exists")
         return HttpResponse(content="", status=400)
     
+    # decryption happens on the data processing servers, see ingest_raw_upload.
+    if DEFER_UPLOAD_DECRYPTION:
+        return ingest_raw_upload(s3_file_location, participant, get_uploaded_file(request))
+    
     # attempt to decrypt, some scenarios delete remote files even if decryption fails
     try:
         file_contents = get_uploaded_file(request)
@@ -1,10 +1,13 @@
 import json
+from hashlib import sha256
 from typing import List
 
-from django.db.models import F
+import orjson
+from django.db.models import Count, Max
 from django.db.models.fields import Field
 from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views.decorators.http import require_GET
 
 from authentication.tableau_authentication import authenticate_tableau
@@ -12,13 +15,21 @@ from constants.tableau_api_constants import FIELD_TYPE_MAP, SERIALIZABLE_FIELD_N
 from database.tableau_api_models import SummaryStatisticDaily
 from forms.django_forms import ApiQueryForm
 from libs.internal_types import TableauRequest
-from libs.utils.effiicient_paginator import TableauApiPaginator
+from libs.tableau_result_cache import tableau_result_cache
+from libs.utils.effiicient_paginator import StreamingQueryPaginator
 
 
 FINAL_SERIALIZABLE_FIELDS: List[Field] = [
     f for f in SummaryStatisticDaily._meta.fields if f.name in SERIALIZABLE_FIELD_NAMES
 ]
 
+# study_id and participant_id are the object id of the study and the patient id of the participant
+RELATED_FIELD_PATHS = {
+    "participant_id": "participant__patient_id",
+    "study_id": "participant__study__object_id",
+}
+TABLEAU_PAGE_SIZE = 10000
+
 
 @require_GET
 @authenticate_tableau
@@ -29,16 +40,58 @@ def get_tableau_daily(request: TableauRequest, study_object_id: str = None):
             format_errors(form.errors.get_json_data()), status=400, content_type="application/json"
         )
     
+    # The response is identified by the query and the version of the study's summary statistics,
+    # a refresh that has the current version (If-None-Match) gets a 304 without running the query.
+    etag = get_tableau_etag(study_object_id, form.cleaned_data)
+    response = get_conditional_response(request, etag=etag)  # (None if it was modified)
+    if response is None:
+        response = get_tableau_response(study_object_id, form.cleaned_data, etag)
+    response["ETag"] = etag
+    # clients must revalidate with the etag, and only the client may store the (private) data
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def get_tableau_response(study_object_id: str, cleaned_data: dict, etag: str) -> HttpResponse:
+    """ Returns the cached response for the etag, or streams the query (and caches it). """
+    cached_response = tableau_result_cache.get(etag)
+    if cached_response is not None:
+        return HttpResponse(cached_response, content_type="application/json")
+    
     # The don't need to specify the study_id and participant_id fields, those are provided.
-    query_fields = [f for f in form.cleaned_data["fields"] if f in SERIALIZABLE_FIELD_NAMES]
+    query_fields = [f for f in cleaned_data["fields"] if f in SERIALIZABLE_FIELD_NAMES]
     paginator = tableau_query_database(
         study_object_id=study_object_id,  # the object id is validated in the login logic
         query_fields=query_fields,
-        **form.cleaned_data,  # already cleaned and validated
+        **cleaned_data,  # already cleaned and validated
     )
     return StreamingHttpResponse(
-        paginator.stream_orjson_paginate(), content_type="application/json"
+        tableau_result_cache.stream_and_put(etag, paginator.stream_orjson_paginate()),
+        content_type="application/json",
+    )
+
+
+def get_summary_statistics_version(study_object_id: str) -> str:
+    """ A version stamp of a study's SummaryStatisticDaily rows, the row count and the latest
+    last_updated.  Every write changes it: data processing and forest update last_updated when they
+    create or update rows (bulk updates set it explicitly), and deleting rows changes the count. """
+    stamp = SummaryStatisticDaily.objects.filter(participant__study__object_id=study_object_id) \
+        .aggregate(count=Count("pk"), last_updated=Max("last_updated"))
+    last_updated = stamp["last_updated"].isoformat() if stamp["last_updated"] else ""
+    return f"{stamp['count']}_{last_updated}"
+
+
+def get_tableau_etag(study_object_id: str, cleaned_data: dict) -> str:
+    """ An etag of the normalized query parameters and the version of the study's data, it is
+    also the result cache key. """
+    query = dict(cleaned_data)
+    if "participant_ids" in query:  # (the order of participant ids doesn't change the results)
+        query["participant_ids"] = sorted(query["participant_ids"])
+    normalized_query = orjson.dumps(
+        [study_object_id, get_summary_statistics_version(study_object_id), query],
+        option=orjson.OPT_SORT_KEYS,
     )
+    return f'"{sha256(normalized_query).hexdigest()[:32]}"'
 
 
 @require_GET
@@ -81,7 +134,7 @@ def tableau_query_database(
     ordered_by="date", order_direction="default",       # sort
     query_fields: List[str] = None,
     **_  # Because Whimsy is important.                 # ignore everything else
-) -> TableauApiPaginator:
+) -> StreamingQueryPaginator:
     """ Args:
         study_object_id (str): study in which to find data
         end_date (optional[date]): last date to include in search
@@ -90,7 +143,8 @@ def tableau_query_database(
         order_by (str): parameter to sort output by. Must be one in the list of fields to return
         order_direction (str): order to sort in, either "ascending" or "descending"
         participant_ids (optional[list[str]]): a list of participants to limit the search to
-    Returns EfficientPaginator of the SummaryStatisticsDaily objects specified by the parameters """
+    Returns a StreamingQueryPaginator of the SummaryStatisticsDaily objects specified by the
+    parameters """
     
     if not query_fields:
         raise Exception("invalid usage")
@@ -105,27 +159,26 @@ def tableau_query_database(
     if start_date:
         filter_kwargs["date__gte"] = start_date
     
-    # particpant_id needs to be remapped to patient_id
-    if ordered_by == "participant_id":
-        ordered_by = "patient_id"  # participant__patient_id also works, participant_id does not
+    # participant_id and study_id are not fields of SummaryStatisticDaily
+    ordered_by = RELATED_FIELD_PATHS.get(ordered_by, ordered_by)
     
     # default ordering for date (which is itself the default oreding) is most recent first
     if order_direction == "default" and ordered_by == "date":
         order_direction = "descending"
     elif order_direction == "default":
         order_direction = "ascending"
+    # the pk makes the order of rows with the same value deterministic
     if order_direction == "descending":
-        ordered_by = "-" + ordered_by
+        order_by = ("-" + ordered_by, "-pk")
+    else:
+        order_by = (ordered_by, "pk")
     
-    # Set up annotation to rename the study's object_id the "study_id"
-    annotate_kwargs = {"study_id": F("participant__study__object_id")}
-    if "participant_id" in query_fields:
-        # need to replace participant_id with patient_id, we have to swap it back later
-        query_fields[query_fields.index("participant_id")] = "patient_id"
-        annotate_kwargs["patient_id"] = F("participant__patient_id")
-    
-    # construct query, apply limit if any, pass to paginator with large page size and return.
-    query = SummaryStatisticDaily.objects \
-        .annotate(**annotate_kwargs).order_by(ordered_by).filter(**filter_kwargs)
-    
-    return TableauApiPaginator(query, 10000, values=query_fields, limit=limit)
+    # construct query, pass to paginator with large page size and return, it applies the limit.
+    query = SummaryStatisticDaily.objects.filter(**filter_kwargs).order_by(*order_by)
+    return StreamingQueryPaginator(
+        query,
+        TABLEAU_PAGE_SIZE,
+        values_list=[RELATED_FIELD_PATHS.get(field, field) for field in query_fields],
+        output_names=query_fields,
+        limit=limit,
+    )
@@ -65,7 +65,12 @@ for mandatory_var in MANDATORY_VARS:
 
 # Environment variable type can be unpredictable, sanitize the numerical ones.
 settings.CONCURRENT_NETWORK_OPS = int(settings.CONCURRENT_NETWORK_OPS)
+settings.S3_MAX_POOL_CONNECTIONS = int(settings.S3_MAX_POOL_CONNECTIONS)
+settings.DATA_DOWNLOAD_PREFETCH_BYTES = int(settings.DATA_DOWNLOAD_PREFETCH_BYTES)
+settings.CHUNK_CACHE_MAX_BYTES = int(settings.CHUNK_CACHE_MAX_BYTES)
+settings.TABLEAU_RESULT_CACHE_MAX_BYTES = int(settings.TABLEAU_RESULT_CACHE_MAX_BYTES)
 settings.FILE_PROCESS_PAGE_SIZE = int(settings.FILE_PROCESS_PAGE_SIZE)
+settings.DATA_PROCESSING_WORKER_PROCESSES = int(settings.DATA_PROCESSING_WORKER_PROCESSES)
 
 # email addresses are parsed from a comma separated list, strip whitespace.
 if settings.SYSADMIN_EMAILS:
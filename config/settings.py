@@ -1,4 +1,5 @@
 from os import cpu_count, getenv
+from os.path import expanduser, join
 
 """
 Keep this document legible for non-developers, it is linked in ReadMe, and is the official
@@ -58,6 +59,41 @@ DOWNLOADABLE_APK_URL = getenv("DOWNLOADABLE_APK_URL", "https://beiwe-app-backups
 #   Expects an integer number.
 CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or cpu_count() * 2
 
+# The number of connections to S3 that each server process keeps open for reuse.  Every thread that
+# accesses S3 at the same time needs its own connection, threads beyond this number make a new
+# connection for every request.  By default this is based on CONCURRENT_NETWORK_OPS (data
+# processing downloads and uploads concurrently), you may want to increase it on frontend servers
+# that serve many data downloads.
+#   Expects an integer number.
+S3_MAX_POOL_CONNECTIONS = getenv("S3_MAX_POOL_CONNECTIONS", 0)
+
+# The maximum number of bytes of data files that each data download (the data access api and forest
+# task downloads) reads ahead of the researcher downloading it.  Files are downloaded from S3 on
+# CONCURRENT_NETWORK_OPS threads, up to this limit.  A larger value helps saturate fast
+# connections, but every concurrent data download can use this much memory on a frontend server.
+#   Expects an integer number.
+DATA_DOWNLOAD_PREFETCH_BYTES = getenv("DATA_DOWNLOAD_PREFETCH_BYTES", 128 * 1024 * 1024)
+
+# The maximum size in bytes of the local cache of data files, 0 (the default) disables the cache.
+# Data downloads, forest tasks, and data processing read data files (chunks) from S3 and decrypt
+# them, with the cache enabled a file that has not changed is read from S3 once per server and then
+# read from local disk.  The cache is shared by all processes on a server and least recently used
+# files are removed when it exceeds this size.  NOTE: cached files are stored decrypted, in
+# CHUNK_CACHE_DIRECTORY, which should be on an encrypted volume and is only readable by the user
+# running Beiwe.  When a participant's data is deleted their cached files are removed from the
+# cache of the server that runs the deletion, every other server removes them before its next
+# data processing task, forest task or data download; they are never read from the cache again.
+#   Expects an integer number.
+CHUNK_CACHE_MAX_BYTES = getenv("CHUNK_CACHE_MAX_BYTES", 0)
+CHUNK_CACHE_DIRECTORY = getenv("CHUNK_CACHE_DIRECTORY", join(expanduser("~"), "beiwe_chunk_cache"))
+
+# The maximum size in bytes of each frontend server process's in-memory cache of Tableau API
+# responses, 0 (the default) disables the cache.  Tableau workbooks repeat the same queries every
+# time they refresh, with the cache enabled a query is answered from memory until the study's
+# summary statistics change.  Responses larger than a quarter of this size are not cached.
+#   Expects an integer number.
+TABLEAU_RESULT_CACHE_MAX_BYTES = getenv("TABLEAU_RESULT_CACHE_MAX_BYTES", 0)
+
 # This is number of files to be pulled in and processed simultaneously on data processing servers,
 # it has no effect on frontend servers. Mostly this affects the ram utilization of file processing.
 # A larger "page" of files to process is more efficient with respect to network bandwidth (and
@@ -66,6 +102,21 @@ CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or cpu_count() * 2
 #   Expects an integer number.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE", 100)
 
+# The number of additional processes each data processing task uses to parse files, which allows a
+# single participant's backlog to use more than one CPU core.  Note that each celery worker process
+# runs its own data processing task, so the total process count is roughly the celery concurrency
+# multiplied by this value.  It has no effect on frontend servers.  0 (the default) disables this,
+# files are then parsed on the data processing task's own process.
+#   Expects an integer number.
+DATA_PROCESSING_WORKER_PROCESSES = getenv("DATA_PROCESSING_WORKER_PROCESSES", 0)
+
+# When enabled, files uploaded by the Beiwe apps are stored on S3 exactly as they are received, and
+# are decrypted by the data processing servers instead of during the upload.  This substantially
+# reduces the CPU usage of uploads on frontend servers.  Uploads that have not been processed yet
+# are not visible in the raw data download.  This setting only needs to be set on frontend servers.
+#   Expects (case-insensitive) "true" to enable, otherwise it is disabled.
+DEFER_UPLOAD_DECRYPTION = getenv('DEFER_UPLOAD_DECRYPTION', 'false').lower() == 'true'
+
 #
 # Push Notification directives
 
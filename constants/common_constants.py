@@ -41,6 +41,9 @@ DISPLAY_TIME_FORMAT = "%Y-%m-%d %-I:%M%p (%Z)"
 # file path for s3 for problem uploads
 PROBLEM_UPLOADS = "PROBLEM_UPLOADS"
 
+# file path for s3 for uploads that have not been decrypted yet (see DEFER_UPLOAD_DECRYPTION)
+RAW_UPLOADS = "RAW_UPLOADS"
+
 # file path for custom ondeploy script
 CUSTOM_ONDEPLOY_SCRIPT_EB = "CUSTOM_ONDEPLOY_SCRIPT/EB"
 CUSTOM_ONDEPLOY_SCRIPT_PROCESSING = "CUSTOM_ONDEPLOY_SCRIPT/PROCESSING"
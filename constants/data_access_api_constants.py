@@ -1,4 +1,32 @@
 CHUNK_FIELDS = (
     "pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
-    "participant__patient_id", "study_id", "survey_id", "survey__object_id"
+    "participant__patient_id", "study_id", "survey_id", "survey__object_id", "file_size"
 )
+
+# values of the compression parameter of the data download api
+COMPRESSION_NONE = "none"  # a zip file, files are stored
+COMPRESSION_DEFLATE = "deflate"  # a zip file, files are deflated
+COMPRESSION_ZSTD = "zstd"  # a zstd-compressed tar file
+COMPRESSION_OPTIONS = (COMPRESSION_NONE, COMPRESSION_DEFLATE, COMPRESSION_ZSTD)
+
+# Incremental downloads with a sync cursor exclude chunks updated within this many seconds, a chunk
+# that is being written when a download starts could otherwise end up behind the returned cursor.
+# This needs to comfortably exceed the time between a ChunkRegistry's last_updated being set and
+# its transaction committing, and any clock difference between servers.
+SYNC_CURSOR_DELAY_SECONDS = 5*60
+
+# The data manifest is queried in pages of this many chunks.
+DATA_MANIFEST_PAGE_SIZE = 10000
+
+# The maximum number of files that can be requested from the data files api at once.
+DATA_FILES_MAX_BATCH_SIZE = 500
+
+# values of the output_format parameter of the data download api
+OUTPUT_FORMAT_CSV = "csv"  # the data files as they are stored, hourly csv files
+OUTPUT_FORMAT_PARQUET = "parquet"  # per-participant, per-data stream parquet files
+OUTPUT_FORMAT_ARROW = "arrow"  # per-participant, per-data stream arrow ipc files
+OUTPUT_FORMAT_OPTIONS = (OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_PARQUET, OUTPUT_FORMAT_ARROW)
+
+# Parquet and arrow files are built in memory, a participant's data stream is split into several
+# files of roughly at most this size.
+COLUMNAR_EXPORT_MAX_FILE_BYTES = 128 * 1024 * 1024
@@ -11,6 +11,22 @@ CHUNK_TIMESLICE_QUANTUM = 3600
 # the name of the s3 folder that contains chunked data
 CHUNKS_FOLDER = "CHUNKED_DATA"
 
+# Rollup chunks (see ROLLUP_DATA_STREAMS) cover a day, each row summarizes a minute of data.
+ROLLUP_TIMESLICE_QUANTUM = 24 * 3600
+ROLLUP_PERIOD_MS = 60 * 1000
+ROLLUP_HEADER = b"timestamp,UTC time,count,x_mean,x_std,y_mean,y_std,z_mean,z_std," \
+    b"magnitude_mean,magnitude_std"
+
+# High volume sensor data streams with a fixed schema of a millisecond timestamp followed by numeric
+# columns.  These use the (numpy-based) columnar data processing code path when possible.
+COLUMNAR_DATA_STREAMS = {ACCELEROMETER, DEVICEMOTION, GYRO, MAGNETOMETER}
+
+## Scheduling
+# A data processing task processes pages of a participant's files for (roughly) this many seconds
+# and then ends, so that a large backlog can't occupy a worker for hours while other participants
+# wait.  This is a little shorter than the interval at which data processing tasks are queued.
+DATA_PROCESSING_TASK_SECONDS = 5*60
+
 # These reference dicts contain the output headers that should exist for each data stream, per-os.
 #  A value of None means that the os cannot generate that data (or the dictionary needs to be updated)
 
@@ -115,6 +115,22 @@ CHUNKABLE_FILES = {
     IOS_LOG_FILE
 }
 
+# Rollups are per-minute summaries of high frequency sensor data, maintained by data processing in
+# their own (daily) chunks.  Keys are the data streams that are summarized, values are the data
+# streams of their rollups.
+ACCELEROMETER_MINUTES = "accelerometer_minutes"
+GYRO_MINUTES = "gyro_minutes"
+MAGNETOMETER_MINUTES = "magnetometer_minutes"
+
+ROLLUP_DATA_STREAMS = {
+    ACCELEROMETER: ACCELEROMETER_MINUTES,
+    GYRO: GYRO_MINUTES,
+    MAGNETOMETER: MAGNETOMETER_MINUTES,
+}
+
+# the data streams that can be downloaded through the data access api
+DATA_ACCESS_STREAMS = ALL_DATA_STREAMS + list(ROLLUP_DATA_STREAMS.values())
+
 # dictionary for printing ALL data streams (processed and bytes)
 
 
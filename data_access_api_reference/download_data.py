@@ -1,7 +1,12 @@
+import base64
+import hashlib
 import io
 import json
 import os
+import tarfile
+import time
 import zipfile
+from concurrent.futures import as_completed, ThreadPoolExecutor
 
 from os import path
 
@@ -44,6 +49,16 @@ MAGNETOMETER = "magnetometer"
 DEVICEMOTION = "devicemotion"
 REACHABILITY = "reachability"
 
+# Compression
+COMPRESSION_NONE = "none"
+COMPRESSION_DEFLATE = "deflate"
+COMPRESSION_ZSTD = "zstd"
+
+# Output formats
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMAT_PARQUET = "parquet"
+OUTPUT_FORMAT_ARROW = "arrow"
+
 RUNNING_IN_TEST_MODE = False
 SKIP_DOWNLOAD = False
 
@@ -60,7 +75,8 @@ if not API_URL_BASE.endswith("/"):
 
 def make_request(
         study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_ids=None, data_streams=None,
-        time_start=None, time_end=None
+        time_start=None, time_end=None, compression=COMPRESSION_DEFLATE, sync=False,
+        trim_rows=False, output_format=OUTPUT_FORMAT_CSV
 ):
     """
     Behavior
@@ -105,6 +121,33 @@ def make_request(
     Use the string from this module's API_TIME_FORMAT variable if you are using the Python
     DateTime library to generate date strings, or investigate the commented out lines of code in
     this function.
+
+    Compression
+    Data is compressed on the server, which greatly reduces download size and time. The default,
+    COMPRESSION_DEFLATE, is a compressed zip file. COMPRESSION_ZSTD (a zstd-compressed tar file)
+    is faster to decompress and compresses better, it requires the python zstd library
+    (pip install zstd). COMPRESSION_NONE is an uncompressed zip file.
+
+    Sync
+    With sync=True the server keeps track of what you have downloaded with a small "sync_cursor"
+    file instead of the registry, and only sends files that were created or updated since your
+    last download. This is much faster than the registry for large studies. Always use the same
+    query parameters (users, data streams, times) with the same sync_cursor file. Files updated
+    in the last few minutes are left for the next download.
+
+    Trim Rows
+    Data files cover an hour. With trim_rows=True the files at the start and end of the requested
+    time range are trimmed to the rows within it (and the file that contains time_start is
+    included), which makes short time ranges much smaller downloads. Trimmed files are not added to
+    the registry, they are downloaded again by the next request.
+
+    Output Format
+    By default you receive the data files as they are stored, hourly csv files. With
+    OUTPUT_FORMAT_PARQUET (or OUTPUT_FORMAT_ARROW, arrow ipc files) each participant's data
+    streams are combined into typed files (e.g. pandas.read_parquet), without the "UTC time"
+    column, which is the timestamp column as a string. Columnar downloads always contain all of
+    the requested data, they can't be combined with sync=True and don't use the registry. The
+    files are already compressed, use compression=COMPRESSION_NONE.
     """
 
     if access_key is None or secret_key is None:
@@ -138,8 +181,24 @@ def make_request(
         # if isinstance(time_end, datetime):
         # time_end = time_end.strftime(API_TIME_FORMAT)
         values['time_end'] = time_end
-
-    if path.exists("master_registry"):
+    if compression:
+        values['compression'] = compression
+    if trim_rows:
+        values['trim_rows'] = "true"
+    columnar = output_format != OUTPUT_FORMAT_CSV
+    if columnar:
+        values['output_format'] = output_format
+
+    if columnar:
+        pass  # columnar downloads don't have a registry
+    elif sync:
+        # an empty sync cursor starts from the beginning
+        if path.exists("sync_cursor"):
+            with open("sync_cursor") as f:
+                values["sync_cursor"] = f.read()
+        else:
+            values["sync_cursor"] = ""
+    elif path.exists("master_registry"):
         with open("master_registry") as f:
             old_registry = json.load(f)
             f.close()
@@ -159,22 +218,156 @@ def make_request(
     data = response.content
     print("Data received.  Unpacking and overwriting any updated files into", path.abspath('.'))
 
-    z = zipfile.ZipFile(io.BytesIO(data))
-    z.extractall()
+    z = extract_archive(data, compression)
 
-    with open("registry") as f:
-        new_registry = json.load(f)
-        f.close()
+    # in sync mode the new sync_cursor file was extracted over the old one.
+    if not sync and not columnar:
+        with open("registry") as f:
+            new_registry = json.load(f)
+            f.close()
 
-    old_registry.update(new_registry)
-    with open("master_registry", "w") as f:
-        json.dump(old_registry, f)
-    os.remove("registry")
+        old_registry.update(new_registry)
+        with open("master_registry", "w") as f:
+            json.dump(old_registry, f)
+        os.remove("registry")
     print("Operations complete.")
     # Uncomment the following line to have the function return a list of newly updated files.
+    # (for a zstd-compressed tar file use z.getnames() instead of z.filelist)
     # return [name.filename for name in z.filelist if name.filename != "registry"]
 
 
+def make_concurrent_request(
+        study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_ids=None, data_streams=None,
+        time_start=None, time_end=None, compression=COMPRESSION_DEFLATE, threads=8, batch_size=100,
+        retries=3,
+):
+    """
+    Behavior
+    As make_request, but the list of files (the manifest) is requested first and then the files
+    are downloaded in batches of batch_size files, with threads batches downloading at a time. A
+    batch that fails is retried up to retries times. The downloaded files are recorded in the
+    "manifest_registry" file in your current working directory, files that are in it and have not
+    changed on the server are not downloaded again, so an interrupted download (or one where some
+    batches failed) resumes where it left off when you run it again.
+
+    This is the recommended way to download a large amount of data. The user_ids, data_streams,
+    time_start, time_end, and compression parameters are the same as for make_request.
+    """
+    if access_key is None or secret_key is None:
+        raise Exception("You must provide credentials to run this API call.")
+
+    values = get_study_values(study_id, access_key, secret_key)
+    if user_ids:
+        values['user_ids'] = json.dumps(user_ids)
+    if data_streams:
+        values['data_streams'] = json.dumps(data_streams)
+    if time_start:
+        values['time_start'] = time_start
+    if time_end:
+        values['time_end'] = time_end
+
+    print("requesting the manifest.")
+    response = requests.post(API_URL_BASE + 'get-data-manifest/v1', data=values)
+    if response.status_code != 200:
+        raise requests.exceptions.HTTPError(response.status_code)
+    manifest = response.json()
+
+    registry = {}
+    if path.exists("manifest_registry"):
+        with open("manifest_registry") as f:
+            registry = json.load(f)
+
+    # a file is downloaded if it is new or if it has changed
+    to_download = [
+        entry for entry in manifest
+        if registry.get(entry["chunk_path"]) != [entry["chunk_hash"], entry["file_size"]]
+    ]
+    batches = [to_download[i:i + batch_size] for i in range(0, len(to_download), batch_size)]
+    print(
+        f"{len(manifest)} files, {len(manifest) - len(to_download)} already downloaded, "
+        f"downloading {len(to_download)} files in {len(batches)} batches into", path.abspath('.')
+    )
+
+    file_values = get_study_values(study_id, access_key, secret_key)
+    if compression:
+        file_values['compression'] = compression
+
+    def download_batch(batch):
+        file_values_batch = dict(file_values, chunk_ids=json.dumps([e["chunk_id"] for e in batch]))
+        for attempt in range(1, retries + 1):
+            try:
+                response = requests.post(API_URL_BASE + 'get-data-files/v1', data=file_values_batch)
+                if response.status_code != 200:
+                    raise requests.exceptions.HTTPError(response.status_code)
+                extract_archive(response.content, compression)
+                return batch
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"batch failed ({e}), retrying.")
+                time.sleep(2 ** attempt)
+
+    failed_batches = 0
+    completed_files = 0
+    try:
+        with ThreadPoolExecutor(threads) as executor:
+            for future in as_completed([executor.submit(download_batch, b) for b in batches]):
+                try:
+                    batch = future.result()
+                except Exception as e:
+                    failed_batches += 1
+                    print(f"batch failed: {e}")
+                    continue
+                for entry in batch:
+                    if file_matches_manifest(entry):
+                        registry[entry["chunk_path"]] = [entry["chunk_hash"], entry["file_size"]]
+                completed_files += len(batch)
+                print(f"{completed_files} of {len(to_download)} files downloaded.")
+    finally:
+        with open("manifest_registry", "w") as f:
+            json.dump(registry, f)
+
+    if failed_batches:
+        print(f"{failed_batches} batches failed, run this again to download the missing files.")
+    else:
+        print("Operations complete.")
+
+
+def get_study_values(study_id, access_key, secret_key):
+    try:
+        int(study_id)
+        study_key = "study_pk"
+    except ValueError:
+        study_key = "study_id"
+    return {
+        'access_key': access_key,
+        'secret_key': secret_key,
+        study_key: study_id,
+    }
+
+
+def extract_archive(data, compression):
+    """ Extracts a data download into the current working directory. """
+    if compression == COMPRESSION_ZSTD:
+        import zstd  # the zstd library decompresses all frames of the stream
+        z = tarfile.open(fileobj=io.BytesIO(zstd.decompress(data)))
+    else:
+        z = zipfile.ZipFile(io.BytesIO(data))
+    z.extractall()
+    return z
+
+
+def file_matches_manifest(entry):
+    """ Checks a downloaded file against the chunk_hash (a base64 md5 hash) from the manifest.
+    Files that are not chunked data don't have a chunk_hash, those are only checked for existence. """
+    if not path.exists(entry["file_name"]):
+        return False
+    if not entry["chunk_hash"]:
+        return True
+    with open(entry["file_name"], "rb") as f:
+        return base64.b64encode(hashlib.md5(f.read()).digest()).decode() == entry["chunk_hash"]
+
+
 def get_users_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY):
     """ Provides a list of user ids enrolled in the given study. """
     url = API_URL_BASE + 'get-users/v1'
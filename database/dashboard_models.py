@@ -3,12 +3,12 @@ from __future__ import annotations
 from django.db import models
 from django.db.models import Manager
 
-from database.models import TimestampedModel
+from database.models import TimestampedModel, UtilityModel
 
 
 # this is an import hack to improve IDE assistance
 try:
-    from database.models import Study
+    from database.models import Participant, Study
 except ImportError:
     pass
 
@@ -75,3 +75,30 @@ class DashboardInflection(TimestampedModel):
     # no default for the operator, default of 0 is safe.
     operator = models.CharField(max_length=1)
     inflection_point = models.IntegerField(default=0)
+
+
+class DashboardDataQuantity(UtilityModel):
+    """ The number of bytes of a data stream that a participant uploaded for a day (in the study's
+    timezone), these are the cells of the dashboard heatmaps.  Data processing keeps these up to
+    date along with the SummaryStatisticDaily data quantities, the dashboard only has to read the
+    days it displays. """
+    study: Study = models.ForeignKey(
+        "Study", on_delete=models.PROTECT, related_name="dashboard_data_quantities"
+    )
+    participant: Participant = models.ForeignKey(
+        "Participant", on_delete=models.PROTECT, related_name="dashboard_data_quantities"
+    )
+    data_type = models.CharField(max_length=32)
+    date = models.DateField()
+    bytes = models.PositiveBigIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["participant", "data_type", "date"], name="unique_dashboard_data_quantity"
+            )
+        ]
+        indexes = [
+            # the data stream dashboard reads a range of days of a study's data stream
+            models.Index(fields=["study", "data_type", "date"], name="dashboard_study_type_date"),
+        ]
@@ -2,19 +2,20 @@ from __future__ import annotations
 
 from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from django.db import models
-from django.db.models import QuerySet
+from django.db import models, transaction
+from django.db.models import Max, Min, Q, QuerySet
 
 from django.utils import timezone
 
 from constants.common_constants import API_TIME_FORMAT, EARLIEST_POSSIBLE_DATA_DATETIME
+from constants.data_access_api_constants import SYNC_CURSOR_DELAY_SECONDS
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER
 from constants.data_stream_constants import (CHUNKABLE_FILES, IDENTIFIERS,
-    REVERSE_UPLOAD_FILE_TYPE_MAPPING)
+    REVERSE_UPLOAD_FILE_TYPE_MAPPING, ROLLUP_DATA_STREAMS)
 from constants.user_constants import OS_TYPE_CHOICES
-from database.models import TimestampedModel
+from database.models import TimestampedModel, UtilityModel
 from database.user_models_participant import Participant
 from libs.security import chunk_hash
 
@@ -26,6 +27,9 @@ except ImportError:
     pass
 
 
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
 class UnchunkableDataTypeError(Exception): pass
 class ChunkableDataTypeError(Exception): pass
 
@@ -55,6 +59,17 @@ class ChunkRegistry(TimestampedModel):
         db_index=True
     )
     
+    class Meta:
+        # composite indexes for the real access patterns: data access api queries (a study or some
+        # participants, some data streams, a time range) and queries for recently updated data.
+        indexes = [
+            models.Index(fields=["study", "data_type", "time_bin"], name="chunk_study_type_time"),
+            models.Index(
+                fields=["participant", "data_type", "time_bin"], name="chunk_participant_type_time"
+            ),
+            models.Index(fields=["study", "last_updated"], name="chunk_study_last_updated"),
+        ]
+    
     def s3_retrieve(self) -> bytes:
         from libs.s3 import s3_retrieve
         return s3_retrieve(self.chunk_path, self.study.object_id, raw_path=True)
@@ -63,14 +78,24 @@ class ChunkRegistry(TimestampedModel):
     def register_chunked_data(
             cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None
     ):
-        if data_type not in CHUNKABLE_FILES:
+        cls.build_chunked_data(
+            data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id
+        ).save()
+    
+    @classmethod
+    def build_chunked_data(
+            cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None
+    ) -> ChunkRegistry:
+        """ Returns an unsaved ChunkRegistry for new chunked data (or a rollup chunk), for use with
+        bulk_create. """
+        if data_type not in CHUNKABLE_FILES and data_type not in ROLLUP_DATA_STREAMS.values():
             raise UnchunkableDataTypeError
         
         chunk_hash_str = chunk_hash(file_contents).decode()
         time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
         
-        cls.objects.create(
+        return cls(
             is_chunkable=True,
             chunk_path=chunk_path,
             chunk_hash=chunk_hash_str,
@@ -84,13 +109,13 @@ class ChunkRegistry(TimestampedModel):
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
-                                file_contents, survey_id=None):
+                                file_contents, survey_id=None) -> ChunkRegistry:
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(unix_timestamp), timezone.utc)
         
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         
-        cls.objects.create(
+        return cls.objects.create(
             is_chunkable=False,
             chunk_path=chunk_path,
             chunk_hash='',
@@ -103,23 +128,33 @@ class ChunkRegistry(TimestampedModel):
         )
     
     @classmethod
-    def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents):
+    def update_registered_unchunked_data(
+        cls, data_type, chunk_path, file_contents
+    ) -> Tuple[ChunkRegistry, int]:
         """ Updates the data in case a user uploads an unchunkable file more than once,
-        and updates the file size just in case it changed. """
+        and updates the file size just in case it changed.  Returns the chunk and the change in
+        file size. """
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         chunk = cls.objects.get(chunk_path=chunk_path)
+        previous_file_size = chunk.file_size or 0
         chunk.file_size = len(file_contents)
         chunk.save()
+        return chunk, chunk.file_size - previous_file_size
     
     @classmethod
     def get_chunks_time_range(
-        cls, study_id, user_ids=None, data_types=None, start=None, end=None) -> QuerySet[ChunkRegistry]:
+        cls, study_id, user_ids=None, data_types=None, start=None, end=None, participant_ids=None
+    ) -> QuerySet[ChunkRegistry]:
         """This function uses Django query syntax to provide datetimes and have Django do the
         comparison operation, and the 'in' operator to have Django only match the user list
-        provided. """
+        provided.  Participant pks (participant_ids) are preferred over patient ids (user_ids), they
+        don't require a join and the query can use the (participant, data_type, time_bin) index.
+        Rollup chunks are only included if their data types are requested. """
         query = {'study_id': study_id}
-        if user_ids:
+        if participant_ids:
+            query['participant_id__in'] = participant_ids
+        elif user_ids:
             query['participant__patient_id__in'] = user_ids
         if data_types:
             query['data_type__in'] = data_types
@@ -127,7 +162,35 @@ class ChunkRegistry(TimestampedModel):
             query['time_bin__gte'] = start
         if end:
             query['time_bin__lte'] = end
-        return cls.objects.filter(**query)
+        chunks = cls.objects.filter(**query)
+        if not data_types:
+            chunks = chunks.exclude(data_type__in=ROLLUP_DATA_STREAMS.values())
+        return chunks
+    
+    @staticmethod
+    def encode_sync_cursor(last_updated: datetime, pk: int) -> str:
+        """ A sync cursor is a position in (last_updated, pk) order, it is encoded as the
+        microseconds since the unix epoch of last_updated and the pk. """
+        return f"{(last_updated - UNIX_EPOCH) // timedelta(microseconds=1)}_{pk}"
+    
+    @staticmethod
+    def decode_sync_cursor(sync_cursor: str) -> Tuple[datetime, int]:
+        """ The empty string is the start, raises a ValueError if the cursor is invalid. """
+        if sync_cursor == "":
+            return UNIX_EPOCH, 0
+        microseconds, pk = sync_cursor.split("_")
+        return UNIX_EPOCH + timedelta(microseconds=int(microseconds)), int(pk)
+    
+    @classmethod
+    def filter_by_sync_cursor(cls, chunks: QuerySet, sync_cursor: str) -> QuerySet[ChunkRegistry]:
+        """ Returns the chunks that were created or updated after the sync cursor, ordered so that
+        the position of the last chunk is the next sync cursor.  Recently updated chunks are left
+        for the next sync, see SYNC_CURSOR_DELAY_SECONDS. """
+        last_updated, pk = cls.decode_sync_cursor(sync_cursor)
+        return chunks.filter(
+            Q(last_updated__gt=last_updated) | Q(last_updated=last_updated, pk__gt=pk),
+            last_updated__lt=timezone.now() - timedelta(seconds=SYNC_CURSOR_DELAY_SECONDS),
+        ).order_by("last_updated", "pk")
     
     @classmethod
     def get_updated_users_for_study(cls, study, date_of_last_activity) -> QuerySet[str]:
@@ -145,6 +208,145 @@ class ChunkRegistry(TimestampedModel):
         return cls.objects.exclude(time_bin__lt=EARLIEST_POSSIBLE_DATA_DATETIME)
 
 
+class ChunkTimeBinExtent(UtilityModel):
+    """ The earliest and latest ChunkRegistry time bins of a participant's data stream (rollups are
+    not included).  Data processing widens these when it registers new chunks, in the same
+    transaction; anything that deletes ChunkRegistries should call recalculate.  Finding the first
+    or last data of a study only has to read the extents of its participants' data streams, instead
+    of every time bin of the study. """
+    study: Study = models.ForeignKey(
+        'Study', on_delete=models.PROTECT, related_name='chunk_time_bin_extents'
+    )
+    participant: Participant = models.ForeignKey(
+        'Participant', on_delete=models.PROTECT, related_name='chunk_time_bin_extents'
+    )
+    data_type = models.CharField(max_length=32)
+    earliest_time_bin = models.DateTimeField()
+    latest_time_bin = models.DateTimeField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["participant", "data_type"], name="unique_chunk_time_bin_extent"
+            )
+        ]
+    
+    @classmethod
+    def widen(cls, participant: Participant, chunk_time_bins: Iterable[Tuple[str, datetime]]):
+        """ Widens the extents of a participant's data streams to include the (data type, time bin)
+        of new chunks.  Must be called inside of the transaction that creates the chunks. """
+        extents: Dict[str, Tuple[datetime, datetime]] = {}
+        for data_type, time_bin in chunk_time_bins:
+            if data_type in ROLLUP_DATA_STREAMS.values():
+                continue
+            earliest, latest = extents.get(data_type, (time_bin, time_bin))
+            extents[data_type] = min(earliest, time_bin), max(latest, time_bin)
+        if not extents:
+            return
+        
+        existing_extents = {
+            extent.data_type: extent for extent in cls.objects.select_for_update()
+            .filter(participant=participant, data_type__in=extents)
+        }
+        new_extents: List[ChunkTimeBinExtent] = []
+        updated_extents: List[ChunkTimeBinExtent] = []
+        for data_type, (earliest, latest) in extents.items():
+            extent = existing_extents.get(data_type)
+            if extent is None:
+                new_extents.append(cls(
+                    study_id=participant.study_id, participant=participant, data_type=data_type,
+                    earliest_time_bin=earliest, latest_time_bin=latest,
+                ))
+            elif earliest < extent.earliest_time_bin or latest > extent.latest_time_bin:
+                extent.earliest_time_bin = min(extent.earliest_time_bin, earliest)
+                extent.latest_time_bin = max(extent.latest_time_bin, latest)
+                updated_extents.append(extent)
+        
+        if new_extents:
+            cls.objects.bulk_create(new_extents)
+        if updated_extents:
+            cls.objects.bulk_update(updated_extents, ["earliest_time_bin", "latest_time_bin"])
+    
+    @classmethod
+    def recalculate(cls, participant: Participant) -> int:
+        """ Recalculates the extents of a participant's data streams from their ChunkRegistries (one
+        grouped query on the participant, data type, time bin index), e.g. after chunks were
+        deleted.  Returns the number of extents that were corrected. """
+        with transaction.atomic():
+            existing_extents = {
+                extent.data_type: extent for extent in
+                cls.objects.select_for_update().filter(participant=participant)
+            }
+            correct_extents = {
+                row["data_type"]: (row["earliest"], row["latest"]) for row in
+                ChunkRegistry.objects.filter(participant=participant)
+                .exclude(data_type__in=ROLLUP_DATA_STREAMS.values())
+                .values("data_type").annotate(earliest=Min("time_bin"), latest=Max("time_bin"))
+                .order_by()
+            }
+            new_extents: List[ChunkTimeBinExtent] = []
+            updated_extents: List[ChunkTimeBinExtent] = []
+            for data_type, (earliest, latest) in correct_extents.items():
+                extent = existing_extents.get(data_type)
+                if extent is None:
+                    new_extents.append(cls(
+                        study_id=participant.study_id, participant=participant,
+                        data_type=data_type, earliest_time_bin=earliest, latest_time_bin=latest,
+                    ))
+                elif (extent.earliest_time_bin, extent.latest_time_bin) != (earliest, latest):
+                    extent.earliest_time_bin, extent.latest_time_bin = earliest, latest
+                    updated_extents.append(extent)
+            stale_extents = [
+                extent.pk for data_type, extent in existing_extents.items()
+                if data_type not in correct_extents
+            ]
+            
+            if new_extents:
+                cls.objects.bulk_create(new_extents)
+            if updated_extents:
+                cls.objects.bulk_update(updated_extents, ["earliest_time_bin", "latest_time_bin"])
+            if stale_extents:
+                cls.objects.filter(pk__in=stale_extents).delete()
+        return len(new_extents) + len(updated_extents) + len(stale_extents)
+    
+    @classmethod
+    def get_study_time_bin(
+        cls, study: Study, earliest: bool = True, only_after_epoch: bool = True,
+        only_before_now: bool = True,
+    ) -> Optional[datetime]:
+        """ Returns the earliest or latest time bin of a study's data.  An extent that reaches
+        outside of the requested range (i.e. data with a bad timestamp, before the unix epoch or in
+        the future) is narrowed with an indexed query on that participant's data stream. """
+        lower_bound = UNIX_EPOCH if only_after_epoch else None  # exclusive
+        upper_bound = timezone.now() if only_before_now else None  # inclusive
+        
+        time_bins = []
+        for extent in cls.objects.filter(study=study):
+            if (lower_bound and extent.latest_time_bin <= lower_bound) or \
+                    (upper_bound and extent.earliest_time_bin > upper_bound):
+                continue  # all of this data stream's time bins are out of range
+            if (lower_bound and extent.earliest_time_bin <= lower_bound) or \
+                    (upper_bound and extent.latest_time_bin > upper_bound):
+                chunks = ChunkRegistry.objects.filter(
+                    participant_id=extent.participant_id, data_type=extent.data_type
+                )
+                if lower_bound:
+                    chunks = chunks.filter(time_bin__gt=lower_bound)
+                if upper_bound:
+                    chunks = chunks.filter(time_bin__lte=upper_bound)
+                time_bin = chunks.aggregate(
+                    time_bin=Min("time_bin") if earliest else Max("time_bin")
+                )["time_bin"]
+            else:
+                time_bin = extent.earliest_time_bin if earliest else extent.latest_time_bin
+            if time_bin is not None:
+                time_bins.append(time_bin)
+        
+        if not time_bins:
+            return None
+        return min(time_bins) if earliest else max(time_bins)
+
+
 class FileToProcess(TimestampedModel):
     # todo: this should have a max length of 66 characters on audio recordings
     s3_file_path = models.CharField(max_length=256, blank=False, unique=True)
@@ -152,6 +354,8 @@ class FileToProcess(TimestampedModel):
     participant: Participant = models.ForeignKey('Participant', on_delete=models.PROTECT, related_name='files_to_process')
     os_type = models.CharField(max_length=16, choices=OS_TYPE_CHOICES, blank=True, null=False, default="")
     deleted = models.BooleanField(default=False)
+    # the file is stored undecrypted at RAW_UPLOADS/s3_file_path until data processing decrypts it.
+    deferred_decryption = models.BooleanField(default=False)
     
     def s3_retrieve(self) -> bytes:
         from libs.s3 import s3_retrieve
@@ -176,13 +380,16 @@ class FileToProcess(TimestampedModel):
         ).exists()
     
     @classmethod
-    def append_file_for_processing(cls, file_path: str, participant: Participant):
+    def append_file_for_processing(
+        cls, file_path: str, participant: Participant, deferred_decryption: bool = False
+    ):
         # normalize the file path, grab the study id, passthrough kwargs to create; create.
         cls.objects.create(
             s3_file_path=cls.normalize_s3_file_path(file_path, participant.study.object_id),
             participant=participant,
             study=participant.study,
             os_type=participant.os_type,
+            deferred_decryption=deferred_decryption,
         )
     
     @classmethod
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-18 06:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0107_alter_devicesettings_consent_form_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetoprocess',
+            name='deferred_decryption',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.20 on 2026-10-18 07:27
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(AddIndexConcurrently):
+    """ ChunkRegistry is the largest table, a plain CREATE INDEX would lock it against writes (data
+    processing) for the duration of the build.  Other databases (the tests use sqlite) don't
+    support concurrent index creation, they get a plain AddIndex. """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(
+                self, app_label, schema_editor, from_state, to_state
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(
+                self, app_label, schema_editor, from_state, to_state
+            )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # concurrent index creation can't run inside a transaction
+
+    dependencies = [
+        ('database', '0108_filetoprocess_deferred_decryption'),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyOnPostgres(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'data_type', 'time_bin'], name='chunk_study_type_time'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='chunkregistry',
+            index=models.Index(fields=['participant', 'data_type', 'time_bin'], name='chunk_participant_type_time'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'last_updated'], name='chunk_study_last_updated'),
+        ),
+    ]
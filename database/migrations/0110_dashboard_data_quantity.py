@@ -0,0 +1,65 @@
+# Generated by Django 3.2.20 on 2026-10-18 07:50
+
+from collections import defaultdict
+
+from dateutil.tz import gettz
+from django.db import migrations, models
+import django.db.models.deletion
+
+from constants.data_stream_constants import ALL_DATA_STREAMS
+
+
+def populate_dashboard_data_quantities(apps, schema_editor):
+    ChunkRegistry = apps.get_model('database', 'ChunkRegistry')
+    DashboardDataQuantity = apps.get_model('database', 'DashboardDataQuantity')
+    Participant = apps.get_model('database', 'Participant')
+
+    for participant in Participant.objects.select_related("study"):
+        study_timezone = gettz(participant.study.timezone_name)
+        query = ChunkRegistry.objects.filter(
+            participant=participant, data_type__in=ALL_DATA_STREAMS
+        ).values_list('time_bin', 'data_type', 'file_size')
+
+        # dict[(date, data_type)] = total_bytes
+        daily_data_quantities = defaultdict(int)
+        for time_bin, data_type, file_size in query:
+            day = time_bin.astimezone(study_timezone).date()
+            daily_data_quantities[day, data_type] += file_size or 0
+
+        DashboardDataQuantity.objects.bulk_create(
+            DashboardDataQuantity(
+                study_id=participant.study_id, participant=participant, data_type=data_type,
+                date=day, bytes=total_bytes,
+            )
+            for (day, data_type), total_bytes in daily_data_quantities.items() if total_bytes
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0109_chunkregistry_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardDataQuantity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_type', models.CharField(max_length=32)),
+                ('date', models.DateField()),
+                ('bytes', models.PositiveBigIntegerField(default=0)),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='dashboard_data_quantities', to='database.participant')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='dashboard_data_quantities', to='database.study')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dashboarddataquantity',
+            index=models.Index(fields=['study', 'data_type', 'date'], name='dashboard_study_type_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='dashboarddataquantity',
+            constraint=models.UniqueConstraint(fields=('participant', 'data_type', 'date'), name='unique_dashboard_data_quantity'),
+        ),
+        migrations.RunPython(populate_dashboard_data_quantities, migrations.RunPython.noop),
+    ]
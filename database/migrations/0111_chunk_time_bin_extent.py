@@ -0,0 +1,54 @@
+# Generated by Django 3.2.20 on 2026-10-18 07:55
+
+from django.db import migrations, models
+from django.db.models import Max, Min
+import django.db.models.deletion
+
+from constants.data_stream_constants import ROLLUP_DATA_STREAMS
+
+
+def populate_chunk_time_bin_extents(apps, schema_editor):
+    ChunkRegistry = apps.get_model('database', 'ChunkRegistry')
+    ChunkTimeBinExtent = apps.get_model('database', 'ChunkTimeBinExtent')
+
+    # one grouped query over all ChunkRegistries
+    extents = ChunkRegistry.objects.exclude(data_type__in=ROLLUP_DATA_STREAMS.values()) \
+        .values("study_id", "participant_id", "data_type") \
+        .annotate(earliest=Min("time_bin"), latest=Max("time_bin")).order_by()
+    ChunkTimeBinExtent.objects.bulk_create(
+        (
+            ChunkTimeBinExtent(
+                study_id=extent["study_id"], participant_id=extent["participant_id"],
+                data_type=extent["data_type"], earliest_time_bin=extent["earliest"],
+                latest_time_bin=extent["latest"],
+            )
+            for extent in extents.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0110_dashboard_data_quantity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkTimeBinExtent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_type', models.CharField(max_length=32)),
+                ('earliest_time_bin', models.DateTimeField()),
+                ('latest_time_bin', models.DateTimeField()),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='chunk_time_bin_extents', to='database.participant')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='chunk_time_bin_extents', to='database.study')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chunktimebinextent',
+            constraint=models.UniqueConstraint(fields=('participant', 'data_type'), name='unique_chunk_time_bin_extent'),
+        ),
+        migrations.RunPython(populate_chunk_time_bin_extents, migrations.RunPython.noop),
+    ]
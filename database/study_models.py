@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import operator
 from datetime import datetime, tzinfo
 from typing import Any, Dict, Optional
 
@@ -10,7 +9,6 @@ from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.db.models import F, Func, Manager
 from django.db.models.query import QuerySet
-from django.utils import timezone
 from django.utils.timezone import localtime
 
 from constants.data_stream_constants import ALL_DATA_STREAMS
@@ -139,31 +137,19 @@ class Study(TimestampedModel):
     def _get_data_time_bin(
         self, earliest=True, only_after_epoch: bool = True, only_before_now: bool = True
     ) -> Optional[datetime]:
-        """ Return the earliest ChunkRegistry time bin datetime for this study.
-
-        Note: As of 2021-07-01, running the query as a QuerySet filter or sorting the QuerySet can
-              take upwards of 30 seconds. Doing the logic in python speeds this up tremendously.
+        """ Return the earliest (or latest) ChunkRegistry time bin datetime for this study, from
+        the ChunkTimeBinExtents of its participants' data streams.
+        
         Args:
             earliest: if True, will return earliest datetime; if False, will return latest datetime
             only_after_epoch: if True, will filter results only for datetimes after the Unix epoch
                               (1970-01-01T00:00:00Z)
             only_before_now: if True, will filter results only for datetimes before now """
-        time_bins: QuerySet[datetime] = self.chunk_registries.values_list("time_bin", flat=True)
-        comparator = operator.lt if earliest else operator.gt
-        now = timezone.now()
-        desired_time_bin = None
-        for time_bin in time_bins:
-            if only_after_epoch and time_bin.timestamp() <= 0:
-                continue
-            if only_before_now and time_bin > now:
-                continue
-            if desired_time_bin is None:
-                desired_time_bin = time_bin
-                continue
-            if comparator(desired_time_bin, time_bin):
-                continue
-            desired_time_bin = time_bin
-        return desired_time_bin
+        from database.data_access_models import ChunkTimeBinExtent
+        return ChunkTimeBinExtent.get_study_time_bin(
+            self, earliest=earliest, only_after_epoch=only_after_epoch,
+            only_before_now=only_before_now,
+        )
     
     def notification_events(self, **archived_event_filter_kwargs):
         from database.schedule_models import ArchivedEvent
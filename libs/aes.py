@@ -1,23 +1,57 @@
 from os import urandom
+from typing import Generator, Optional
 
 from Cryptodome.Cipher import AES
 
 
+# encrypt_for_server output starts with the initialization vector
+IV_LENGTH = 16
+
+
 def encrypt_for_server(input_string: bytes, encryption_key: bytes) -> bytes:
     """ Encrypts config using the ENCRYPTION_KEY, prepends the generated initialization vector.
     Use this function on an entire file (as a string). """
-    if not isinstance(encryption_key, bytes):
-        raise Exception(f"received non-bytes object {type(encryption_key)}")
-    if len(encryption_key) != 32:
-        raise Exception(f"received encryption key with bad length: {len(encryption_key)}")
-    iv: bytes = urandom(16)  # bytes
+    check_encryption_key(encryption_key)
+    iv: bytes = urandom(IV_LENGTH)  # bytes
     return iv + AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt(input_string)
 
 
+def encrypt_for_server_in_parts(
+    input_string: bytes, encryption_key: bytes, part_size: int
+) -> Generator[bytes, None, None]:
+    """ encrypt_for_server, but the output is generated in parts of part_size bytes (the last part
+    may be smaller), so that it never has to be in memory all at once. """
+    check_encryption_key(encryption_key)
+    iv: bytes = urandom(IV_LENGTH)
+    cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv)
+    input_view = memoryview(input_string)  # slices of a memoryview are not copies
+    yield iv + cipher.encrypt(input_view[:part_size - IV_LENGTH])
+    for start in range(part_size - IV_LENGTH, len(input_view), part_size):
+        yield cipher.encrypt(input_view[start:start + part_size])
+
+
 def decrypt_server(data: bytes, encryption_key: bytes) -> bytes:
     """ Decrypts config encrypted by the encrypt_for_server function. """
+    return decrypt_server_part(data, encryption_key)
+
+
+def decrypt_server_part(
+    data: bytes, encryption_key: bytes, output: memoryview = None
+) -> Optional[bytes]:
+    """ Decrypts any part of the output of encrypt_for_server, the part must start with the 16
+    bytes in front of it (the first part starts with the initialization vector).  This works
+    because in CFB mode with 8 bit segments the cipher state before decrypting a byte is the 16
+    bytes of ciphertext in front of it, so parts of a file can be decrypted in any order.
+    If output is provided the decrypted data is written to it, it must be the correct size. """
+    if not isinstance(encryption_key, bytes):
+        raise Exception(f"received non-bytes object {type(encryption_key)}")
+    data = memoryview(data)  # slices of a memoryview are not copies
+    return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=data[:IV_LENGTH]) \
+        .decrypt(data[IV_LENGTH:], output=output)
+
+
+def check_encryption_key(encryption_key: bytes):
     if not isinstance(encryption_key, bytes):
         raise Exception(f"received non-bytes object {type(encryption_key)}")
-    iv = data[:16]
-    data = data[16:]  # gr arg, memcopy operation...
-    return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)
+    if len(encryption_key) != 32:
+        raise Exception(f"received encryption key with bad length: {len(encryption_key)}")
@@ -0,0 +1,247 @@
+import errno
+import os
+import shutil
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from threading import get_ident, Lock
+from time import monotonic
+from typing import Optional, Set
+
+from config.settings import CHUNK_CACHE_DIRECTORY, CHUNK_CACHE_MAX_BYTES
+from constants.data_processing_constants import CHUNKS_FOLDER
+from database.user_models_participant import ParticipantDeletionEvent
+from libs.internal_types import StrOrParticipantOrStudy
+from libs.s3 import s3_retrieve, s3_retrieve_to_file
+
+
+# when the cache is over its size limit, least recently used files are removed until it is at this
+# fraction of the limit, so that eviction doesn't run on every write.
+EVICTION_LOW_WATERMARK = 0.9
+
+# how often (at most) a process reloads the participants whose data has been deleted
+PURGED_PARTICIPANTS_REFRESH_SECONDS = 60
+
+
+class ChunkCache:
+    """ A local, content-addressed cache of decrypted data files, shared by all processes on a
+    server.  Files are keyed by their chunk path, chunk hash and file size, so a chunk that changes
+    has a new key; entries never need to be invalidated, outdated entries age out of the cache.
+    (Files that are not chunked data have no chunk hash, they are keyed by their size.)  Files are
+    stored in a folder per participant, so that they can be removed when the participant's data is
+    deleted: participant data deletion purges the cache of the server it runs on, every other
+    server purges its cache in refresh_purged_participants, before its next task that uses the
+    cache.  The files of those participants are never read from or written to the cache again.
+    
+    Every process checks the size of the cache after writing a tenth of max_bytes, and removes the
+    least recently used files (by modification time, which is updated on every read) if the cache
+    is larger than max_bytes.  Files are written to a temporary file and renamed into place, so no
+    process ever reads a partial file.  A max_bytes of 0 disables the cache.
+    
+    retrieve_to_file hard links cached files into place (e.g. into the input folder of a forest
+    task), a file with more than one link is pinned: it is in use, so it is not evicted, and it
+    would stay on disk anyway.  It is unpinned when the other links are removed.  Pinned files
+    count towards max_bytes. """
+    
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self.bytes_written = 0  # since the last eviction check, by this process
+        self.hits = 0
+        self.misses = 0
+        self.purged_folder_names: Set[str] = set()
+        self.purged_refreshed_at: Optional[float] = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    def get_path(self, chunk: dict) -> Optional[str]:
+        """ Returns the cache path for a chunk (a dict with the chunk_path, chunk_hash and file_size
+        of a ChunkRegistry), or None if the chunk can't be cached. """
+        if not chunk.get("chunk_hash") and chunk.get("file_size") is None:
+            return None
+        folder_name = get_participant_folder_name(chunk["chunk_path"])
+        if folder_name in self.purged_folder_names:
+            return None
+        key = f'{chunk["chunk_path"]}\n{chunk.get("chunk_hash")}\n{chunk.get("file_size")}'
+        key_hash = sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, folder_name, key_hash)
+    
+    def get(self, chunk: dict) -> Optional[bytes]:
+        """ Returns the cached file contents, or None. """
+        cache_path = self.get_path(chunk) if self.enabled else None
+        if cache_path is None:
+            return None
+        try:
+            with open(cache_path, "rb") as f:
+                contents = f.read()
+            os.utime(cache_path)  # mark as recently used
+        except FileNotFoundError:  # (or evicted by another process)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return contents
+    
+    def put(self, chunk: dict, contents: bytes):
+        cache_path = self.get_path(chunk) if self.enabled else None
+        if cache_path is None:
+            return
+        self.make_folder(cache_path)
+        # (in the participant's folder, so that it is counted by evict and removed by purge)
+        temp_file = NamedTemporaryFile(dir=os.path.dirname(cache_path), delete=False)
+        try:
+            with temp_file:
+                temp_file.write(contents)
+            os.replace(temp_file.name, cache_path)
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+        self.wrote(len(contents))
+    
+    def put_file(self, chunk: dict, file_path: str):
+        """ Adds an existing file to the cache, it is hard linked if possible. """
+        cache_path = self.get_path(chunk) if self.enabled else None
+        if cache_path is None:
+            return
+        self.make_folder(cache_path)
+        temp_path = f"{cache_path}.{os.getpid()}.{id(file_path)}.tmp"
+        link_or_copy(file_path, temp_path)
+        os.replace(temp_path, cache_path)
+        self.wrote(os.path.getsize(cache_path))
+    
+    def make_folder(self, cache_path: str):
+        """ Creates the folder of a cache path, only the server's user can read the cache. """
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+    
+    def retrieve(self, chunk: dict, obj: StrOrParticipantOrStudy) -> bytes:
+        """ s3_retrieve (with raw_path=True), through the cache. """
+        contents = self.get(chunk)
+        if contents is None:
+            contents = s3_retrieve(chunk["chunk_path"], obj, raw_path=True)
+            self.put(chunk, contents)
+        return contents
+    
+    def retrieve_to_file(self, chunk: dict, obj: StrOrParticipantOrStudy, file_path: str):
+        """ s3_retrieve_to_file (with raw_path=True), through the cache.  Cached files are hard
+        linked to file_path if possible, so file_path must not be modified. """
+        cache_path = self.get_path(chunk) if self.enabled else None
+        if cache_path is not None:
+            try:
+                link_or_copy(cache_path, file_path)
+                os.utime(cache_path)
+                with self._lock:
+                    self.hits += 1
+                return
+            except FileNotFoundError:
+                with self._lock:
+                    self.misses += 1
+        
+        s3_retrieve_to_file(chunk["chunk_path"], obj, file_path, raw_path=True)
+        if cache_path is not None:
+            self.put_file(chunk, file_path)
+    
+    def wrote(self, byte_count: int):
+        with self._lock:
+            self.bytes_written += byte_count
+            if self.bytes_written < self.max_bytes // 10:
+                return
+            self.bytes_written = 0
+        self.evict()
+    
+    def evict(self):
+        """ Removes the least recently used files that are not pinned if the cache is larger than
+        max_bytes. """
+        files = []
+        total_bytes = 0
+        for folder in os.scandir(self.directory):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                total_bytes += stat.st_size
+                if stat.st_nlink == 1:  # (not pinned)
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        
+        if total_bytes <= self.max_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total_bytes <= self.max_bytes * EVICTION_LOW_WATERMARK:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # another process got there first
+                pass
+            total_bytes -= size
+    
+    def purge_participant(self, study_object_id: str, patient_id: str):
+        """ Removes all of a participant's cached files from this server's cache.  (Files in use,
+        see retrieve_to_file, are removed when they are no longer in use.) """
+        folder_name = get_participant_folder_name(f"{study_object_id}/{patient_id}")
+        self.purged_folder_names.add(folder_name)
+        shutil.rmtree(os.path.join(self.directory, folder_name), ignore_errors=True)
+    
+    def refresh_purged_participants(self):
+        """ Reloads the participants whose data has been deleted, or is queued for deletion, and
+        removes their folders from this server's cache.  Called at the start of data processing
+        tasks, forest tasks and data downloads, it only runs once every
+        PURGED_PARTICIPANTS_REFRESH_SECONDS per process. """
+        now = monotonic()
+        if self.purged_refreshed_at is not None \
+                and now - self.purged_refreshed_at < PURGED_PARTICIPANTS_REFRESH_SECONDS:
+            return
+        if not self.enabled and not os.path.isdir(self.directory):
+            return
+        self.purged_refreshed_at = now
+        
+        self.purged_folder_names |= {
+            get_participant_folder_name(f"{study_object_id}/{patient_id}")
+            for study_object_id, patient_id in ParticipantDeletionEvent.objects
+            .values_list("participant__study__object_id", "participant__patient_id")
+        }
+        try:
+            folder_names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for folder_name in self.purged_folder_names.intersection(folder_names):
+            shutil.rmtree(os.path.join(self.directory, folder_name), ignore_errors=True)
+    
+    def print_summary(self):
+        if self.enabled:
+            print(f"chunk cache: {self.hits} hits, {self.misses} misses.")
+
+
+def get_participant_folder_name(chunk_path: str) -> str:
+    """ The name of the cache folder of a file, from the study and patient ids in its path. """
+    path_parts = chunk_path.split("/")
+    if path_parts[0] == CHUNKS_FOLDER:
+        path_parts = path_parts[1:]
+    return "_".join(path_parts[:2])
+
+
+def link_or_copy(source: str, destination: str):
+    """ Hard links source to destination, or copies it if hard links aren't possible (e.g. they
+    are on different file systems).  Raises FileExistsError if destination exists: it may be a hard
+    link to another cached file, it must never be written through. """
+    try:
+        os.link(source, destination)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+    
+    if os.path.lexists(destination):
+        raise FileExistsError(errno.EEXIST, "File exists", destination)
+    temp_path = f"{destination}.{os.getpid()}.{get_ident()}.tmp"
+    shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+chunk_cache = ChunkCache(CHUNK_CACHE_DIRECTORY, CHUNK_CACHE_MAX_BYTES)
@@ -0,0 +1,161 @@
+from typing import Any, Iterable, List, Optional, Tuple
+
+from config.settings import CONCURRENT_NETWORK_OPS, DATA_DOWNLOAD_PREFETCH_BYTES
+from constants.data_access_api_constants import (COLUMNAR_EXPORT_MAX_FILE_BYTES, COMPRESSION_NONE,
+    OUTPUT_FORMAT_PARQUET)
+from constants.data_stream_constants import (ACCELEROMETER, CHUNKABLE_FILES, DEVICEMOTION, GYRO,
+    MAGNETOMETER, ROLLUP_DATA_STREAMS)
+from libs.streaming_zip import determine_file_name, TimeWindow, ZipGenerator
+
+
+# pyarrow is an optional requirement, without it only csv downloads are available.
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv, ipc as pyarrow_ipc, parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = pyarrow_csv = pyarrow_ipc = pyarrow_parquet = None
+
+COLUMNAR_EXPORT_AVAILABLE = pyarrow is not None
+
+# the numeric columns of these data streams are sensor readings, float32 is more than precise enough
+FLOAT32_DATA_STREAMS = {ACCELEROMETER, DEVICEMOTION, GYRO, MAGNETOMETER}
+
+# the UTC time column of chunked data is a string version of the timestamp column, it is not
+# exported, a reader can derive it from the timestamp (unix time in milliseconds) when needed.
+UTC_TIME_COLUMN = "UTC time"
+
+# the order that chunks must be in for a columnar export
+COLUMNAR_EXPORT_ORDERING = ("participant_id", "data_type", "survey_id", "time_bin")
+
+
+def csv_to_table(file_contents: bytes, data_type: str) -> "pyarrow.Table":
+    """ Parses a chunked data csv into a typed table: the timestamp is an int64, the numeric columns
+    of FLOAT32_DATA_STREAMS are float32, the other columns have the types pyarrow infers, and the
+    UTC time column is dropped.  Raises ValueError (or pyarrow.ArrowInvalid, a subclass) if the csv
+    can't be parsed. """
+    header = file_contents[:file_contents.find(b"\n")].decode().split(",")
+    if header[0] != "timestamp":
+        raise ValueError("not chunked data")
+    
+    table = pyarrow_csv.read_csv(
+        pyarrow.py_buffer(file_contents),
+        convert_options=pyarrow_csv.ConvertOptions(
+            include_columns=[column for column in header if column != UTC_TIME_COLUMN],
+            column_types={"timestamp": pyarrow.int64()},
+        ),
+    )
+    fields = []
+    for field in table.schema:
+        if pyarrow.types.is_null(field.type):
+            # a column that is empty in this file, it could contain anything in the next one
+            field = field.with_type(pyarrow.string())
+        elif data_type in FLOAT32_DATA_STREAMS and field.name != "timestamp" and \
+                (pyarrow.types.is_floating(field.type) or pyarrow.types.is_integer(field.type)):
+            field = field.with_type(pyarrow.float32())
+        fields.append(field)
+    return table.cast(pyarrow.schema(fields))
+
+
+class ColumnarFileWriter:
+    """ Writes tables with the same schema to an in-memory parquet or arrow ipc file. """
+    
+    def __init__(self, output_format: str, schema: "pyarrow.Schema", file_name: str):
+        self.schema = schema
+        self.file_name = file_name
+        self.buffer = pyarrow.BufferOutputStream()
+        if output_format == OUTPUT_FORMAT_PARQUET:
+            self.writer = pyarrow_parquet.ParquetWriter(self.buffer, schema, compression="zstd")
+        else:
+            self.writer = pyarrow_ipc.new_file(
+                self.buffer, schema, options=pyarrow_ipc.IpcWriteOptions(compression="zstd")
+            )
+    
+    @property
+    def size(self) -> int:
+        return self.buffer.tell()
+    
+    def write(self, table: "pyarrow.Table"):
+        """ Raises pyarrow.ArrowInvalid if the table can't be converted to the schema. """
+        if table.schema.names != self.schema.names:
+            raise pyarrow.ArrowInvalid("different columns")
+        self.writer.write_table(table.cast(self.schema))
+    
+    def close(self) -> bytes:
+        self.writer.close()
+        return self.buffer.getvalue().to_pybytes()
+
+
+class ColumnarExportGenerator(ZipGenerator):
+    """ A ZipGenerator that converts chunked data (the hourly csv files of each participant's data
+    streams) into parquet or arrow ipc files, one per participant and data stream (and survey, for
+    survey timings), instead of one per hour.  Files that are not chunked data, or that can't be
+    parsed, are included as they are.
+    
+    The files_list must be in COLUMNAR_EXPORT_ORDERING.  Csv files are parsed on the thread pool,
+    tables are written to the current file on the iterating thread.  A file is completed, and a new
+    one started, when the participant or data stream changes, when a table has a schema that can't
+    be converted to that of the current file (e.g. a changed header), or when the file reaches
+    max_file_bytes; files are named after the time bin of their first chunk. """
+    
+    def __init__(
+        self, files_list: Iterable[dict], output_format: str,
+        threads: int = CONCURRENT_NETWORK_OPS, prefetch_bytes: int = DATA_DOWNLOAD_PREFETCH_BYTES,
+        compression: str = COMPRESSION_NONE, time_window: TimeWindow = None,
+        max_file_bytes: int = COLUMNAR_EXPORT_MAX_FILE_BYTES,
+    ):
+        super().__init__(
+            files_list, construct_registry=False, threads=threads, prefetch_bytes=prefetch_bytes,
+            compression=compression, time_window=time_window,
+        )
+        self.output_format = output_format
+        self.max_file_bytes = max_file_bytes
+        self.file_extension = "parquet" if output_format == OUTPUT_FORMAT_PARQUET else "arrow"
+        self.current_writer: Optional[ColumnarFileWriter] = None
+        self.current_group: Optional[Tuple] = None
+    
+    def prepare_file(self, chunk: dict, file_contents: bytes) -> Any:
+        """ Runs on the thread pool, returns a table or a prepared archive entry. """
+        data_type = chunk["data_type"]
+        if data_type in CHUNKABLE_FILES or data_type in ROLLUP_DATA_STREAMS.values():
+            if self.time_window is not None:
+                file_contents = self.time_window.trim(chunk, file_contents)
+            try:
+                return csv_to_table(file_contents, data_type)
+            except ValueError:
+                pass
+        return super().prepare_file(chunk, file_contents)
+    
+    def get_entries(self, chunk: dict, prepared_entry: Any) -> Iterable[Any]:
+        if not isinstance(prepared_entry, pyarrow.Table):
+            return super().get_entries(chunk, prepared_entry)
+        
+        table = prepared_entry
+        if table.num_rows == 0:
+            return ()  # (an empty table's inferred types would all be strings)
+        
+        entries = []
+        group = (chunk["participant_id"], chunk["data_type"], chunk["survey_id"])
+        if self.current_writer is not None and group == self.current_group:
+            try:
+                self.current_writer.write(table)
+            except pyarrow.ArrowInvalid:
+                entries.extend(self.get_final_entries())
+        else:
+            entries.extend(self.get_final_entries())
+        
+        if self.current_writer is None:
+            file_name = determine_file_name(chunk).rsplit(".", 1)[0] + "." + self.file_extension
+            self.current_writer = ColumnarFileWriter(self.output_format, table.schema, file_name)
+            self.current_group = group
+            self.current_writer.write(table)
+        
+        if self.current_writer.size >= self.max_file_bytes:
+            entries.extend(self.get_final_entries())
+        return entries
+    
+    def get_final_entries(self) -> List[Any]:
+        """ Completes the current file. """
+        if self.current_writer is None:
+            return []
+        writer, self.current_writer = self.current_writer, None
+        return [self.archive.prepare(writer.file_name, writer.close())]
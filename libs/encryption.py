@@ -1,7 +1,9 @@
 import json
-from typing import List
+from binascii import a2b_base64, Error as Base64Error
+from typing import List, Optional, Tuple
 
 from Cryptodome.Cipher import AES
+from Cryptodome.PublicKey import RSA
 from django.forms import ValidationError
 
 from config.settings import STORE_DECRYPTION_LINE_ERRORS
@@ -36,9 +38,69 @@ def log(*args, **kwargs):
         print(*args, **kwargs)
 
 
+# urlsafe_b64decode is a translation to the standard base64 alphabet followed by a2b_base64
+URLSAFE_TO_STANDARD_BASE64 = bytes.maketrans(b"-_", b"+/")
+
+
+def decode_batchable_line(line: bytes) -> Optional[Tuple[bytes, bytes]]:
+    """ The parsing half of DeviceDataDecryptor.decrypt_device_line for lines that can be decrypted
+    by decrypt_batch: returns the iv and the block-aligned data of a well formed line, and None for
+    any line that would cause an error (or any other special case) in decrypt_device_line. """
+    iv, separator, data = line.translate(URLSAFE_TO_STANDARD_BASE64).partition(b":")
+    if not separator or b":" in data:
+        return None
+    try:
+        iv = a2b_base64(iv)
+        data = a2b_base64(data)
+    except Base64Error:
+        return None  # may still be decodable, decode_base64 retries with extra padding.
+    if len(iv) != 16 or len(data) < 16:
+        return None
+    
+    # CBC data encryption requires alignment to a 16 bytes, we lose any data that overflows that length.
+    overflow_bytes = len(data) % 16
+    if overflow_bytes:
+        data = data[:-overflow_bytes]
+    return iv, data
+
+
+def decrypt_batch(
+    block_decipherer, segments: List[bytes], data_starts: List[int], data_ends: List[int]
+) -> List[memoryview]:
+    """ AES CBC decryption of many lines at once.  segments are the iv and data of every line,
+    data_starts and data_ends are the positions of each line's data within them.
+    
+    A CBC plaintext block is the ECB decryption of its ciphertext block XOR the preceding ciphertext
+    block (or the iv), so the iv and data of every line are ECB decrypted in one call, and then XORed
+    with the same bytes shifted by one block.  (The decrypted iv blocks are junk and are skipped.)
+    Returns the plaintext of every line as a view into a single buffer, with PKCS5 padding removed. """
+    ciphertext = b"".join(segments)
+    decrypted = block_decipherer.decrypt(ciphertext)
+    # XOR of the whole buffer in one operation, int.from_bytes and int.to_bytes are linear time.
+    plaintext = memoryview((
+        int.from_bytes(decrypted[16:], "little") ^ int.from_bytes(ciphertext[:-16], "little")
+    ).to_bytes(len(ciphertext) - 16, "little"))
+    del decrypted, ciphertext
+    
+    lines = []
+    for start, end in zip(data_starts, data_ends):
+        # plaintext is offset by one block from the ciphertext
+        start, end = start - 16, end - 16
+        # PKCS5 Padding: The last byte of the line contains the number of bytes at the end of the
+        # line that are padding.  Matches slicing [0: -num_padding_bytes] in decrypt_device_line.
+        num_padding_bytes = plaintext[end - 1]
+        if num_padding_bytes:
+            end = end - num_padding_bytes if num_padding_bytes < end - start else start
+        lines.append(plaintext[start:end])
+    return lines
+
+
 class DeviceDataDecryptor():
     
-    def __init__(self, file_name: str, original_data: bytes, participant: Participant) -> None:
+    def __init__(
+        self, file_name: str, original_data: bytes, participant: Participant,
+        private_key: RSA.RsaKey = None
+    ) -> None:
         # basic info
         self.file_name: str = file_name
         self.original_data: bytes = original_data
@@ -48,12 +110,12 @@ class DeviceDataDecryptor():
         # storage and error tracking
         self.bad_lines: List[bytes] = []
         self.error_types: List[str] = []
-        self.good_lines: List[bytes] = []
+        self.good_lines: List[bytes or memoryview] = []
         self.error_count: int = 0
         self.line_index = None  # line index is index to files_list variable of the current line
         
         # decryption key extraction
-        self.private_key_cipher = self.participant.get_private_key()
+        self.private_key_cipher = private_key or self.participant.get_private_key()
         self.file_lines = self.split_file()
         
         # error management includes external assets, attribute needs to be populated.
@@ -108,7 +170,21 @@ class DeviceDataDecryptor():
         return file_data
     
     def decrypt_device_file(self) -> bytes:
-        """ Runs the line-by-line decryption of a file encrypted by a device. """
+        """ Decrypts the lines of a file encrypted by a device.  Well-formed lines are decrypted
+        together by decrypt_batch, any other line goes through decrypt_device_line, which raises
+        the line's error for handle_line_error. """
+        try:
+            block_decipherer = AES.new(self.aes_decryption_key, mode=AES.MODE_ECB)
+        except Exception:
+            block_decipherer = None  # every line will raise its error in decrypt_device_line
+        
+        # the iv and data of every batched line, the position of each batched line's data within
+        # those segments, and good_lines holds the index of the batched line as a placeholder.
+        segments: List[bytes] = []
+        batch_data_starts: List[int] = []
+        batch_data_ends: List[int] = []
+        position = 0
+        
         # we need to skip the first line (the decryption key), but need real index values
         lines = enumerate(self.file_lines)
         next(lines)
@@ -120,10 +196,27 @@ class DeviceDataDecryptor():
                 self.append_line_encryption_error(LineEncryptionError.LINE_IS_NONE, line)
                 # print("encountered empty line of data, ignoring.")
                 continue
+            
+            iv_and_data = decode_batchable_line(line) if block_decipherer else None
+            if iv_and_data is not None:
+                segments.extend(iv_and_data)
+                position += len(iv_and_data[0])
+                self.good_lines.append(len(batch_data_starts))
+                batch_data_starts.append(position)
+                position += len(iv_and_data[1])
+                batch_data_ends.append(position)
+                continue
+            
             try:
                 self.good_lines.append(self.decrypt_device_line(line))
             except Exception as error_orig:
                 self.handle_line_error(line, error_orig)
+        
+        if segments:
+            batch = decrypt_batch(block_decipherer, segments, batch_data_starts, batch_data_ends)
+            self.good_lines = [
+                batch[line] if isinstance(line, int) else line for line in self.good_lines
+            ]
         self.create_metadata_error()
     
     def extract_aes_key(self) -> bytes:
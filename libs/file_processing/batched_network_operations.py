@@ -2,10 +2,10 @@ import sys
 import traceback
 from typing import Tuple
 
-from django.utils import timezone
-
 from constants.data_processing_constants import CHUNK_EXISTS_CASE
 from database.data_access_models import ChunkRegistry
+from libs.chunk_cache import chunk_cache
+from libs.file_processing.rollups import is_rollup_source, summarize_minutes
 from libs.file_processing.utility_functions_simple import decompress
 from libs.s3 import s3_upload
 from libs.security import chunk_hash
@@ -17,7 +17,8 @@ from libs.sentry import make_error_sentry, SentryTypes
 
 
 def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
-    """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter. """
+    """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter.
+    Does not touch the database, see CsvMerger.save_chunk_registries. """
     
     ret = {'exception': None, 'traceback': None}
     with make_error_sentry(sentry_type=SentryTypes.data_processing):
@@ -37,17 +38,33 @@ def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
             
             s3_upload(chunk_path, new_contents, study_object_id, raw_path=True)
             
-            # if the chunk object is a chunk registry then we are updating an old one,
-            # otherwise we are creating a new one.
+            # The new contents are written through to the chunk cache, so the next merge into this
+            # chunk and downloads of it don't have to download it.
+            # ChunkRegistry changes are returned rather than saved, they are saved in bulk by the
+            # CsvMerger once all of its uploads have completed.
             if chunk == CHUNK_EXISTS_CASE:
                 # If the contents are being appended to an existing ChunkRegistry object
-                ChunkRegistry.objects.filter(chunk_path=chunk_path).update(
-                    file_size=len(new_contents),
-                    chunk_hash=chunk_hash(new_contents).decode(),
-                    last_updated=timezone.now()
-                )
+                ret['chunk_path'] = chunk_path
+                ret['file_size'] = len(new_contents)
+                ret['chunk_hash'] = chunk_hash(new_contents).decode()
+                chunk_cache.put(ret, new_contents)
             else:
-                ChunkRegistry.register_chunked_data(**chunk, file_contents=new_contents)
+                new_chunk_registry = \
+                    ChunkRegistry.build_chunked_data(**chunk, file_contents=new_contents)
+                ret['new_chunk_registry'] = new_chunk_registry
+                chunk_cache.put(
+                    {
+                        "chunk_path": chunk_path,
+                        "chunk_hash": new_chunk_registry.chunk_hash,
+                        "file_size": new_chunk_registry.file_size,
+                    },
+                    new_contents,
+                )
+            
+            # the per-minute summaries of sensor data are computed here, while the contents are at
+            # hand, they are merged into rollup chunks after all uploads have completed.
+            if is_rollup_source(chunk_path):
+                ret['minute_rollups'] = (chunk_path, summarize_minutes(new_contents))
         
         # it broke. print stacktrace for debugging
         except Exception as e:
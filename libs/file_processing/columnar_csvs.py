@@ -0,0 +1,214 @@
+from collections import defaultdict
+from typing import DefaultDict, Iterable, List, Optional, Tuple
+
+from constants import common_constants
+from constants.common_constants import EARLIEST_POSSIBLE_DATA_TIMESTAMP
+from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
+
+
+# numpy is installed on data processing servers (forest depends on it), on frontend servers it is
+# only a dependency of the optional pyarrow.  Without numpy every file goes through the row-based
+# code path.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNAR_PROCESSING_AVAILABLE = numpy is not None
+
+# Java millisecond timestamps are 13 digits long until the year 2286, the columnar code path only
+# handles files where every row starts with exactly such a timestamp.  A timestamp plus its comma
+# is the first 14 bytes of every row, the UTC time column is inserted after that first column.
+TIMESTAMP_LENGTH = 13
+UTC_TIME_LENGTH = 23  # e.g. 2018-10-13T01:52:43.219
+if COLUMNAR_PROCESSING_AVAILABLE:
+    DIGIT_POWERS = 10 ** numpy.arange(TIMESTAMP_LENGTH - 1, -1, -1, dtype=numpy.int64)
+
+COMMA = ord(",")
+ZERO = ord("0")
+
+
+class ColumnarRows:
+    """ A columnar alternative to the list-of-lists-of-bytes rows used in data processing.  Holds
+    the unix millisecond timestamp of every row in an int64 array, and the unmodified csv line of
+    every row in a parallel object array.  Sorting, merging and deduplication all happen with
+    numpy operations instead of per-row Python code.
+    
+    This is only valid for fixed-schema data streams (e.g. accelerometer, gyro), where the csv
+    lines never need to be parsed beyond the timestamp. """
+    
+    __slots__ = ("timestamps", "lines")
+    
+    def __init__(self, timestamps: "numpy.ndarray", lines: "numpy.ndarray"):
+        self.timestamps = timestamps
+        self.lines = lines
+    
+    def __len__(self):
+        return len(self.timestamps)
+    
+    def __getitem__(self, key) -> "ColumnarRows":
+        # supports numpy-style indexing, e.g. boolean masks and index arrays
+        return ColumnarRows(self.timestamps[key], self.lines[key])
+    
+    @classmethod
+    def concatenate(cls, pieces: Iterable["ColumnarRows"]) -> "ColumnarRows":
+        pieces = list(pieces)
+        if len(pieces) == 1:
+            return pieces[0]
+        return cls(
+            numpy.concatenate([piece.timestamps for piece in pieces]),
+            numpy.concatenate([piece.lines for piece in pieces]),
+        )
+    
+    def sorted(self) -> "ColumnarRows":
+        # a stable sort is required to match list.sort(), identical timestamps keep their order.
+        return self[numpy.argsort(self.timestamps, kind="stable")]
+    
+    def with_utc_time_column(self) -> "ColumnarRows":
+        """ Columnar version of convert_unix_to_human_readable_timestamps, inserts the UTC time
+        string as the second column of every line. """
+        if len(self) == 0:
+            return self
+        
+        # the lines are joined into a single buffer, the new column is inserted with one masked
+        # assignment, and the buffer is split back into lines.
+        source = numpy.frombuffer(b"\n".join(self.lines.tolist()), dtype=numpy.uint8)
+        line_lengths = numpy.fromiter(map(len, self.lines), dtype=numpy.int64, count=len(self))
+        source_starts = numpy.zeros(len(self), dtype=numpy.int64)
+        numpy.cumsum(line_lengths[:-1] + 1, out=source_starts[1:])
+        
+        insert_length = UTC_TIME_LENGTH + 1
+        inserted_bytes = numpy.empty((len(self), insert_length), dtype=numpy.uint8)
+        inserted_bytes[:, 0] = COMMA
+        inserted_bytes[:, 1:] = utc_time_strings(self.timestamps)
+        
+        # every line grows by insert_length bytes, so the start of line i moves by i*insert_length
+        output_starts = source_starts + numpy.arange(len(self), dtype=numpy.int64) * insert_length
+        inserted_positions = (
+            output_starts[:, None] + TIMESTAMP_LENGTH + numpy.arange(insert_length)
+        ).ravel()
+        
+        output = numpy.empty(len(source) + inserted_positions.size, dtype=numpy.uint8)
+        is_inserted = numpy.zeros(len(output), dtype=bool)
+        is_inserted[inserted_positions] = True
+        output[is_inserted] = inserted_bytes.ravel()
+        output[~is_inserted] = source
+        
+        return ColumnarRows(self.timestamps, _object_array(output.tobytes().split(b"\n")))
+    
+    def to_csv(self, header: bytes) -> bytes:
+        """ Columnar version of ensure_sorted_by_timestamp followed by construct_csv_string. """
+        # dict.fromkeys is an order preserving deduplication that runs entirely in C.
+        lines = dict.fromkeys(self.sorted().lines.tolist())
+        return header + b"\n" + b"\n".join(lines)
+    
+    def to_row_lists(self) -> List[List[bytes]]:
+        """ Converts back to the row-based representation for the fallback code path. """
+        return [line.split(b",") for line in self.lines.tolist()]
+
+
+def utc_time_strings(timestamps: "numpy.ndarray") -> "numpy.ndarray":
+    """ Returns the UTC time strings (API_TIME_FORMAT plus milliseconds) of unix millisecond
+    timestamps as an (n, 23) array of ascii bytes.  numpy.datetime_as_string does the same thing
+    but is several times slower due to its unicode output. """
+    # built transposed so that each character position is a contiguous row
+    output = numpy.empty((UTC_TIME_LENGTH, len(timestamps)), dtype=numpy.uint8)
+    days = (timestamps // 86400000).astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    fields = (  # (start position, width, values)
+        (0, 4, months.astype("datetime64[Y]").astype(numpy.int64) + 1970),
+        (5, 2, months.astype(numpy.int64) % 12 + 1),
+        (8, 2, (days - months).astype(numpy.int64) + 1),
+        (11, 2, timestamps // 3600000 % 24),
+        (14, 2, timestamps // 60000 % 60),
+        (17, 2, timestamps // 1000 % 60),
+        (20, 3, timestamps % 1000),
+    )
+    for start, width, values in fields:
+        values = values.astype(numpy.int32)
+        for position in range(start + width - 1, start - 1, -1):
+            output[position] = values % 10 + ZERO
+            values //= 10
+    for position, character in ((4, "-"), (7, "-"), (10, "T"), (13, ":"), (16, ":"), (19, ".")):
+        output[position] = ord(character)
+    return output.T
+
+
+def _object_array(items: List[bytes]) -> "numpy.ndarray":
+    # numpy.array(items, dtype=object) will try to be clever about nested sequences, this won't.
+    array = numpy.empty(len(items), dtype=object)
+    array[:] = items
+    return array
+
+
+def parse_columnar_csv(file_contents: bytes) -> Tuple[bytes, Optional[ColumnarRows]]:
+    """ Splits a csv into its header and a ColumnarRows of its data.  Returns None as the rows if
+    any line does not start with a 13 digit timestamp, the caller must use the row-based code path
+    for that file.  Empty lines and lines starting with a comma are dropped, matching the row-based
+    code path. """
+    header, _, body = file_contents.partition(b"\n")
+    lines = body.split(b"\n")
+    
+    # the S14 dtype truncates every line to its first 14 bytes, and null-pads short lines.
+    prefixes = numpy.array(lines, dtype=f"S{TIMESTAMP_LENGTH + 1}") \
+        .view(numpy.uint8).reshape(len(lines), TIMESTAMP_LENGTH + 1)
+    
+    first_bytes = prefixes[:, 0]
+    keep = (first_bytes != 0) & (first_bytes != COMMA)
+    prefixes = prefixes[keep]
+    
+    digits = prefixes[:, :TIMESTAMP_LENGTH] - ZERO  # uint8 math, non-digits wrap to values > 9
+    separators = prefixes[:, TIMESTAMP_LENGTH]
+    if (digits > 9).any() or ((separators != COMMA) & (separators != 0)).any():
+        return header, None
+    
+    timestamps = digits.astype(numpy.int64) @ DIGIT_POWERS
+    lines = _object_array(lines)
+    if not keep.all():
+        lines = lines[keep]
+    return header, ColumnarRows(timestamps, lines)
+
+
+def binify_columnar_rows(
+    rows: ColumnarRows, study_id: str, user_id: str, data_type: str, header: bytes
+) -> DefaultDict[tuple, list]:
+    """ Columnar version of binify_csv_rows, output is identical except that each bin contains a
+    single ColumnarRows instead of many rows. """
+    seconds = rows.timestamps // 1000
+    # matches the BadTimecodeError cases in clean_java_timecode
+    valid = (seconds >= EARLIEST_POSSIBLE_DATA_TIMESTAMP) & \
+        (seconds <= common_constants.LATEST_POSSIBLE_DATA_TIMESTAMP)
+    if not valid.all():
+        rows, seconds = rows[valid], seconds[valid]
+    
+    ret = defaultdict(list)
+    time_bins = seconds // CHUNK_TIMESLICE_QUANTUM
+    for time_bin in numpy.unique(time_bins).tolist():
+        ret[(study_id, user_id, data_type, time_bin, header)].append(rows[time_bins == time_bin])
+    return ret
+
+
+def is_columnar_bin(rows: list) -> bool:
+    return bool(rows) and all(isinstance(row, ColumnarRows) for row in rows)
+
+
+def expand_columnar_rows(rows: list) -> list:
+    """ A bin can contain both ColumnarRows and regular rows if some files for a data stream fell
+    back to the row-based code path, in that case the whole bin uses the row-based code path. """
+    if not any(isinstance(row, ColumnarRows) for row in rows):
+        return rows
+    
+    expanded_rows = []
+    for row in rows:
+        if isinstance(row, ColumnarRows):
+            expanded_rows.extend(row.to_row_lists())
+        else:
+            expanded_rows.append(row)
+    return expanded_rows
+
+
+def add_utc_time_column_to_header(header: bytes) -> bytes:
+    """ The header half of convert_unix_to_human_readable_timestamps. """
+    header: List[bytes] = header.split(b",")
+    header.insert(1, b"UTC time")
+    return b",".join(header)
@@ -1,22 +1,32 @@
-from typing import Dict, List, Set, Tuple
+from collections import Counter
+from multiprocessing.pool import AsyncResult, ThreadPool
+from threading import BoundedSemaphore
+from typing import Callable, Dict, List, Set, Tuple, Union
 
 from botocore.exceptions import ReadTimeoutError
 from cronutils import ErrorHandler
+from django.db import transaction
+from django.utils import timezone
 
+from config.settings import CONCURRENT_NETWORK_OPS
 from constants.common_constants import RUNNING_TEST_OR_IN_A_SHELL
 from constants.data_processing_constants import (CHUNK_EXISTS_CASE, CHUNK_TIMESLICE_QUANTUM,
     CHUNKS_FOLDER, REFERENCE_CHUNKREGISTRY_HEADERS)
 from constants.data_stream_constants import SURVEY_DATA_FILES
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, ChunkTimeBinExtent
 from database.survey_models import Survey
 from database.system_models import GenericEvent
 from database.user_models_participant import Participant
-from libs.file_processing.exceptions import ChunkFailedToExist
+from libs.chunk_cache import chunk_cache
+from libs.file_processing.batched_network_operations import batch_upload
+from libs.file_processing.columnar_csvs import (add_utc_time_column_to_header, ColumnarRows,
+    expand_columnar_rows, is_columnar_bin, parse_columnar_csv)
+from libs.file_processing.data_qty_stats import apply_data_quantity_deltas
+from libs.file_processing.exceptions import ChunkFailedToExist, ChunkNotSortedError
 from libs.file_processing.utility_functions_csvs import (construct_csv_string, csv_to_list,
     unix_time_to_string)
 from libs.file_processing.utility_functions_simple import (compress,
-    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp)
-from libs.s3 import s3_retrieve
+    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp, merge_sorted_rows)
 
 
 class CsvMerger:
@@ -24,7 +34,8 @@ class CsvMerger:
     
     def __init__(
         self, binified_data: Dict, error_handler: ErrorHandler, survey_id_dict: Dict,
-        participant: Participant
+        participant: Participant, upload_pool: ThreadPool = None,
+        upload_function: Callable = batch_upload
     ):
         self.participant = participant
         
@@ -34,28 +45,116 @@ class CsvMerger:
         self.upload_these: List[Tuple[ChunkRegistry, str, bytes, str]] = []
         # chunk, something?, file contents, study object id
         
-        # Track the earliest and latest time bins, to return them at the end of the function
-        self.earliest_time_bin: int = None
-        self.latest_time_bin: int = None
+        # If there is an upload pool then chunks are uploaded as soon as they are ready instead of
+        # being stored in upload_these. The semaphore bounds the number of (compressed) chunks that
+        # can be waiting in memory for a thread in the pool.
+        self.upload_pool = upload_pool
+        self.upload_function = upload_function
+        self.upload_results: List[AsyncResult] = []
+        self.upload_slots = BoundedSemaphore(CONCURRENT_NETWORK_OPS)
         
         self.binified_data = binified_data
         self.error_handler = error_handler
         self.survey_id_dict = survey_id_dict
         self.iterate()
     
-    def get_retirees(self) -> Tuple[Set[int], int, int, int]:
-        """ returns the ftp pks that have succeeded, the number of ftps that have failed, 
-        and the earliest and the latest time bins """
-        return self.ftps_to_retire.difference(self. failed_ftps), \
-            len(self.failed_ftps), self.earliest_time_bin, self.latest_time_bin
+    def get_retirees(self) -> Tuple[Set[int], int]:
+        """ returns the ftp pks that have succeeded and the number of ftps that have failed """
+        return self.ftps_to_retire.difference(self.failed_ftps), len(self.failed_ftps)
+    
+    def upload(self, upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
+        if self.upload_pool is None:
+            self.upload_these.append(upload)
+            return
+        
+        self.upload_slots.acquire()
+        release_slot = lambda _: self.upload_slots.release()
+        self.upload_results.append(
+            self.upload_pool.apply_async(
+                self.upload_function, (upload,), callback=release_slot, error_callback=release_slot
+            )
+        )
     
     def iterate(self):
         # this function is the core loop. we iterate over all binified data and merge data into new
         # chunks, then handle ChunkRegistry parameter setup for the next stage of processing.
+        self.existing_chunks = self.get_existing_chunks()
+        
+        # A page can contain more than one bin for a chunk, if a header changed.  The contents of
+        # those chunks are held until all of their bins are merged and then uploaded once, two
+        # concurrent uploads of the same chunk would race.
+        chunk_path_counts = Counter(
+            construct_s3_chunk_path(study_object_id, patient_id, data_stream, time_bin)
+            for study_object_id, patient_id, data_stream, time_bin, _ in self.binified_data
+        )
+        self.repeated_chunk_paths = {path for path, count in chunk_path_counts.items() if count > 1}
+        self.held_chunks: Dict[str, Tuple[Union[dict, str], bytes, str]] = {}
+        
         ftp_list: List[int]
         for data_bin, (data_rows_list, ftp_list) in self.binified_data.items():
             with self.error_handler:
                 self.inner_iterate(data_bin, data_rows_list, ftp_list)
+        
+        for chunk_path, (chunk_params, contents, study_object_id) in self.held_chunks.items():
+            self.upload((chunk_params, chunk_path, compress(contents), study_object_id))
+    
+    def get_existing_chunks(self) -> Dict[str, dict]:
+        """ Returns the pk, chunk_path, chunk_hash, file_size, data_type and time_bin of every chunk
+        in the binified data that already exists, keyed by chunk path.  One query for the whole page
+        instead of one query per bin. """
+        chunk_paths = {
+            construct_s3_chunk_path(study_object_id, patient_id, data_stream, time_bin)
+            for study_object_id, patient_id, data_stream, time_bin, _ in self.binified_data
+        }
+        chunks = ChunkRegistry.objects.filter(chunk_path__in=chunk_paths) \
+            .values("pk", "chunk_path", "chunk_hash", "file_size", "data_type", "time_bin")
+        return {chunk["chunk_path"]: chunk for chunk in chunks}
+    
+    def save_chunk_registries(self, upload_returns: List[dict]):
+        """ Creates and updates the ChunkRegistries of successful uploads, in bulk, and applies the
+        changes in their sizes to the participant's data quantity stats, and the time bins of new
+        chunks to their ChunkTimeBinExtents, in the same transaction. """
+        new_chunk_registries: Dict[str, ChunkRegistry] = {}
+        updated_chunk_registries: List[ChunkRegistry] = []
+        updated_file_sizes: Dict[str, int] = {}
+        now = timezone.now()
+        for upload_return in upload_returns:
+            if "new_chunk_registry" in upload_return:
+                chunk_registry: ChunkRegistry = upload_return["new_chunk_registry"]
+                new_chunk_registries[chunk_registry.chunk_path] = chunk_registry
+            else:
+                updated_chunk_registries.append(ChunkRegistry(
+                    pk=self.existing_chunks[upload_return["chunk_path"]]["pk"],
+                    file_size=upload_return["file_size"],
+                    chunk_hash=upload_return["chunk_hash"],
+                    last_updated=now,  # bulk_update does not apply auto_now
+                ))
+                updated_file_sizes[upload_return["chunk_path"]] = upload_return["file_size"]
+        
+        # (time bin, data type, change in bytes) of every chunk
+        chunk_deltas = [
+            (chunk.time_bin, chunk.data_type, chunk.file_size)
+            for chunk in new_chunk_registries.values()
+        ]
+        for chunk_path, file_size in updated_file_sizes.items():
+            existing_chunk = self.existing_chunks[chunk_path]
+            chunk_deltas.append((
+                existing_chunk["time_bin"], existing_chunk["data_type"],
+                file_size - (existing_chunk["file_size"] or 0),
+            ))
+        
+        with transaction.atomic():
+            if new_chunk_registries:
+                ChunkRegistry.objects.bulk_create(new_chunk_registries.values())
+            if updated_chunk_registries:
+                ChunkRegistry.objects.bulk_update(
+                    updated_chunk_registries, ["file_size", "chunk_hash", "last_updated"]
+                )
+            apply_data_quantity_deltas(self.participant, chunk_deltas)
+            ChunkTimeBinExtent.widen(
+                self.participant,
+                [(chunk.data_type, chunk.time_bin) for chunk in new_chunk_registries.values()],
+            )
     
     def inner_iterate(self, data_bin, data_rows_list, ftp_list: List[int]):
         study_object_id: str
@@ -66,18 +165,25 @@ class CsvMerger:
         
         try:
             study_object_id, patient_id, data_stream, time_bin, original_header = data_bin
-            # Update earliest and latest time bins
-            if self.earliest_time_bin is None or time_bin < self.earliest_time_bin:
-                self.earliest_time_bin = time_bin
-            if self.latest_time_bin is None or time_bin > self.latest_time_bin:
-                self.latest_time_bin = time_bin
             
-            # data_rows_list may be a generator; here it is evaluated
-            updated_header = convert_unix_to_human_readable_timestamps(original_header, data_rows_list)
+            if is_columnar_bin(data_rows_list):
+                # fixed-schema data streams, all rows are merged into a single ColumnarRows
+                updated_header = add_utc_time_column_to_header(original_header)
+                data_rows_list = ColumnarRows.concatenate(data_rows_list).with_utc_time_column()
+            else:
+                # data_rows_list may be a generator; here it is evaluated
+                data_rows_list = expand_columnar_rows(data_rows_list)
+                updated_header = convert_unix_to_human_readable_timestamps(original_header, data_rows_list)
             chunk_path = construct_s3_chunk_path(study_object_id, patient_id, data_stream, time_bin)
             
-            # two core cases
-            if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
+            # two core cases, and a chunk that an earlier bin of this page is merged into
+            if chunk_path in self.held_chunks:
+                chunk_params, held_contents, _ = self.held_chunks[chunk_path]
+                self.merge_with_chunk(
+                    chunk_params, chunk_path, study_object_id, updated_header, data_rows_list,
+                    data_stream, held_contents
+                )
+            elif chunk_path in self.existing_chunks:
                 self.chunk_exists_case(
                     chunk_path, study_object_id, updated_header, data_rows_list, data_stream
                 )
@@ -112,11 +218,14 @@ class CsvMerger:
     
     def chunk_not_exists_case(
         self, chunk_path: str, study_object_id: str, updated_header: str, patient_id: str,
-        data_stream: str, original_header: bytes, time_bin: int, rows: List[bytes]
+        data_stream: str, original_header: bytes, time_bin: int, rows: List[bytes] or ColumnarRows
     ):
-        ensure_sorted_by_timestamp(rows)
         final_header = self.validate_one_header(updated_header, data_stream)
-        new_contents = construct_csv_string(final_header, rows)
+        if isinstance(rows, ColumnarRows):
+            new_contents = rows.to_csv(final_header)
+        else:
+            ensure_sorted_by_timestamp(rows)
+            new_contents = construct_csv_string(final_header, rows)
         if data_stream in SURVEY_DATA_FILES:
             # We need to keep a mapping of files to survey ids, that is handled here.
             survey_id_hash = study_object_id, patient_id, data_stream, original_header
@@ -136,16 +245,15 @@ class CsvMerger:
             "survey_id": survey_id
         }
         
-        self.upload_these.append(
-            (chunk_params, chunk_path, compress(new_contents), study_object_id)
-        )
+        self.upload_chunk(chunk_params, chunk_path, new_contents, study_object_id)
     
     def chunk_exists_case(
-        self, chunk_path: str, study_object_id: str, updated_header: str, rows: List[bytes],
-        data_stream: str
+        self, chunk_path: str, study_object_id: str, updated_header: str,
+        rows: List[bytes] or ColumnarRows, data_stream: str
     ):
         try:
-            s3_file_data = s3_retrieve(chunk_path, study_object_id, raw_path=True)
+            # the chunk is usually in the chunk cache, it was written through when it was uploaded.
+            s3_file_data = chunk_cache.retrieve(self.existing_chunks[chunk_path], study_object_id)
         except ReadTimeoutError as e:
             # The following check was correct for boto 2, still need to hit with boto3 test.
             if "The specified key does not exist." == str(e):
@@ -155,23 +263,60 @@ class CsvMerger:
                 # no python stacktrace.  Best guess is mongo blew up.
                 # If this happened, delete the ChunkRegistry and push this file upload to the next cycle
                 ChunkRegistry.objects.filter(chunk_path=chunk_path).delete()
+                ChunkTimeBinExtent.recalculate(self.participant)
                 raise ChunkFailedToExist(
                     "chunk %s does not actually point to a file, deleting DB entry, should run correctly on next index."
                     % chunk_path
                 )
             raise  # Raise original error
         
+        self.merge_with_chunk(
+            CHUNK_EXISTS_CASE, chunk_path, study_object_id, updated_header, rows, data_stream,
+            s3_file_data
+        )
+    
+    def merge_with_chunk(
+        self, chunk_params: Union[dict, str], chunk_path: str, study_object_id: str,
+        updated_header: str, rows: List[bytes] or ColumnarRows, data_stream: str,
+        s3_file_data: bytes
+    ):
+        """ Merges rows into the contents of a chunk, and uploads it with chunk_params. """
+        if isinstance(rows, ColumnarRows):
+            old_header, old_columnar_rows = parse_columnar_csv(s3_file_data)
+            if old_columnar_rows is not None:
+                final_header = self.validate_two_headers(old_header, updated_header, data_stream)
+                # old rows go first, identical timestamps keep their order when sorted.
+                new_contents = ColumnarRows.concatenate((old_columnar_rows, rows)).to_csv(final_header)
+                self.upload_chunk(chunk_params, chunk_path, new_contents, study_object_id)
+                return
+            # the existing chunk has irregular rows, fall back to the row-based code path
+            rows = rows.to_row_lists()
+        
         old_header, old_rows = csv_to_list(s3_file_data)
         final_header = self.validate_two_headers(old_header, updated_header, data_stream)
+        ensure_sorted_by_timestamp(rows)
         
-        old_rows = list(old_rows)
-        old_rows.extend(rows)
-        ensure_sorted_by_timestamp(old_rows)
-        new_contents = construct_csv_string(final_header, old_rows)
+        # Existing chunks are sorted, so we stream a merge of the old and new rows rather than
+        # materializing and sorting all of them.
+        try:
+            new_contents = final_header + b"\n" + b"\n".join(merge_sorted_rows(old_rows, rows))
+        except ChunkNotSortedError:
+            # very old chunks may not be sorted, these take the slow path.
+            old_rows = list(csv_to_list(s3_file_data)[1])
+            old_rows.extend(rows)
+            ensure_sorted_by_timestamp(old_rows)
+            new_contents = construct_csv_string(final_header, old_rows)
         
-        self.upload_these.append(
-            (CHUNK_EXISTS_CASE, chunk_path, compress(new_contents), study_object_id, )
-        )
+        self.upload_chunk(chunk_params, chunk_path, new_contents, study_object_id)
+    
+    def upload_chunk(
+        self, chunk_params: Union[dict, str], chunk_path: str, contents: bytes,
+        study_object_id: str
+    ):
+        if chunk_path in self.repeated_chunk_paths:
+            self.held_chunks[chunk_path] = (chunk_params, contents, study_object_id)
+        else:
+            self.upload((chunk_params, chunk_path, compress(contents), study_object_id))
     
     def validate_one_header(self, header: bytes, data_stream: str) -> bytes:
         real_header: bytes = REFERENCE_CHUNKREGISTRY_HEADERS[data_stream][self.participant.os_type]
@@ -1,39 +1,23 @@
 from collections import defaultdict
-from datetime import datetime, tzinfo
-from typing import Callable, Optional
+from datetime import date, datetime, tzinfo
+from typing import Dict, Iterable, List, Set, Tuple
 
-from dateutil.tz import gettz, UTC
+from django.db import transaction
 from django.db.models.query import QuerySet
-from django.utils.timezone import make_aware
+from django.utils import timezone
 
-from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
 from constants.data_stream_constants import ALL_DATA_STREAMS
-from database.data_access_models import ChunkRegistry
+from database.dashboard_models import DashboardDataQuantity
+from database.data_access_models import ChunkRegistry, ChunkTimeBinExtent
 from database.tableau_api_models import SummaryStatisticDaily
 from database.user_models_participant import Participant
-from libs.utils.date_utils import date_to_end_of_day, date_to_start_of_day, get_timezone_shortcode
+from libs.utils.date_utils import get_timezone_shortcode
 
 
-# not importable
-utcfromtimestamp: Callable = datetime.utcfromtimestamp
-
-
-def timeslice_to_start_of_day(timeslice: int, tz: tzinfo):
-    """ We use an integer to represent time, it must be multiplied by CHUNK_TIMESLICE_QUANTUM to
-    yield a unix timestamp."""
-    # get the date _in the local time_, then get the start of that day as a datetime
-    day = make_aware(utcfromtimestamp(timeslice * CHUNK_TIMESLICE_QUANTUM), UTC) \
-        .astimezone(tz).date()
-    return date_to_start_of_day(day, tz)
-
-
-def timeslice_to_end_of_day(timeslice: int, tz: tzinfo):
-    """ We use an integer to represent time, it must be multiplied by CHUNK_TIMESLICE_QUANTUM to
-    yield a unix timestamp."""
-    # get the date _in the local time_, then get the end of that day as a datetime
-    day = make_aware(utcfromtimestamp(timeslice * CHUNK_TIMESLICE_QUANTUM), UTC) \
-        .astimezone(tz).date()
-    return date_to_end_of_day(day, tz)
+# the SummaryStatisticDaily field of each data stream
+DATA_QUANTITY_FIELDS = {
+    data_stream: f"beiwe_{data_stream}_bytes" for data_stream in ALL_DATA_STREAMS
+}
 
 
 def populate_data_quantity(
@@ -53,39 +37,189 @@ def populate_data_quantity(
     return daily_data_quantities
 
 
-def calculate_data_quantity_stats(
-        participant: Participant,
-        earliest_time_bin_number: Optional[int] = None,
-        latest_time_bin_number: Optional[int] = None,
+def apply_data_quantity_deltas(
+    participant: Participant, chunk_deltas: Iterable[Tuple[datetime, str, int]]
 ):
-    """ Update the SummaryStatisticDaily  stats for a participant, using ChunkRegistry data
-    earliest_time_bin_number -- expressed in hours since 1/1/1970
-    latest_time_bin_number -- expressed in hours since 1/1/1970 """
+    """ Updates the SummaryStatisticDaily data quantities of a participant incrementally, instead of
+    rereading their ChunkRegistries: chunk_deltas are the time bin, data type and change in size (in
+    bytes) of the chunks that were just created or updated, they are added to the days of those
+    chunks.  Takes one query to find the existing days, a bulk update, and a bulk create.
     
-    # (related model, study, is cached)
+    The DashboardDataQuantity heatmap cells of those days are updated in the same way.  Must be
+    called inside of the transaction that saves the chunks, the rows are locked so that
+    reconcile_data_quantity_stats can't run in between. """
     study_timezone: tzinfo = participant.study.timezone
-    query = ChunkRegistry.objects.filter(participant=participant)
+    daily_deltas: Dict[date, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for time_bin, data_type, delta in chunk_deltas:
+        if data_type in DATA_QUANTITY_FIELDS and delta:
+            day = time_bin.astimezone(study_timezone).date()
+            daily_deltas[day][DATA_QUANTITY_FIELDS[data_type]] += delta
+    if not daily_deltas:
+        return
+    
+    existing_days = {
+        stats.date: stats for stats in SummaryStatisticDaily.objects.select_for_update()
+        .filter(participant=participant, date__in=daily_deltas)
+        .only("pk", "date", *DATA_QUANTITY_FIELDS.values())
+    }
+    new_stats: List[SummaryStatisticDaily] = []
+    updated_fields = {"last_updated"}
+    now = timezone.now()
+    for day, deltas in daily_deltas.items():
+        stats = existing_days.get(day)
+        if stats is None:
+            stats = SummaryStatisticDaily(
+                participant=participant, date=day,
+                timezone=get_timezone_shortcode(day, study_timezone),
+            )
+            new_stats.append(stats)
+        else:
+            stats.last_updated = now  # bulk_update does not apply auto_now
+            updated_fields.update(deltas)
+        for field_name, delta in deltas.items():
+            # (a value that has drifted can't go below zero, reconciliation corrects it)
+            setattr(stats, field_name, max(0, (getattr(stats, field_name) or 0) + delta))
+    
+    if new_stats:
+        SummaryStatisticDaily.objects.bulk_create(new_stats)
+    if existing_days:
+        SummaryStatisticDaily.objects.bulk_update(existing_days.values(), updated_fields)
+    
+    apply_dashboard_deltas(participant, daily_deltas)
 
-    # Filter by date range
-    if earliest_time_bin_number is not None:
-        query = query.filter(
-            time_bin__gte=timeslice_to_start_of_day(earliest_time_bin_number, study_timezone)
-        )
-    if latest_time_bin_number is not None:
-        query = query.filter(  # lte vs lt is irrelevant
-            time_bin__lt=timeslice_to_end_of_day(latest_time_bin_number, study_timezone)
-        )
+
+def apply_dashboard_deltas(participant: Participant, daily_deltas: Dict[date, Dict[str, int]]):
+    """ Adds the daily deltas of apply_data_quantity_deltas (keyed by SummaryStatisticDaily field
+    name) to the participant's DashboardDataQuantity cells. """
+    data_types = {field_name: data_type for data_type, field_name in DATA_QUANTITY_FIELDS.items()}
+    existing_cells = {
+        (cell.date, cell.data_type): cell for cell in DashboardDataQuantity.objects
+        .select_for_update().filter(participant=participant, date__in=daily_deltas)
+        .only("pk", "date", "data_type", "bytes")
+    }
+    new_cells: List[DashboardDataQuantity] = []
+    updated_cells: List[DashboardDataQuantity] = []
+    for day, deltas in daily_deltas.items():
+        for field_name, delta in deltas.items():
+            data_type = data_types[field_name]
+            cell = existing_cells.get((day, data_type))
+            if cell is None:
+                cell = DashboardDataQuantity(
+                    study_id=participant.study_id, participant=participant, data_type=data_type,
+                    date=day, bytes=0,
+                )
+                new_cells.append(cell)
+            else:
+                updated_cells.append(cell)
+            cell.bytes = max(0, cell.bytes + delta)
     
-    # For each date, create a DataQuantity object
-    for day, day_data in populate_data_quantity(query, study_timezone).items():
-        data_quantity = {
-            "participant": participant,
-            "date": day,
-            "defaults": {
-                "timezone": get_timezone_shortcode(day, participant.study.timezone)
-            }
+    if new_cells:
+        DashboardDataQuantity.objects.bulk_create(new_cells)
+    if updated_cells:
+        DashboardDataQuantity.objects.bulk_update(updated_cells, ["bytes"])
+
+
+def reconcile_data_quantity_stats(participant: Participant) -> int:
+    """ Recalculates all of a participant's SummaryStatisticDaily data quantities from their
+    ChunkRegistries, the safety net for apply_data_quantity_deltas (e.g. for deleted chunks, or a
+    changed study timezone), and their DashboardDataQuantity heatmap cells.  Only days that are
+    wrong are written.  Returns the number of days that were corrected. """
+    study_timezone: tzinfo = participant.study.timezone
+    with transaction.atomic():
+        existing_days = {
+            stats.date: stats for stats in SummaryStatisticDaily.objects.select_for_update()
+            .filter(participant=participant).only("pk", "date", *DATA_QUANTITY_FIELDS.values())
         }
-        for data_type, total_bytes in day_data.items():
-            if data_type in ALL_DATA_STREAMS:
-                data_quantity["defaults"][f"beiwe_{data_type}_bytes"] = total_bytes
-        SummaryStatisticDaily.objects.update_or_create(**data_quantity)
+        chunks = ChunkRegistry.objects.filter(
+            participant=participant, data_type__in=DATA_QUANTITY_FIELDS
+        )
+        daily_data_quantities = populate_data_quantity(chunks, study_timezone)
+        
+        new_stats: List[SummaryStatisticDaily] = []
+        updated_stats: List[SummaryStatisticDaily] = []
+        now = timezone.now()
+        for day in existing_days.keys() | daily_data_quantities.keys():
+            day_data = daily_data_quantities.get(day, {})
+            correct_values = {
+                field_name: day_data.get(data_type)  # (None if there is no data)
+                for data_type, field_name in DATA_QUANTITY_FIELDS.items()
+            }
+            stats = existing_days.get(day)
+            if stats is None:
+                new_stats.append(SummaryStatisticDaily(
+                    participant=participant, date=day,
+                    timezone=get_timezone_shortcode(day, study_timezone), **correct_values
+                ))
+            elif any(getattr(stats, name) != value for name, value in correct_values.items()):
+                for field_name, value in correct_values.items():
+                    setattr(stats, field_name, value)
+                stats.last_updated = now  # bulk_update does not apply auto_now
+                updated_stats.append(stats)
+        
+        if new_stats:
+            SummaryStatisticDaily.objects.bulk_create(new_stats)
+        if updated_stats:
+            SummaryStatisticDaily.objects.bulk_update(
+                updated_stats, [*DATA_QUANTITY_FIELDS.values(), "last_updated"]
+            )
+        corrected_days = {stats.date for stats in new_stats}
+        corrected_days.update(stats.date for stats in updated_stats)
+        corrected_days.update(reconcile_dashboard_cells(participant, daily_data_quantities))
+    return len(corrected_days)
+
+
+def reconcile_dashboard_cells(
+    participant: Participant, daily_data_quantities: Dict[date, Dict[str, int]]
+) -> Set[date]:
+    """ Makes a participant's DashboardDataQuantity cells match the daily data quantities of their
+    ChunkRegistries, returns the days that were corrected. """
+    existing_cells = {
+        (cell.date, cell.data_type): cell for cell in DashboardDataQuantity.objects
+        .select_for_update().filter(participant=participant)
+        .only("pk", "date", "data_type", "bytes")
+    }
+    correct_cells = {
+        (day, data_type): total_bytes
+        for day, day_data in daily_data_quantities.items()
+        for data_type, total_bytes in day_data.items() if total_bytes
+    }
+    new_cells: List[DashboardDataQuantity] = []
+    updated_cells: List[DashboardDataQuantity] = []
+    for (day, data_type), total_bytes in correct_cells.items():
+        cell = existing_cells.get((day, data_type))
+        if cell is None:
+            new_cells.append(DashboardDataQuantity(
+                study_id=participant.study_id, participant=participant, data_type=data_type,
+                date=day, bytes=total_bytes,
+            ))
+        elif cell.bytes != total_bytes:
+            cell.bytes = total_bytes
+            updated_cells.append(cell)
+    # cells of days or data types that no longer have any chunks
+    stale_cells = [cell for key, cell in existing_cells.items() if key not in correct_cells]
+    
+    if new_cells:
+        DashboardDataQuantity.objects.bulk_create(new_cells)
+    if updated_cells:
+        DashboardDataQuantity.objects.bulk_update(updated_cells, ["bytes"])
+    if stale_cells:
+        DashboardDataQuantity.objects.filter(pk__in=[cell.pk for cell in stale_cells]).delete()
+    return {cell.date for cell in new_cells + updated_cells + stale_cells}
+
+
+def reconcile_all_data_quantity_stats(study_id: int = None):
+    """ Runs reconcile_data_quantity_stats, and recalculates the ChunkTimeBinExtents, of every
+    participant (of a study, if study_id is provided) that has data or data quantity stats.  This is
+    run weekly, and for a study when its timezone changes. """
+    filters = {} if study_id is None else {"participant__study_id": study_id}
+    participant_ids = set()
+    for model in (ChunkRegistry, SummaryStatisticDaily, DashboardDataQuantity, ChunkTimeBinExtent):
+        participant_ids.update(
+            model.objects.filter(**filters).values_list("participant_id", flat=True).distinct()
+        )
+    corrected_days = corrected_extents = 0
+    for participant in Participant.objects.filter(pk__in=participant_ids).select_related("study"):
+        corrected_days += reconcile_data_quantity_stats(participant)
+        corrected_extents += ChunkTimeBinExtent.recalculate(participant)
+    print(f"reconciled the data quantity stats of {len(participant_ids)} participants, "
+          f"{corrected_days} days and {corrected_extents} time bin extents were corrected.")
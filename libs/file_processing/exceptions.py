@@ -4,3 +4,4 @@ class EverythingWentFine(Exception): pass
 class ProcessingOverlapError(Exception): pass
 class BadTimecodeError(Exception): pass
 class BadFileNameError(Exception): pass
+class ChunkNotSortedError(Exception): pass
@@ -4,6 +4,7 @@ import traceback
 from constants.data_stream_constants import CHUNKABLE_FILES
 from database.data_access_models import FileToProcess
 from libs.file_processing.utility_functions_simple import s3_file_path_to_data_type
+from libs.participant_file_uploads import decrypt_deferred_upload
 from libs.s3 import s3_retrieve
 
 
@@ -21,6 +22,8 @@ class FileForProcessing():
         self.data_type: str = s3_file_path_to_data_type(file_to_process.s3_file_path)
         self.chunkable: bool = self.data_type in CHUNKABLE_FILES
         self.file_contents: bytes = None
+        # a deferred upload that turned out to have nothing to process, see decrypt_deferred_upload
+        self.undecryptable: bool = False
         
         # state tracking
         self.exception: Exception or None = None
@@ -37,6 +40,10 @@ class FileForProcessing():
         # Try to retrieve the file contents. If any errors are raised, store them to be raised by
         # the parent function
         try:
+            if self.file_to_process.deferred_decryption:
+                self.file_contents = decrypt_deferred_upload(self.file_to_process)
+                self.undecryptable = self.file_contents is None
+                return
             self.file_contents = s3_retrieve(
                 self.file_to_process.s3_file_path,
                 self.file_to_process.study.object_id,
@@ -2,154 +2,44 @@ import time
 from collections import defaultdict
 from datetime import timedelta
 from multiprocessing.pool import ThreadPool
-from typing import DefaultDict
+from typing import DefaultDict, Dict, List, Tuple
 
-from cronutils.error_handler import ErrorHandler, null_error_handler
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.utils import timezone
 
-from config.settings import CONCURRENT_NETWORK_OPS, FILE_PROCESS_PAGE_SIZE
 from constants import common_constants
+from constants.data_processing_constants import COLUMNAR_DATA_STREAMS
 from constants.data_stream_constants import (ACCELEROMETER, ANDROID_LOG_FILE, CALL_LOG, IDENTIFIERS,
-    SURVEY_DATA_FILES, SURVEY_TIMINGS, WIFI)
+    ROLLUP_DATA_STREAMS, SURVEY_DATA_FILES, SURVEY_TIMINGS, WIFI)
 from constants.user_constants import ANDROID_API
-from database.data_access_models import ChunkRegistry, FileToProcess
+from database.data_access_models import ChunkRegistry, ChunkTimeBinExtent, FileToProcess
 from database.user_models_participant import Participant
-from libs.file_processing.batched_network_operations import batch_upload
-from libs.file_processing.csv_merger import CsvMerger
+from libs.chunk_cache import chunk_cache
+from libs.file_processing.columnar_csvs import (binify_columnar_rows, ColumnarRows,
+    COLUMNAR_PROCESSING_AVAILABLE, parse_columnar_csv)
+from libs.file_processing.csv_merger import construct_s3_chunk_path, CsvMerger
 from libs.file_processing.data_fixes import (fix_app_log_file, fix_call_log_csv, fix_identifier_csv,
     fix_survey_timings, fix_wifi_csv)
-from libs.file_processing.data_qty_stats import calculate_data_quantity_stats
+from libs.file_processing.data_qty_stats import apply_data_quantity_deltas
 from libs.file_processing.exceptions import BadTimecodeError
 from libs.file_processing.file_for_processing import FileForProcessing
+from libs.file_processing.rollups import (HOURS_PER_ROLLUP_CHUNK, merge_rollup_rows,
+    parse_s3_chunk_path, RollupRows)
 from libs.file_processing.utility_functions_csvs import csv_to_list
 from libs.file_processing.utility_functions_simple import (binify_from_timecode,
     clean_java_timecode, resolve_survey_id_from_file_name)
-
-
-def easy_run(participant: Participant):
-    """ Just a handy way to just run data processing in the terminal, use with caution, does not
-    test for celery activity. """
-    print(f"processing files for {participant.patient_id}")
-    number_bad_files = 0
-    while True:
-        previous_number_bad_files = number_bad_files
-        starting_length = participant.files_to_process.exclude(deleted=True).count()
-        print("===")
-        print(f"{timezone.now()} processing {participant.patient_id}, {starting_length} files remaining")
-        number_bad_files += do_process_user_file_chunks(
-            page_size=FILE_PROCESS_PAGE_SIZE,
-            error_handler=null_error_handler,
-            position=number_bad_files,
-            participant=participant,
-        )
-        
-        print("previous_number_bad_files:", previous_number_bad_files)
-        print("number_bad_files:", number_bad_files)
-        print("===")
-        # If no files were processed, quit processing
-        if participant.files_to_process.exclude(deleted=True).count() == starting_length:
-            if previous_number_bad_files == number_bad_files:
-                # 2 Cases:
-                #   1) every file broke, blow up. (would cause infinite loop otherwise).
-                #   2) no new files.
-                break
-            else:
-                continue
+from libs.s3 import s3_upload
+from libs.security import chunk_hash
 
 
 """########################## Hourly Update Tasks ###########################"""
 
-# This is useful for testing and profiling behavior. Replaces the imported threadpool with this
-# dummy class and poof! Single-threaded so the "threaded" network operations have real stack traces!
-# class ThreadPool():
-#     def map(self, *args, **kwargs):
-#         # cut off any threadpool kwargs, which is conveniently easy because map does not use kwargs!
-#         return map(*args)
-#     def terminate(self): pass
-#     def close(self): pass
-#     def __init__(self, *args,**kwargs): pass
-
-
-def do_process_user_file_chunks(
-        page_size: int, error_handler: ErrorHandler, position: int, participant: Participant
-):
-    """Run through the files to process, pull their data, put it into s3 bins. Run the file through
-    the appropriate logic path based on file type.
-
-    If a file is empty put its ftp object to the empty_files_list, we can't delete objects
-    in-place while iterating over the db.
-
-    All files except for the audio recording files are in the form of CSVs, most of those files
-    can be separated by "time bin" (separated into one-hour chunks) and concatenated and sorted
-    trivially. A few files, call log, identifier file, and wifi log, require some triage
-    beforehand.  The debug log cannot be correctly sorted by time for all elements, because it
-    was not actually expected to be used by researchers, but is apparently quite useful.
-
-    Any errors are themselves concatenated using the passed in error handler.
-
-    In a single call to this function, page_size files will be processed,at the position specified.
-    This is expected to exclude files that have previously errored in file processing.
-    (some conflicts can be most easily resolved by just delaying a file until the next processing
-    period, and it solves )
-    """
-    
+def update_latest_possible_data_timestamp():
     # FIXME: this is a gross hack to force some time related safety, which is only ever used deep
     # inside of data processing.
     common_constants.LATEST_POSSIBLE_DATA_TIMESTAMP = \
         int(time.mktime((timezone.now() + timedelta(days=90)).timetuple()))
-    
-    # Declare a defaultdict of a tuple of 2 lists
-    all_binified_data = defaultdict(lambda: ([], []))
-    ftps_to_remove = set()
-    # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
-    # to download files as other files are being processed, making the code as a whole run faster.
-    # In principle we could make a global pool that is free-memory aware.
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    survey_id_dict = {}
-    
-    # A Django query with a slice (e.g. .all()[x:y]) makes a LIMIT query, so it
-    # only gets from the database those FTPs that are in the slice.
-    # print(participant.as_dict())
-    print("Number Files To Process:", participant.files_to_process.exclude(deleted=True).count())
-    print(f"will process {page_size} files.")
-    print("current count processing within this run:", position)
-    
-    # TODO: investigate, comment.  ordering by path results in files grouped by type and
-    # chronological order, which is perfect for download efficiency... right? would it break anthing?
-    files_to_process = participant.files_to_process \
-        .exclude(deleted=True)  #.order_by("s3_file_path", "created_on")
-    
-    # This pool pulls in data for each FileForProcessing on a background thread and instantiates it.
-    # Instantiating a FileForProcessing object queries S3 for the File's data. (network request))
-    files_for_processing = pool.map(
-        FileForProcessing, files_to_process[position: position + page_size], chunksize=1
-    )
-    
-    for file_for_processing in files_for_processing:
-        with error_handler:
-            process_one_file(
-                file_for_processing, survey_id_dict, all_binified_data, ftps_to_remove
-            )
-    pool.close()
-    pool.terminate()
-    
-    # there are several failure modes and success modes, information for what to do with different
-    # files percolates back to here.  Delete various database objects accordingly.
-    more_ftps_to_remove, number_bad_files, earliest_time_bin, latest_time_bin = upload_binified_data(
-        all_binified_data, error_handler, survey_id_dict, participant
-    )
-    ftps_to_remove.update(more_ftps_to_remove)
-    
-    # Update the data quantity stats, if it actually processed any files
-    if len(files_to_process) > 0:
-        calculate_data_quantity_stats(participant,
-                                      earliest_time_bin_number=earliest_time_bin,
-                                      latest_time_bin_number=latest_time_bin)
-    
-    # Actually delete the processed FTPs from the database
-    FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
-    return number_bad_files
 
 
 def process_one_file(
@@ -161,6 +51,11 @@ def process_one_file(
     if file_for_processing.exception:
         file_for_processing.raise_data_processing_error()
     
+    if file_for_processing.undecryptable:
+        # the FileToProcess has already been deleted, this is a no-op for the database.
+        ftps_to_remove.add(file_for_processing.file_to_process.id)
+        return
+    
     # there are two cases: chunkable data that can be stuck into "time bins" for each hour, and
     # files that do not need to be "binified" and pretty much just go into the ChunkRegistry unmodified.
     if file_for_processing.chunkable:
@@ -173,7 +68,18 @@ def process_chunkable_file(
     file_for_processing: FileForProcessing, survey_id_dict: dict, all_binified_data: DefaultDict,
     ftps_to_remove: set
 ):
-    newly_binified_data, survey_id_hash = process_csv_data(file_for_processing)
+    store_binified_csv_data(
+        file_for_processing, process_csv_data(file_for_processing), survey_id_dict,
+        all_binified_data, ftps_to_remove
+    )
+
+
+def store_binified_csv_data(
+    file_for_processing: FileForProcessing, csv_data: tuple, survey_id_dict: dict,
+    all_binified_data: DefaultDict, ftps_to_remove: set
+):
+    """ Adds the output of process_csv_data for a file to the binified data of its page. """
+    newly_binified_data, survey_id_hash = csv_data
     
     # survey answers store the survey id in the file name (truly ancient design decision).
     if file_for_processing.data_type in SURVEY_DATA_FILES:
@@ -197,18 +103,24 @@ def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_rem
     except BadTimecodeError:
         ftps_to_remove.add(file_for_processing.file_to_process.id)
         return
-
+    
     # Since we aren't binning the data by hour, just create a ChunkRegistry that
     # points to the already existing S3 file.
+    participant = file_for_processing.file_to_process.participant
     try:
-        ChunkRegistry.register_unchunked_data(
-            file_for_processing.data_type,
-            timestamp,
-            file_for_processing.file_to_process.s3_file_path,
-            file_for_processing.file_to_process.study.pk,
-            file_for_processing.file_to_process.participant.pk,
-            file_for_processing.file_contents,
-        )
+        with transaction.atomic():
+            chunk = ChunkRegistry.register_unchunked_data(
+                file_for_processing.data_type,
+                timestamp,
+                file_for_processing.file_to_process.s3_file_path,
+                file_for_processing.file_to_process.study.pk,
+                participant.pk,
+                file_for_processing.file_contents,
+            )
+            apply_data_quantity_deltas(
+                participant, [(chunk.time_bin, chunk.data_type, chunk.file_size)]
+            )
+            ChunkTimeBinExtent.widen(participant, [(chunk.data_type, chunk.time_bin)])
         ftps_to_remove.add(file_for_processing.file_to_process.id)
     except ValidationError as ve:
         if len(ve.messages) != 1:
@@ -219,47 +131,134 @@ def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_rem
         # we detect this specific case and update the registry with the new file size
         # (hopefully it doesn't actually change)
         if 'Chunk registry with this Chunk path already exists.' in ve.messages:
-            ChunkRegistry.update_registered_unchunked_data(
-                file_for_processing.data_type,
-                file_for_processing.file_to_process.s3_file_path,
-                file_for_processing.file_contents,
-            )
+            with transaction.atomic():
+                chunk, file_size_change = ChunkRegistry.update_registered_unchunked_data(
+                    file_for_processing.data_type,
+                    file_for_processing.file_to_process.s3_file_path,
+                    file_for_processing.file_contents,
+                )
+                apply_data_quantity_deltas(
+                    participant, [(chunk.time_bin, chunk.data_type, file_size_change)]
+                )
             ftps_to_remove.add(file_for_processing.file_to_process.id)
         else:
             # any other errors, add
             raise
 
 
-def upload_binified_data(binified_data, error_handler, survey_id_dict, participant):
-    """ Takes in binified csv data and handles uploading/downloading+updating
-        older data to/from S3 for each chunk.
-        Returns a set of concatenations that have succeeded and can be removed.
-        Returns the number of failed FTPS so that we don't retry them.
-        Returns the earliest and latest time bins handled
-        Raises any errors on the passed in ErrorHandler."""
-    # failed_ftps = set([])
-    # ftps_to_retire = set([])
-    # upload_these = []
-    
-    # # Track the earliest and latest time bins, to return them at the end of the function
-    # earliest_time_bin = None
-    # latest_time_bin = None
-    uploads = CsvMerger(binified_data, error_handler, survey_id_dict, participant)
-    
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    errors = pool.map(batch_upload, uploads.upload_these, chunksize=1)
-    for err_ret in errors:
+def wait_for_uploads(uploads: CsvMerger):
+    """ Blocks until every upload dispatched by the CsvMerger has completed, saves the ChunkRegistries
+    of the successful uploads and updates their rollups, then raises the first upload error
+    encountered.  Returns the output of CsvMerger.get_retirees. """
+    successful_uploads = []
+    first_error = None
+    for upload_result in uploads.upload_results:
+        try:
+            err_ret = upload_result.get()
+        except Exception as e:
+            first_error = first_error or e
+            continue
         if err_ret['exception']:
             print(err_ret['traceback'])
-            raise err_ret['exception']
+            first_error = first_error or err_ret['exception']
+        else:
+            successful_uploads.append(err_ret)
+    
+    uploads.save_chunk_registries(successful_uploads)
+    
+    # The rollup stage.  Rollups are derived data, a failure is reported but doesn't fail the files.
+    minute_rollups = dict(
+        upload['minute_rollups'] for upload in successful_uploads if 'minute_rollups' in upload
+    )
+    with uploads.error_handler:
+        update_rollups(uploads.participant, minute_rollups, uploads.upload_pool)
+    
+    if first_error:
+        raise first_error
     
-    pool.close()
-    pool.terminate()
     # The things in ftps to retire that are not in failed ftps.
     # len(failed_ftps) will become the number of files to skip in the next iteration.
     return uploads.get_retirees()
 
 
+def update_rollups(
+    participant: Participant, minute_rollups: Dict[str, RollupRows], pool: ThreadPool = None
+):
+    """ The rollup stage of data processing, runs after the uploads of a CsvMerger have completed.
+    minute_rollups maps the chunk paths of updated hourly chunks to their summarize_minutes rows,
+    these replace the rows of those hours in the participant's (daily) rollup chunks.  Rollup chunks
+    are downloaded (through the chunk cache), updated and uploaded on the pool, then their
+    ChunkRegistries are created or updated in bulk. """
+    # rollup chunk path: (data stream, time bin, {hour time bin: rollup rows})
+    rollup_chunks: Dict[str, Tuple[str, int, Dict[int, RollupRows]]] = {}
+    for chunk_path, rollup_rows in minute_rollups.items():
+        study_object_id, patient_id, data_stream, time_bin = parse_s3_chunk_path(chunk_path)
+        rollup_data_stream = ROLLUP_DATA_STREAMS[data_stream]
+        rollup_time_bin = time_bin - time_bin % HOURS_PER_ROLLUP_CHUNK
+        rollup_path = construct_s3_chunk_path(
+            study_object_id, patient_id, rollup_data_stream, rollup_time_bin
+        )
+        if rollup_path not in rollup_chunks:
+            rollup_chunks[rollup_path] = (rollup_data_stream, rollup_time_bin, {})
+        rollup_chunks[rollup_path][2][time_bin] = rollup_rows
+    
+    if not rollup_chunks:
+        return
+    
+    study_object_id = participant.study.object_id
+    existing_chunks = {
+        chunk["chunk_path"]: chunk for chunk in
+        ChunkRegistry.objects.filter(chunk_path__in=rollup_chunks)
+        .values("pk", "chunk_path", "chunk_hash", "file_size")
+    }
+    
+    def update_rollup_chunk(rollup_path: str) -> Tuple[str, bytes]:
+        existing_chunk = existing_chunks.get(rollup_path)
+        existing_contents = None if existing_chunk is None else \
+            chunk_cache.retrieve(existing_chunk, study_object_id)
+        new_contents = merge_rollup_rows(existing_contents, rollup_chunks[rollup_path][2])
+        s3_upload(rollup_path, new_contents, study_object_id, raw_path=True)
+        return rollup_path, new_contents
+    
+    new_chunk_registries: List[ChunkRegistry] = []
+    updated_chunk_registries: List[ChunkRegistry] = []
+    now = timezone.now()
+    updates = pool.imap(update_rollup_chunk, rollup_chunks) if pool else \
+        map(update_rollup_chunk, rollup_chunks)
+    for rollup_path, new_contents in updates:
+        if rollup_path in existing_chunks:
+            chunk_registry = ChunkRegistry(
+                pk=existing_chunks[rollup_path]["pk"],
+                chunk_path=rollup_path,
+                file_size=len(new_contents),
+                chunk_hash=chunk_hash(new_contents).decode(),
+                last_updated=now,  # bulk_update does not apply auto_now
+            )
+            updated_chunk_registries.append(chunk_registry)
+        else:
+            data_stream, time_bin, _ = rollup_chunks[rollup_path]
+            chunk_registry = ChunkRegistry.build_chunked_data(
+                data_stream, time_bin, rollup_path, new_contents, participant.study_id,
+                participant.pk,
+            )
+            new_chunk_registries.append(chunk_registry)
+        chunk_cache.put(
+            {
+                "chunk_path": rollup_path,
+                "chunk_hash": chunk_registry.chunk_hash,
+                "file_size": chunk_registry.file_size,
+            },
+            new_contents,
+        )
+    
+    if new_chunk_registries:
+        ChunkRegistry.objects.bulk_create(new_chunk_registries)
+    if updated_chunk_registries:
+        ChunkRegistry.objects.bulk_update(
+            updated_chunk_registries, ["file_size", "chunk_hash", "last_updated"]
+        )
+
+
 """############################## Standard CSVs #############################"""
 
 def binify_csv_rows(rows_list: list, study_id: str, user_id: str, data_type: str, header: bytes) -> DefaultDict[tuple, list]:
@@ -296,59 +295,90 @@ def process_csv_data(file_for_processing: FileForProcessing):
     """ Constructs a binified dict of a given list of a csv rows,
         catches csv files with known problems and runs the correct logic.
         Returns None If the csv has no data in it. """
+    file_contents = file_for_processing.file_contents
+    # Memory saving measure: after this the data is only referenced by binify_file_contents
+    file_for_processing.clear_file_content()
+    return binify_file_contents(file_contents, *get_csv_processing_parameters(file_for_processing))
+
+
+def get_csv_processing_parameters(file_for_processing: FileForProcessing) -> Tuple[str, str, str, str, str]:
+    """ Everything from the database that binify_file_contents needs, in order. """
+    return (
+        file_for_processing.data_type,
+        file_for_processing.file_to_process.os_type,
+        file_for_processing.file_to_process.s3_file_path,
+        file_for_processing.file_to_process.study.object_id,
+        file_for_processing.file_to_process.participant.patient_id,
+    )
+
+
+def binify_file_contents(
+    file_contents: bytes, data_type: str, os_type: str, s3_file_path: str, study_object_id: str,
+    patient_id: str
+):
+    """ The body of process_csv_data.  This function does not touch the database, so it can be run
+    in a separate process. """
     
-    if file_for_processing.file_to_process.os_type == ANDROID_API:
-        # Do fixes for Android
-        if file_for_processing.data_type == ANDROID_LOG_FILE:
-            file_for_processing.file_contents = fix_app_log_file(
-                file_for_processing.file_contents, file_for_processing.file_to_process.s3_file_path
+    if COLUMNAR_PROCESSING_AVAILABLE and data_type in COLUMNAR_DATA_STREAMS:
+        header, columnar_rows = parse_columnar_csv(file_contents)
+        # columnar_rows is None if the file has irregular rows, fall back to the row-based code path
+        if columnar_rows is not None:
+            return process_columnar_csv_data(
+                header, columnar_rows, data_type, study_object_id, patient_id
             )
+    
+    if os_type == ANDROID_API:
+        # Do fixes for Android
+        if data_type == ANDROID_LOG_FILE:
+            file_contents = fix_app_log_file(file_contents, s3_file_path)
         
-        header, csv_rows_list = csv_to_list(file_for_processing.file_contents)
-        if file_for_processing.data_type != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(file_contents)
+        if data_type != ACCELEROMETER:
             # If the data is not accelerometer data, convert the generator to a list.
             # For accelerometer data, the data is massive and so we don't want it all
             # in memory at once.
             csv_rows_list = list(csv_rows_list)
         
-        if file_for_processing.data_type == CALL_LOG:
+        if data_type == CALL_LOG:
             header = fix_call_log_csv(header, csv_rows_list)
-        if file_for_processing.data_type == WIFI:
-            header = fix_wifi_csv(header, csv_rows_list, file_for_processing.file_to_process.s3_file_path)
+        if data_type == WIFI:
+            header = fix_wifi_csv(header, csv_rows_list, s3_file_path)
     else:
         # Do fixes for iOS
-        header, csv_rows_list = csv_to_list(file_for_processing.file_contents)
+        header, csv_rows_list = csv_to_list(file_contents)
         
-        if file_for_processing.data_type != ACCELEROMETER:
+        if data_type != ACCELEROMETER:
             csv_rows_list = list(csv_rows_list)
     
-    # Memory saving measure: this data is now stored in its entirety in csv_rows_list
-    file_for_processing.clear_file_content()
-    
     # Do these fixes for data whether from Android or iOS
-    if file_for_processing.data_type == IDENTIFIERS:
-        header = fix_identifier_csv(header, csv_rows_list, file_for_processing.file_to_process.s3_file_path)
-    if file_for_processing.data_type == SURVEY_TIMINGS:
-        header = fix_survey_timings(header, csv_rows_list, file_for_processing.file_to_process.s3_file_path)
+    if data_type == IDENTIFIERS:
+        header = fix_identifier_csv(header, csv_rows_list, s3_file_path)
+    if data_type == SURVEY_TIMINGS:
+        header = fix_survey_timings(header, csv_rows_list, s3_file_path)
     
     header = b",".join([column_name.strip() for column_name in header.split(b",")])
     if csv_rows_list:
         return (
             # return item 1: the data as a defaultdict
-            binify_csv_rows(
-                csv_rows_list,
-                file_for_processing.file_to_process.study.object_id,
-                file_for_processing.file_to_process.participant.patient_id,
-                file_for_processing.data_type,
-                header
-            ),
+            binify_csv_rows(csv_rows_list, study_object_id, patient_id, data_type, header),
             # return item 2: the tuple that we use as a key for the defaultdict
-            (
-                file_for_processing.file_to_process.study.object_id,
-                file_for_processing.file_to_process.participant.patient_id,
-                file_for_processing.data_type,
-                header
-            )
+            (study_object_id, patient_id, data_type, header)
         )
     else:
         return None, None
+
+
+def process_columnar_csv_data(
+    header: bytes, columnar_rows: ColumnarRows, data_type: str, study_object_id: str,
+    patient_id: str
+):
+    """ The columnar equivalent of binify_file_contents for fixed-schema data streams, which have
+    no data fixes. Return values are the same as process_csv_data. """
+    header = b",".join([column_name.strip() for column_name in header.split(b",")])
+    if len(columnar_rows) == 0:
+        return None, None
+    
+    return (
+        binify_columnar_rows(columnar_rows, study_object_id, patient_id, data_type, header),
+        (study_object_id, patient_id, data_type, header),
+    )
@@ -0,0 +1,320 @@
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from billiard.pool import ApplyResult, Pool
+from cronutils.error_handler import ErrorHandler, null_error_handler
+from django.db import connection
+
+from config.settings import (CONCURRENT_NETWORK_OPS, DATA_PROCESSING_WORKER_PROCESSES,
+    FILE_PROCESS_PAGE_SIZE)
+from database.data_access_models import FileToProcess
+from database.user_models_participant import Participant
+from libs.chunk_cache import chunk_cache
+from libs.file_processing.batched_network_operations import batch_upload
+from libs.file_processing.csv_merger import CsvMerger
+from libs.file_processing.file_for_processing import FileForProcessing
+from libs.file_processing.file_processing_core import (binify_file_contents,
+    get_csv_processing_parameters, process_one_file, store_binified_csv_data,
+    update_latest_possible_data_timestamp, wait_for_uploads)
+from libs.s3 import S3_STATS
+
+
+# sentinel placed on the download queue when there are no more files to download
+END_OF_FILES = object()
+
+
+class StageStats:
+    """ Thread-safe counters for one stage of the processing pipeline. """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._lock = Lock()
+    
+    def record(self, seconds: float, byte_count: int = 0):
+        with self._lock:
+            self.items += 1
+            self.bytes += byte_count
+            self.seconds += seconds
+    
+    def timed(self, function: Callable, measure: Callable = None) -> Callable:
+        """ Wraps a function so that every call is recorded, measure is called on the return value
+        to determine the byte count. """
+        def wrapper(*args, **kwargs):
+            t_start = perf_counter()
+            ret = function(*args, **kwargs)
+            self.record(perf_counter() - t_start, measure(ret) if measure else 0)
+            return ret
+        return wrapper
+    
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "items": self.items,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 3),
+            # seconds are summed across threads, so these are per-thread rates.
+            "items_per_second": round(self.items / self.seconds, 3) if self.seconds else 0,
+            "bytes_per_second": round(self.bytes / self.seconds) if self.seconds else 0,
+        }
+
+
+class PipelineStats:
+    """ Per-stage throughput and download queue depth, for sizing the pipeline. """
+    
+    def __init__(self):
+        self.download = StageStats("download")
+        self.parse = StageStats("parse")
+        self.merge = StageStats("merge")
+        self.upload = StageStats("upload")
+        self.queue_depth_samples = 0
+        self.queue_depth_total = 0
+        self.queue_depth_max = 0
+        self.queue_empty_count = 0  # number of times the parse stage had to wait for a download
+    
+    def sample_queue_depth(self, depth: int):
+        self.queue_depth_samples += 1
+        self.queue_depth_total += depth
+        self.queue_depth_max = max(self.queue_depth_max, depth)
+        if depth == 0:
+            self.queue_empty_count += 1
+    
+    def as_dict(self) -> Dict[str, dict]:
+        return {
+            **{stage.name: stage.as_dict() for stage in (self.download, self.parse, self.merge, self.upload)},
+            "download_queue": {
+                "max_depth": self.queue_depth_max,
+                "mean_depth": round(self.queue_depth_total / self.queue_depth_samples, 2)
+                    if self.queue_depth_samples else 0,
+                "times_empty": self.queue_empty_count,
+            },
+        }
+    
+    def print_summary(self):
+        for name, values in self.as_dict().items():
+            print(f"{name}: " + ", ".join(f"{k}={v}" for k, v in values.items()))
+
+
+class ProcessingPage:
+    """ The state of one page of files moving through the pipeline. """
+    
+    def __init__(self):
+        self.file_count = 0
+        self.all_binified_data = defaultdict(lambda: ([], []))
+        self.survey_id_dict = {}
+        self.ftps_to_remove = set()
+        self.uploads: Optional[CsvMerger] = None
+        self.parsing_results: List[Tuple[FileForProcessing, ApplyResult]] = []
+
+
+class ParticipantProcessingPipeline:
+    """ Processes all of a participant's files with the download, parse, merge, and upload stages
+    running concurrently, instead of in sequence, one page at a time.
+    
+    - Downloads run on a thread pool that is fed by a producer thread, which pages through the
+      participant's FilesToProcess by primary key for the entire run.  Downloaded files go onto a
+      bounded queue, which provides backpressure and caps memory usage at roughly one page of files.
+    - Parsing and binifying happens on the calling thread, one page at a time, or on a pool of
+      DATA_PROCESSING_WORKER_PROCESSES processes if that setting is enabled.
+    - Merging a page dispatches its uploads to a second thread pool, the calling thread then goes on
+      to parse the next page while those uploads run.  A page's uploads must complete (and its
+      FilesToProcess are retired) before the next page is merged, because pages can touch the
+      same chunks.
+    
+    Files that fail are left in place and will not be retried during this run. """
+    
+    def __init__(
+        self, participant: Participant, error_handler: ErrorHandler,
+        page_size: int = FILE_PROCESS_PAGE_SIZE
+    ):
+        self.participant = participant
+        self.error_handler = error_handler
+        self.page_size = page_size
+        self.stats = PipelineStats()
+        self.number_bad_files = 0
+        self.number_processed_files = 0
+        
+        self.download_queue = Queue(maxsize=page_size)
+        self.download_pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        self.upload_pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        self.producer = Thread(target=self.produce, daemon=True)
+        
+        # Optionally, files are parsed on a pool of processes so that more than one core can be used.
+        # (billiard's Pool can be created inside of a celery worker process, multiprocessing's can't.)
+        if DATA_PROCESSING_WORKER_PROCESSES > 0:
+            connection.close()  # child processes must not share the database connection
+            self.parsing_pool = Pool(DATA_PROCESSING_WORKER_PROCESSES)
+        else:
+            self.parsing_pool = None
+        self.stopped = False
+    
+    def run(self, time_limit_seconds: float = None):
+        """ Processes files until there are none left or the time limit is reached. The time limit
+        is checked between pages. """
+        t_start = perf_counter()
+        S3_STATS.reset()  # a celery worker process runs one task at a time.
+        chunk_cache.refresh_purged_participants()
+        self.producer.start()
+        previous_page = None
+        try:
+            while True:
+                try:
+                    page = self.parse_page()
+                finally:
+                    # the merged page's uploads have been dispatched, they are finished (and their
+                    # ChunkRegistries saved) even if parsing the next page fails.
+                    if previous_page is not None:
+                        self.finish_page(previous_page)
+                        previous_page = None
+                if page.file_count == 0:
+                    break
+                
+                self.merge_page(page)
+                previous_page = page
+                
+                if time_limit_seconds and perf_counter() - t_start > time_limit_seconds:
+                    # finish the page that has been merged, downloaded files are discarded.
+                    self.finish_page(page)
+                    print("processing time limit reached.")
+                    break
+        finally:
+            self.stop()
+            self.stats.print_summary()
+            seconds = perf_counter() - t_start
+            print(
+                f"{self.number_processed_files} files in {seconds:.1f} seconds, "
+                f"{self.number_processed_files / seconds:.2f} files per second."
+            )
+            S3_STATS.print_summary()
+    
+    def produce(self):
+        """ The download stage, runs on its own thread. """
+        download = self.stats.download.timed(
+            FileForProcessing, measure=lambda ffp: len(ffp.file_contents or b"")
+        )
+        try:
+            last_pk = 0
+            while not self.stopped:
+                page_of_ftps: List[FileToProcess] = list(
+                    self.participant.files_to_process.exclude(deleted=True)
+                    .filter(pk__gt=last_pk).order_by("pk")
+                    .select_related("study", "participant__study")[:self.page_size]
+                )
+                if not page_of_ftps:
+                    break
+                last_pk = page_of_ftps[-1].pk
+                for file_for_processing in self.download_pool.imap(download, page_of_ftps):
+                    self.download_queue.put(file_for_processing)  # blocks while the queue is full
+                    if self.stopped:
+                        return
+        except Exception as e:
+            # a download error is raised on the consuming thread.
+            self.download_queue.put(e)
+        finally:
+            self.download_queue.put(END_OF_FILES)
+            connection.close()
+    
+    def parse_page(self) -> ProcessingPage:
+        """ The parse stage, consumes up to a page of downloaded files. """
+        update_latest_possible_data_timestamp()
+        page = ProcessingPage()
+        while page.file_count < self.page_size:
+            self.stats.sample_queue_depth(self.download_queue.qsize())
+            file_for_processing = self.download_queue.get()
+            if file_for_processing is END_OF_FILES:
+                self.download_queue.put(END_OF_FILES)  # subsequent pages also need to end.
+                break
+            if isinstance(file_for_processing, Exception):
+                raise file_for_processing
+            
+            page.file_count += 1
+            t_start = perf_counter()
+            if self.parsing_pool is not None and file_for_processing.chunkable \
+                    and not file_for_processing.exception and not file_for_processing.undecryptable:
+                # only the raw bytes and a few strings are sent to the parsing process
+                page.parsing_results.append((
+                    file_for_processing,
+                    self.parsing_pool.apply_async(
+                        binify_file_contents,
+                        (file_for_processing.file_contents,
+                         *get_csv_processing_parameters(file_for_processing)),
+                    )
+                ))
+                file_for_processing.clear_file_content()
+                continue
+            
+            with self.error_handler:
+                process_one_file(
+                    file_for_processing, page.survey_id_dict, page.all_binified_data,
+                    page.ftps_to_remove
+                )
+            self.stats.parse.record(perf_counter() - t_start)
+        
+        # results are stored in file order, which keeps the output identical to parsing in-process.
+        for file_for_processing, parsing_result in page.parsing_results:
+            t_start = perf_counter()
+            with self.error_handler:
+                store_binified_csv_data(
+                    file_for_processing, parsing_result.get(), page.survey_id_dict,
+                    page.all_binified_data, page.ftps_to_remove
+                )
+            self.stats.parse.record(perf_counter() - t_start)
+        page.parsing_results = None
+        return page
+    
+    def merge_page(self, page: ProcessingPage):
+        """ The merge stage, uploads are dispatched to the upload stage as chunks are merged. """
+        t_start = perf_counter()
+        page.uploads = CsvMerger(
+            page.all_binified_data, self.error_handler, page.survey_id_dict, self.participant,
+            upload_pool=self.upload_pool, upload_function=self.timed_upload,
+        )
+        page.all_binified_data = None  # free memory
+        self.stats.merge.record(perf_counter() - t_start)
+    
+    def timed_upload(self, upload: tuple) -> dict:
+        """ The upload stage, runs on the upload pool. """
+        t_start = perf_counter()
+        ret = batch_upload(upload)
+        self.stats.upload.record(perf_counter() - t_start, len(upload[2]))
+        return ret
+    
+    def finish_page(self, page: ProcessingPage):
+        """ Waits for the page's uploads, then retires its FilesToProcess. (The data quantity stats
+        are updated along with the page's ChunkRegistries.) """
+        more_ftps_to_remove, number_bad_files = wait_for_uploads(page.uploads)
+        page.ftps_to_remove.update(more_ftps_to_remove)
+        self.number_bad_files += number_bad_files
+        self.number_processed_files += page.file_count
+        
+        FileToProcess.objects.filter(pk__in=page.ftps_to_remove).delete()
+        print(
+            f"{self.number_processed_files} files processed, {self.number_bad_files} failed, "
+            f"{self.download_queue.qsize()} downloaded files waiting."
+        )
+    
+    def stop(self):
+        self.stopped = True
+        # unblock the producer if it is waiting on a full queue
+        while self.producer.is_alive():
+            try:
+                self.download_queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self.download_pool.terminate()
+        if self.parsing_pool is not None:
+            self.parsing_pool.terminate()
+        self.upload_pool.close()
+        self.upload_pool.join()
+
+
+def easy_run(participant: Participant):
+    """ Just a handy way to just run data processing in the terminal, use with caution, does not
+    test for celery activity. """
+    print(f"processing files for {participant.patient_id}")
+    ParticipantProcessingPipeline(participant, null_error_handler).run()
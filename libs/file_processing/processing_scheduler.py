@@ -0,0 +1,79 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List
+
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from database.data_access_models import FileToProcess
+
+
+class ProcessingWorkUnit:
+    """ A participant's backlog of files to process, as seen by the scheduler.  A data processing
+    task works on a single participant at a time, for at most DATA_PROCESSING_TASK_SECONDS, so a
+    large backlog takes several work units to drain. """
+    
+    def __init__(
+        self, participant_id: int, study_id: int, file_count: int, oldest_file: datetime,
+        now: datetime
+    ):
+        self.participant_id = participant_id
+        self.study_id = study_id
+        self.file_count = file_count
+        self.oldest_file = oldest_file
+        self.age_seconds = max((now - oldest_file).total_seconds(), 0)
+    
+    @property
+    def priority(self) -> float:
+        """ Highest response ratio next: the age of the backlog divided by its size.  Small backlogs
+        are processed first, but every backlog's priority grows as it waits, so a large backlog is
+        never starved. """
+        return self.age_seconds / self.file_count
+    
+    def __repr__(self):
+        return f"ProcessingWorkUnit(participant {self.participant_id}, {self.file_count} files)"
+
+
+def get_processing_work_units(now: datetime = None) -> List[ProcessingWorkUnit]:
+    """ Returns a work unit for every participant with files to process, highest priority first. """
+    now = now or timezone.now()
+    query = (
+        FileToProcess.objects.exclude(deleted=True)
+        .values("participant_id", "study_id")
+        .annotate(file_count=Count("id"), oldest_file=Min("created_on"))
+        .order_by()  # clear any default ordering, it would break the group by.
+        .values_list("participant_id", "study_id", "file_count", "oldest_file")
+    )
+    work_units = [ProcessingWorkUnit(*values, now=now) for values in query]
+    # participant id breaks ties so that the order is deterministic.
+    work_units.sort(key=lambda unit: (-unit.priority, unit.participant_id))
+    return work_units
+
+
+def get_processing_backlog_by_study(
+    work_units: List[ProcessingWorkUnit] = None
+) -> Dict[int, Dict[str, float]]:
+    """ Returns backlog metrics keyed by study id.  Participants are processed in parallel but each
+    participant is only ever processed by one worker, so (given enough workers) a study's backlog
+    clears when its largest participant backlog clears. """
+    if work_units is None:
+        work_units = get_processing_work_units()
+    
+    by_study = defaultdict(list)
+    for work_unit in work_units:
+        by_study[work_unit.study_id].append(work_unit)
+    
+    ret = {}
+    for study_id, study_work_units in by_study.items():
+        ret[study_id] = {
+            "participants": len(study_work_units),
+            "files": sum(work_unit.file_count for work_unit in study_work_units),
+            "largest_participant_files": max(unit.file_count for unit in study_work_units),
+            "oldest_file_age_seconds": round(max(unit.age_seconds for unit in study_work_units)),
+        }
+    return ret
+
+
+def print_processing_backlog(work_units: List[ProcessingWorkUnit] = None):
+    for study_id, metrics in get_processing_backlog_by_study(work_units).items():
+        print(f"study {study_id} backlog: " + ", ".join(f"{k}={v}" for k, v in metrics.items()))
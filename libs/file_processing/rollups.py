@@ -0,0 +1,89 @@
+import math
+from calendar import timegm
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from constants.common_constants import API_TIME_FORMAT
+from constants.data_processing_constants import (CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER,
+    ROLLUP_HEADER, ROLLUP_PERIOD_MS, ROLLUP_TIMESLICE_QUANTUM)
+from constants.data_stream_constants import ROLLUP_DATA_STREAMS
+from libs.file_processing.utility_functions_csvs import unix_time_to_string
+
+
+# the number of hourly chunks summarized in one rollup chunk
+HOURS_PER_ROLLUP_CHUNK = ROLLUP_TIMESLICE_QUANTUM // CHUNK_TIMESLICE_QUANTUM
+
+# (the rows of summarize_minutes are a timestamp in milliseconds and a csv line)
+RollupRows = List[Tuple[int, bytes]]
+
+
+def is_rollup_source(chunk_path: str) -> bool:
+    """ Whether a chunk path is that of an hourly chunk of a data stream that has rollups. """
+    path_parts = chunk_path.split("/")
+    return len(path_parts) == 5 and path_parts[0] == CHUNKS_FOLDER \
+        and path_parts[3] in ROLLUP_DATA_STREAMS
+
+
+def parse_s3_chunk_path(chunk_path: str) -> Tuple[str, str, str, int]:
+    """ The inverse of construct_s3_chunk_path, returns the study id, patient id, data stream and
+    time bin of a chunk path. """
+    _, study_object_id, patient_id, data_stream, file_name = chunk_path.split("/")
+    unix_time = timegm(datetime.strptime(file_name[:-4], API_TIME_FORMAT).timetuple())
+    return study_object_id, patient_id, data_stream, unix_time // CHUNK_TIMESLICE_QUANTUM
+
+
+def summarize_minutes(file_contents: bytes) -> RollupRows:
+    """ Returns the rollup rows of a chunk of sensor data that has x, y and z columns: the number of
+    data points, and the mean and (population) standard deviation of x, y, z and of the magnitude
+    of the vector, for every minute that has data.  Rows that can't be parsed are skipped. """
+    lines = file_contents.splitlines()
+    if not lines:
+        return []
+    header = lines[0].split(b",")
+    try:
+        x_index, y_index, z_index = header.index(b"x"), header.index(b"y"), header.index(b"z")
+    except ValueError:
+        return []
+    
+    minutes = defaultdict(list)
+    for line in lines[1:]:
+        row = line.split(b",")
+        try:
+            timestamp = int(row[0])
+            x, y, z = float(row[x_index]), float(row[y_index]), float(row[z_index])
+        except (ValueError, IndexError):
+            continue
+        if not (math.isfinite(x) and math.isfinite(y) and math.isfinite(z)):
+            continue
+        minutes[timestamp - timestamp % ROLLUP_PERIOD_MS].append(
+            (x, y, z, math.sqrt(x * x + y * y + z * z))
+        )
+    
+    rollup_rows = []
+    for minute, values in sorted(minutes.items()):
+        count = len(values)
+        columns = [str(minute).encode(), unix_time_to_string(minute // 1000), str(count).encode()]
+        for column in zip(*values):  # x, y, z, magnitude
+            mean = math.fsum(column) / count
+            std = math.sqrt(math.fsum((value - mean) ** 2 for value in column) / count)
+            columns.append(b"%.6g,%.6g" % (mean, std))
+        rollup_rows.append((minute, b",".join(columns)))
+    return rollup_rows
+
+
+def merge_rollup_rows(existing_contents: Optional[bytes], hours: Dict[int, RollupRows]) -> bytes:
+    """ Returns the contents of a rollup chunk with the rows of the given hours (keyed by time bin)
+    replaced, the rows of other hours are kept. """
+    rows = {}
+    if existing_contents:
+        for line in existing_contents.splitlines()[1:]:
+            rows[int(line[:line.index(b",")])] = line
+    
+    for time_bin, hour_rows in hours.items():
+        hour_start = time_bin * CHUNK_TIMESLICE_QUANTUM * 1000
+        hour_end = hour_start + CHUNK_TIMESLICE_QUANTUM * 1000
+        for minute in range(hour_start, hour_end, ROLLUP_PERIOD_MS):
+            rows.pop(minute, None)
+        rows.update(hour_rows)
+    return ROLLUP_HEADER + b"\n" + b"\n".join(rows[minute] for minute in sorted(rows))
@@ -70,3 +70,39 @@ def construct_csv_string(header: bytes, rows_list: List[bytes]) -> bytes:
 
 def unix_time_to_string(unix_time: int) -> bytes:
     return datetime.utcfromtimestamp(unix_time).strftime(API_TIME_FORMAT).encode()
+
+
+def trim_csv_to_time_range(file_contents: bytes, start_ms: int = None, end_ms: int = None) -> bytes:
+    """ Returns the header and the rows of a (chunked data) csv with a timestamp (unix time in
+    milliseconds) in the first column that is within start_ms and end_ms, inclusive.  Only the
+    timestamp of each line is parsed, the rest of the line is not split, and lines are not joined
+    again unless the rows in the time range aren't contiguous.  Rows with a broken timestamp are
+    dropped. """
+    header_end = file_contents.find(b"\n")
+    if header_end == -1:
+        return file_contents
+    
+    kept_lines = []  # (start, end) of runs of lines within the time range
+    line_start = header_end + 1
+    length = len(file_contents)
+    while line_start < length:
+        line_end = file_contents.find(b"\n", line_start)
+        if line_end == -1:
+            line_end = length
+        comma = file_contents.find(b",", line_start, line_end)
+        try:
+            timestamp = int(file_contents[line_start:line_end if comma == -1 else comma])
+        except ValueError:
+            timestamp = None
+        
+        if timestamp is not None and (start_ms is None or timestamp >= start_ms) \
+                and (end_ms is None or timestamp <= end_ms):
+            if kept_lines and kept_lines[-1][1] == line_start - 1:
+                kept_lines[-1][1] = line_end  # extend the current run
+            else:
+                kept_lines.append([line_start, line_end])
+        line_start = line_end + 1
+    
+    return b"\n".join(
+        [file_contents[:header_end]] + [file_contents[start:end] for start, end in kept_lines]
+    )
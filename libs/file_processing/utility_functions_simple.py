@@ -1,4 +1,6 @@
-from typing import List
+from heapq import merge
+from operator import itemgetter
+from typing import Generator, Iterable, List, Tuple
 
 import zstd
 
@@ -6,7 +8,7 @@ from constants import common_constants
 from constants.common_constants import EARLIEST_POSSIBLE_DATA_TIMESTAMP
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
 from constants.data_stream_constants import IDENTIFIERS, IOS_LOG_FILE, UPLOAD_FILE_TYPE_MAPPING
-from libs.file_processing.exceptions import BadTimecodeError
+from libs.file_processing.exceptions import BadTimecodeError, ChunkNotSortedError
 from libs.file_processing.utility_functions_csvs import unix_time_to_string
 
 
@@ -64,6 +66,51 @@ def ensure_sorted_by_timestamp(l: list):
         l.sort(key=lambda x: int(x[0]))
 
 
+def iterate_timestamped_sorted_rows(
+    rows: Iterable[List[bytes]]
+) -> Generator[Tuple[int, List[bytes]], None, None]:
+    """ Yields (timestamp, row) pairs from rows that are expected to already be sorted by timestamp.
+    Rows with a broken timestamp are dropped (as in ensure_sorted_by_timestamp), raises
+    ChunkNotSortedError if a row is out of order. """
+    previous_timestamp = None
+    for row in rows:
+        try:
+            timestamp = int(row[0])
+        except ValueError:
+            continue
+        if previous_timestamp is not None and timestamp < previous_timestamp:
+            raise ChunkNotSortedError(f"{timestamp} follows {previous_timestamp}")
+        previous_timestamp = timestamp
+        yield timestamp, row
+
+
+def merge_sorted_rows(
+    old_rows: Iterable[List[bytes]], new_rows: Iterable[List[bytes]]
+) -> Generator[bytes, None, None]:
+    """ Streaming merge of two iterables of rows that are both sorted by timestamp, yields the
+    deduplicated csv lines.  Produces the same lines as extending old_rows with new_rows and running
+    ensure_sorted_by_timestamp and construct_csv_string, but only ever holds one row at a time.
+    Raises ChunkNotSortedError if either iterable turns out not to be sorted. """
+    # heapq.merge is stable, rows from old_rows come first when timestamps are equal.
+    merged_rows = merge(
+        iterate_timestamped_sorted_rows(old_rows),
+        iterate_timestamped_sorted_rows(new_rows),
+        key=itemgetter(0),
+    )
+    # identical rows have identical timestamps, so deduplication only needs to track the lines
+    # of the current timestamp.
+    current_timestamp = None
+    seen = set()
+    for timestamp, row in merged_rows:
+        if timestamp != current_timestamp:
+            current_timestamp = timestamp
+            seen.clear()
+        line = b",".join(row)
+        if line not in seen:
+            seen.add(line)
+            yield line
+
+
 def convert_unix_to_human_readable_timestamps(header: bytes, rows: List[List[bytes]]) -> List[bytes]:
     """ Adds a new column to the end which is the unix time represented in
     a human readable time format.  Returns an appropriately modified header. """
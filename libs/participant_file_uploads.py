@@ -1,18 +1,25 @@
+from functools import lru_cache
+from typing import Optional
+
+from Cryptodome.PublicKey import RSA
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from django.http.response import HttpResponse
 from django.utils import timezone
 
 from config.settings import UPLOAD_LOGGING_ENABLED
-from constants.common_constants import PROBLEM_UPLOADS
+from constants.common_constants import PROBLEM_UPLOADS, RAW_UPLOADS
 from constants.message_strings import (S3_FILE_PATH_UNIQUE_CONSTRAINT_ERROR_1,
     S3_FILE_PATH_UNIQUE_CONSTRAINT_ERROR_2)
+from constants.user_constants import IOS_API
 from database.data_access_models import FileToProcess
 from database.profiling_models import UploadTracking
 from database.system_models import GenericEvent
 from database.user_models_participant import Participant
-from libs.encryption import DeviceDataDecryptor
-from libs.s3 import s3_retrieve, s3_upload, smart_s3_list_study_files
+from libs.encryption import (DecryptionKeyInvalidError, DeviceDataDecryptor,
+    IosDecryptionKeyDuplicateError, IosDecryptionKeyNotFoundError, RemoteDeleteFileScenario)
+from libs.s3 import (get_client_private_key, s3_delete, s3_retrieve, s3_retrieve_plaintext,
+    s3_upload, s3_upload_plaintext, smart_s3_list_study_files)
 from libs.security import generate_easy_alphanumeric_string
 from middleware.abort_middleware import abort
 
@@ -25,7 +32,23 @@ def log(*args, **kwargs):
 def upload_and_create_file_to_process_and_log(
     s3_file_location: str, participant: Participant, decryptor: DeviceDataDecryptor
 ) -> HttpResponse:
+    s3_file_location = upload_decrypted_file(s3_file_location, participant, decryptor)
+    create_file_to_process(s3_file_location, participant)
     
+    # record that an upload occurred
+    UploadTracking.objects.create(
+        file_path=s3_file_location,
+        file_size=len(decryptor.decrypted_file),
+        timestamp=timezone.now(),
+        participant=participant,
+    )
+    return HttpResponse(status=200)
+
+
+def upload_decrypted_file(
+    s3_file_location: str, participant: Participant, decryptor: DeviceDataDecryptor
+) -> str:
+    """ Stores the decrypted file on s3, returns the s3 file location it was stored at. """
     # test if the file exists on s3, handle ios duplicate file merge.
     if not smart_s3_list_study_files(s3_file_location, participant):
         s3_upload(s3_file_location, decryptor.decrypted_file, participant)
@@ -42,12 +65,19 @@ def upload_and_create_file_to_process_and_log(
         s3_file_location = s3_duplicate_name(s3_file_location)
         log(f"renamed duplicate '{old_file_location}' to '{s3_file_location}'")
         s3_upload(s3_file_location, decryptor.decrypted_file, participant)
-    
+    return s3_file_location
+
+
+def create_file_to_process(
+    s3_file_location: str, participant: Participant, deferred_decryption: bool = False
+):
     # race condition: multiple _concurrent_ uploads with same file path. Behavior without try-except
     # is correct, but we don't care about reporting it. Just send the device a 500 error so it skips
     # the file, the followup attempt receives 200 code and deletes the file.
     try:
-        FileToProcess.append_file_for_processing(s3_file_location, participant)
+        FileToProcess.append_file_for_processing(
+            s3_file_location, participant, deferred_decryption=deferred_decryption
+        )
     except (IntegrityError, ValidationError) as e:
         # there are two error cases that can occur here (race condition with 2 concurrent uploads)
         if (
@@ -57,17 +87,128 @@ def upload_and_create_file_to_process_and_log(
             # don't abort 500, we want to limit 500 errors on the ELB in production (uhg)
             log("backoff for duplicate race condition.", str(e))
             return abort(400)
+
+
+#
+## Deferred decryption, see DEFER_UPLOAD_DECRYPTION
+#
+
+def raw_upload_path(normalized_s3_file_path: str) -> str:
+    """ Takes the (normalized) s3_file_path of a FileToProcess. """
+    return f"{RAW_UPLOADS}/{normalized_s3_file_path}"
+
+
+def ingest_raw_upload(
+    s3_file_location: str, participant: Participant, file_contents: bytes
+) -> HttpResponse:
+    """ The deferred decryption version of upload_and_create_file_to_process_and_log.  The file is
+    stored as-is and decrypted by decrypt_deferred_upload during data processing.  Uploaded files
+    are already encrypted by the device, they are not encrypted again with the study key. """
+    # the only check we can make without decrypting, an empty upload would be discarded anyway.
+    if not file_contents.strip():
+        log(200, "empty upload.")
+        return HttpResponse(status=200)
     
-    # record that an upload occurred
+    s3_upload_plaintext(
+        raw_upload_path(
+            FileToProcess.normalize_s3_file_path(s3_file_location, participant.study.object_id)
+        ),
+        file_contents,
+    )
+    create_file_to_process(s3_file_location, participant, deferred_decryption=True)
     UploadTracking.objects.create(
         file_path=s3_file_location,
-        file_size=len(decryptor.decrypted_file),
+        file_size=len(file_contents),
         timestamp=timezone.now(),
         participant=participant,
     )
     return HttpResponse(status=200)
 
 
+@lru_cache(maxsize=64)
+def get_cached_private_key(patient_id: str, study_object_id: str) -> RSA.RsaKey:
+    """ A data processing task decrypts many files for the same participant. """
+    return get_client_private_key(patient_id, study_object_id)
+
+
+def decrypt_deferred_upload(file_to_process: FileToProcess) -> Optional[bytes]:
+    """ Decrypts a file stored by ingest_raw_upload and stores the decrypted file where the upload
+    would have stored it, the FileToProcess is updated to point at the decrypted file.  Returns the
+    decrypted file contents, or None if there is nothing to process, in which case the
+    FileToProcess is deleted.  The error cases match the upload endpoint. """
+    participant = file_to_process.participant
+    raw_path = raw_upload_path(file_to_process.s3_file_path)
+    # the s3_file_path without the study object id prefix, as the upload endpoint receives it.
+    s3_file_location = file_to_process.s3_file_path.split("/", 1)[1]
+    file_contents = s3_retrieve_plaintext(raw_path)
+    
+    decrypted_file = None
+    try:
+        decryptor = DeviceDataDecryptor(
+            s3_file_location, file_contents, participant,
+            private_key=get_cached_private_key(participant.patient_id, participant.study.object_id),
+        )
+    except RemoteDeleteFileScenario:
+        log("RemoteDeleteFileScenario", s3_file_location)
+    except (DecryptionKeyInvalidError, IosDecryptionKeyNotFoundError, IosDecryptionKeyDuplicateError) as e:
+        upload_problem_file(file_contents, participant, s3_file_location, e)
+    else:
+        if participant.os_type == IOS_API and not decryptor.used_ios_decryption_key_cache:
+            merge_ios_split_file_segments(s3_file_location, participant, decryptor)
+        decrypted_file = decryptor.decrypted_file or None
+    
+    if decrypted_file is None:
+        FileToProcess.objects.filter(pk=file_to_process.pk).delete()
+    else:
+        s3_file_location = upload_decrypted_file(s3_file_location, participant, decryptor)
+        file_to_process.s3_file_path = FileToProcess.normalize_s3_file_path(
+            s3_file_location, participant.study.object_id
+        )
+        file_to_process.deferred_decryption = False
+        file_to_process.save()
+    
+    # the database is always updated first, a missing raw file is never left referenced.
+    s3_delete(raw_path)
+    return decrypted_file
+
+
+def merge_ios_split_file_segments(
+    s3_file_location: str, participant: Participant, decryptor: DeviceDataDecryptor
+):
+    """ The segments of an iOS split file (see DeviceDataDecryptor.do_ios_decryption) that were
+    decrypted before the segment with the decryption key failed with IosDecryptionKeyNotFoundError
+    and were stored as problem uploads.  Now that the key is stored they are decrypted and appended
+    to the decrypted file, which is how the upload endpoint merges segments that arrive in order.
+    Segments that still fail are left for scripts/process_ios_no_decryption_key.py. """
+    problem_file_path = f"{PROBLEM_UPLOADS}/{participant.study.object_id}/{s3_file_location}"
+    events = GenericEvent.objects.filter(
+        tag=f"problem_upload_file_{IosDecryptionKeyNotFoundError.__name__}",
+        note__startswith=problem_file_path,
+    ).order_by("created_on")
+    
+    segments = [decryptor.decrypted_file]
+    for event in events:
+        file_path = event.note.split(" ")[0]
+        if len(file_path) != len(problem_file_path) + 10:  # (upload_problem_file's random suffix)
+            continue
+        try:
+            segment_decryptor = DeviceDataDecryptor(
+                s3_file_location, s3_retrieve(file_path, participant, raw_path=True), participant,
+                private_key=decryptor.private_key_cipher,
+            )
+        except (RemoteDeleteFileScenario, DecryptionKeyInvalidError,
+                IosDecryptionKeyNotFoundError, IosDecryptionKeyDuplicateError) as e:
+            log("ios split file segment failed", file_path, str(e))
+            continue
+        if segment_decryptor.decrypted_file:
+            segments.append(segment_decryptor.decrypted_file)
+        log("merged ios split file segment", file_path)
+        event.delete()
+    
+    if len(segments) > 1:
+        decryptor.decrypted_file = b"\n".join(segments)
+
+
 def upload_problem_file(
     file_contents: bytes, participant: Participant, s3_file_path: str, exception: Exception
 ):
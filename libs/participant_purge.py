@@ -3,9 +3,10 @@ from typing import List, Tuple
 
 from django.utils import timezone
 
-from constants.common_constants import PROBLEM_UPLOADS
+from constants.common_constants import PROBLEM_UPLOADS, RAW_UPLOADS
 from constants.data_processing_constants import CHUNKS_FOLDER
 from database.user_models_participant import Participant, ParticipantDeletionEvent
+from libs.chunk_cache import chunk_cache
 from libs.s3 import s3_delete_many_versioned, s3_list_files, s3_list_versions
 from libs.security import generate_easy_alphanumeric_string
 
@@ -45,9 +46,16 @@ def run_next_queued_participant_data_deletion():
     deletion_event.participant.set_password(generate_easy_alphanumeric_string(50))
     
     delete_participant_data(deletion_event)
+    # decrypted copies of the participant's data files (the chunk cache of other servers is not
+    # purged, see CHUNK_CACHE_MAX_BYTES)
+    chunk_cache.purge_participant(
+        deletion_event.participant.study.object_id, deletion_event.participant.patient_id
+    )
     # MAKE SURE TO UPDATE TESTS IF YOU ADD MORE RELATIONS TO THIS LIST
     deletion_event.participant.chunk_registries.all().delete()
     deletion_event.participant.summarystatisticdaily_set.all().delete()
+    deletion_event.participant.dashboard_data_quantities.all().delete()
+    deletion_event.participant.chunk_time_bin_extents.all().delete()
     deletion_event.participant.lineencryptionerror_set.all().delete()
     deletion_event.participant.iosdecryptionkey_set.all().delete()
     deletion_event.participant.foresttask_set.all().delete()
@@ -80,7 +88,8 @@ def delete_participant_data(deletion_event: ParticipantDeletionEvent):
 def confirm_deleted(deletion_event: ParticipantDeletionEvent):
     """ Tests all locations for files and database entries, raises AssertionError if any are found. """
     deletion_event.save()  # mark the event as processing...
-    keys, base, chunks_prefix, problem_uploads = get_all_file_path_prefixes(deletion_event.participant)
+    keys, base, chunks_prefix, problem_uploads, raw_uploads = \
+        get_all_file_path_prefixes(deletion_event.participant)
     for _ in s3_list_files(keys, as_generator=True):
         raise AssertionError(f"still files present in {keys}")
     for _ in s3_list_files(base, as_generator=True):
@@ -89,12 +98,18 @@ def confirm_deleted(deletion_event: ParticipantDeletionEvent):
         raise AssertionError(f"still files present in {chunks_prefix}")
     for _ in s3_list_files(problem_uploads, as_generator=True):
         raise AssertionError(f"still files present in {problem_uploads}")
+    for _ in s3_list_files(raw_uploads, as_generator=True):
+        raise AssertionError(f"still files present in {raw_uploads}")
     
     # MAKE SURE TO UPDATE TESTS IF YOU ADD MORE RELATIONS TO THIS LIST
     if deletion_event.participant.chunk_registries.exists():
         raise AssertionError("still have database entries for chunk_registries")
     if deletion_event.participant.summarystatisticdaily_set.exists():
         raise AssertionError("still have database entries for summarystatisticdaily")
+    if deletion_event.participant.dashboard_data_quantities.exists():
+        raise AssertionError("still have database entries for dashboard_data_quantities")
+    if deletion_event.participant.chunk_time_bin_extents.exists():
+        raise AssertionError("still have database entries for chunk_time_bin_extents")
     if deletion_event.participant.lineencryptionerror_set.exists():
         raise AssertionError("still have database entries for lineencryptionerror")
     if deletion_event.participant.iosdecryptionkey_set.exists():
@@ -150,6 +165,7 @@ def get_all_file_path_prefixes(participant: Participant) -> Tuple[Tuple[str, str
     base = participant.study.object_id + "/" + participant.patient_id + "/"
     chunks_prefix = CHUNKS_FOLDER + "/" + base
     problem_uploads = PROBLEM_UPLOADS + "/" + base
+    raw_uploads = RAW_UPLOADS + "/" + base  # (see DEFER_UPLOAD_DECRYPTION)
     # this one is two files at most without a trailing slash
     keys = participant.study.object_id + "/keys/" + participant.patient_id
-    return keys, base, chunks_prefix, problem_uploads
+    return keys, base, chunks_prefix, problem_uploads, raw_uploads
@@ -1,16 +1,24 @@
-from typing import Generator, List, Optional, Tuple
+from collections import defaultdict
+from io import BytesIO
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from os import pwrite
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
 
 import boto3
-from botocore.client import BaseClient, Paginator
+from botocore.client import BaseClient, Config, Paginator
 from cronutils import ErrorHandler
 from Cryptodome.PublicKey import RSA
 
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-    S3_BUCKET, S3_REGION_NAME)
+    CONCURRENT_NETWORK_OPS, S3_BUCKET, S3_MAX_POOL_CONNECTIONS, S3_REGION_NAME)
 from constants.data_processing_constants import CHUNKS_FOLDER
 from database.study_models import Study
 from database.user_models_participant import Participant
-from libs.aes import decrypt_server, encrypt_for_server
+from libs.aes import (decrypt_server, decrypt_server_part, encrypt_for_server,
+    encrypt_for_server_in_parts, IV_LENGTH)
 from libs.internal_types import StrOrParticipantOrStudy
 from libs.rsa import generate_key_pairing, get_RSA_cipher, prepare_X509_key_for_java
 
@@ -23,12 +31,108 @@ class NoSuchKeyException(Exception): pass
 class S3DeleteException(Exception): pass
 
 
-conn: BaseClient = boto3.client(
-    's3',
-    aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-    region_name=S3_REGION_NAME,
-)
+# Data processing runs CONCURRENT_NETWORK_OPS downloads and CONCURRENT_NETWORK_OPS uploads at once.
+# Threads beyond the pool size make a new connection (a TLS handshake) for every request and then
+# discard it.  Never smaller than botocore's default of 10.
+S3_POOL_CONNECTIONS = S3_MAX_POOL_CONNECTIONS or max(CONCURRENT_NETWORK_OPS * 2, 10)
+
+# Total attempts per S3 call.  Retries (throttling, 500s, connection errors) use exponential backoff
+# with jitter, and "adaptive" mode additionally slows down all of the client's calls when S3 starts
+# throttling them, instead of every thread retrying on its own schedule.
+S3_MAX_ATTEMPTS = 5
+
+# Files larger than S3_TRANSFER_THRESHOLD bytes are transferred in parts of S3_TRANSFER_PART_SIZE
+# bytes, S3_TRANSFER_THREADS parts at a time, with ranged downloads and multipart uploads.  (A
+# single S3 connection is limited to well under the bandwidth of a server.)  Multipart upload parts
+# must be at least 5MiB.
+S3_TRANSFER_PART_SIZE = 16 * 1024 * 1024
+S3_TRANSFER_THRESHOLD = 2 * S3_TRANSFER_PART_SIZE
+S3_TRANSFER_THREADS = 8
+
+
+class S3OperationStats:
+    """ Thread-safe per-operation call counts, latency, and byte counts of every call made by S3
+    clients from get_s3_client.  Latency includes retries, for downloads it is the time until the
+    response headers arrive, the body is read after that. """
+    
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.calls = defaultdict(int)
+            self.retries = defaultdict(int)
+            self.errors = defaultdict(int)
+            self.bytes = defaultdict(int)
+            self.seconds = defaultdict(float)
+    
+    def before_parameter_build(self, params: dict, context: dict, **kwargs):
+        context["s3_operation_stats_start"] = perf_counter()
+        # uploads are counted by their request body size, downloads by their response size.
+        # (botocore has wrapped an uploaded bytes object in a BytesIO by this point.)
+        body = params.get("Body")
+        if isinstance(body, bytes):
+            context["s3_operation_stats_bytes"] = len(body)
+        elif isinstance(body, BytesIO):
+            context["s3_operation_stats_bytes"] = body.getbuffer().nbytes
+    
+    def after_call(self, model, context: dict, http_response, parsed: dict, **kwargs):
+        seconds = perf_counter() - context.get("s3_operation_stats_start", perf_counter())
+        byte_count = parsed.get("ContentLength") or context.get("s3_operation_stats_bytes", 0)
+        with self._lock:
+            self.calls[model.name] += 1
+            self.retries[model.name] += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            self.errors[model.name] += http_response.status_code >= 300
+            self.bytes[model.name] += byte_count
+            self.seconds[model.name] += seconds
+    
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                name: {
+                    "calls": self.calls[name],
+                    "retries": self.retries[name],
+                    "errors": self.errors[name],
+                    "bytes": self.bytes[name],
+                    "mean_seconds": round(self.seconds[name] / self.calls[name], 4),
+                }
+                for name in sorted(self.calls)
+            }
+    
+    def print_summary(self):
+        for name, values in self.as_dict().items():
+            print(f"s3 {name}: " + ", ".join(f"{k}={v}" for k, v in values.items()))
+
+
+S3_STATS = S3OperationStats()
+
+
+def get_s3_client(
+    max_pool_connections: int = S3_POOL_CONNECTIONS, stats: S3OperationStats = S3_STATS,
+    **client_kwargs
+) -> BaseClient:
+    """ Creates an S3 client.  boto3 clients are thread-safe, a process should share one client
+    between its threads and size max_pool_connections to the number of threads using it. """
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "max_attempts": S3_MAX_ATTEMPTS},
+    )
+    client = boto3.client('s3', **{
+        "aws_access_key_id": BEIWE_SERVER_AWS_ACCESS_KEY_ID,
+        "aws_secret_access_key": BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
+        "region_name": S3_REGION_NAME,
+        "config": config,
+        **client_kwargs,
+    })
+    if stats is not None:
+        client.meta.events.register("before-parameter-build.s3", stats.before_parameter_build)
+        client.meta.events.register("after-call.s3", stats.after_call)
+    return client
+
+
+conn: BaseClient = get_s3_client()
 
 
 def smart_get_study_encryption_key(obj: StrOrParticipantOrStudy) -> bytes:
@@ -61,20 +165,52 @@ def s3_upload(
     associated with. Intelligently accepts a string, Participant, or Study object as needed. """
     if not raw_path:
         key_path = s3_construct_study_key_path(key_path, obj)
-    data = encrypt_for_server(data_string, smart_get_study_encryption_key(obj))
+    encryption_key = smart_get_study_encryption_key(obj)
     assert S3_BUCKET is not Exception, "libs.s3.s3_upload called inside test"
-    _do_upload(key_path, data)
+    if len(data_string) + IV_LENGTH > S3_TRANSFER_THRESHOLD:
+        parts = encrypt_for_server_in_parts(data_string, encryption_key, S3_TRANSFER_PART_SIZE)
+        _do_multipart_upload(key_path, parts)
+    else:
+        _do_upload(key_path, encrypt_for_server(data_string, encryption_key))
 
 
-def _do_upload(key_path: str, data_string: bytes, number_retries=3):
-    """ In ~April 2022 this api call started occasionally failing, so wrapping it in a retry. """
+def _do_upload(key_path: str, data_string: bytes):
+    """ In ~April 2022 this api call started occasionally failing ("Please try again"), the client
+    retries those errors with backoff. """
     assert S3_BUCKET is not Exception, "libs.s3._do_upload called inside test"
+    conn.put_object(Body=data_string, Bucket=S3_BUCKET, Key=key_path)
+
+
+def _do_multipart_upload(key_path: str, parts: Iterable[bytes]):
+    """ Uploads parts on S3_TRANSFER_THREADS threads.  parts is consumed S3_TRANSFER_THREADS parts
+    at a time, so if it is a generator only that many parts are in memory. """
+    assert S3_BUCKET is not Exception, "libs.s3._do_multipart_upload called inside test"
+    upload_id = conn.create_multipart_upload(Bucket=S3_BUCKET, Key=key_path)["UploadId"]
+    
+    def upload_part(part_number_and_part: Tuple[int, bytes]) -> dict:
+        part_number, part = part_number_and_part
+        response = conn.upload_part(
+            Body=part, Bucket=S3_BUCKET, Key=key_path, PartNumber=part_number, UploadId=upload_id
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+    
     try:
-        conn.put_object(Body=data_string, Bucket=S3_BUCKET, Key=key_path)
-    except Exception as e:
-        if "Please try again" not in str(e):
-            raise
-        _do_upload(key_path, data_string, number_retries=number_retries - 1)
+        completed_parts = []
+        numbered_parts = enumerate(parts, start=1)  # part numbers start at 1
+        with ThreadPool(S3_TRANSFER_THREADS) as pool:
+            while True:
+                batch = list(islice(numbered_parts, S3_TRANSFER_THREADS))
+                if not batch:
+                    break
+                completed_parts.extend(pool.map(upload_part, batch))
+        conn.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=key_path, UploadId=upload_id,
+            MultipartUpload={"Parts": completed_parts},
+        )
+    except Exception:
+        # otherwise the uploaded parts are stored (and billed) indefinitely
+        conn.abort_multipart_upload(Bucket=S3_BUCKET, Key=key_path, UploadId=upload_id)
+        raise
 
 
 def s3_upload_plaintext(upload_path: str, data_string: bytes) -> None:
@@ -82,35 +218,99 @@ def s3_upload_plaintext(upload_path: str, data_string: bytes) -> None:
     conn.put_object(Body=data_string, Bucket=S3_BUCKET, Key=upload_path)
 
 
-def s3_retrieve(key_path: str, obj: str, raw_path: bool = False, number_retries=3) -> bytes:
+def s3_retrieve(key_path: str, obj: str, raw_path: bool = False) -> bytes:
     """ Takes an S3 file path (key_path), and a study ID.  Takes an optional argument, raw_path,
     which defaults to false.  When set to false the path is prepended to place the file in the
     appropriate study_id folder. """
     if not raw_path:
         key_path = s3_construct_study_key_path(key_path, obj)
-    encrypted_data = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
     assert S3_BUCKET is not Exception, "libs.s3.s3_retrieve called inside test"
-    return decrypt_server(encrypted_data, smart_get_study_encryption_key(obj))
+    encryption_key = smart_get_study_encryption_key(obj)
+    first_part, file_size = _do_retrieve_first_part(key_path)
+    if len(first_part) == file_size:
+        return decrypt_server(first_part, encryption_key)
+    
+    # large files are decrypted into the output as the parts arrive, the entire encrypted file is
+    # never in memory.
+    output = memoryview(bytearray(file_size - IV_LENGTH))
+    
+    def decrypt_part(part: bytes, offset: int):
+        part_output = output[offset:offset + len(part) - IV_LENGTH]
+        decrypt_server_part(part, encryption_key, output=part_output)
+    
+    decrypt_part(first_part, 0)
+    remaining_start = len(first_part)
+    del first_part
+    _do_retrieve_remaining_parts(key_path, remaining_start, file_size, decrypt_part)
+    return output.tobytes()
+
+
+def s3_retrieve_to_file(key_path: str, obj: str, file_path: str, raw_path: bool = False) -> None:
+    """ s3_retrieve, but the file is written to file_path (which must not exist) as it arrives, it
+    is never entirely in memory. """
+    if not raw_path:
+        key_path = s3_construct_study_key_path(key_path, obj)
+    assert S3_BUCKET is not Exception, "libs.s3.s3_retrieve_to_file called inside test"
+    encryption_key = smart_get_study_encryption_key(obj)
+    first_part, file_size = _do_retrieve_first_part(key_path)
+    with open(file_path, "xb") as f:
+        def decrypt_part(part: bytes, offset: int):
+            pwrite(f.fileno(), decrypt_server_part(part, encryption_key), offset)
+        
+        decrypt_part(first_part, 0)
+        remaining_start = len(first_part)
+        del first_part
+        _do_retrieve_remaining_parts(key_path, remaining_start, file_size, decrypt_part)
+
+
+def _do_retrieve_first_part(key_path: str) -> Tuple[bytes, int]:
+    """ Retrieves up to S3_TRANSFER_THRESHOLD bytes of a file, returns them and the file size. """
+    response = _do_retrieve(S3_BUCKET, key_path, Range=f"bytes=0-{S3_TRANSFER_THRESHOLD - 1}")
+    first_part = response['Body'].read()
+    # the ContentRange of a ranged request looks like "bytes 0-1023/4096"
+    if "ContentRange" in response:
+        return first_part, int(response["ContentRange"].rsplit("/", 1)[1])
+    return first_part, len(first_part)
+
+
+def _do_retrieve_remaining_parts(
+    key_path: str, start: int, file_size: int, decrypt_part: Callable[[bytes, int], None]
+):
+    """ Retrieves the rest of a file encrypted by encrypt_for_server with ranged requests on
+    S3_TRANSFER_THREADS threads, calls decrypt_part with each encrypted part and its position in
+    the decrypted file.  Each part includes the IV_LENGTH bytes in front of it, see
+    decrypt_server_part. """
+    
+    def retrieve_part(part_start: int):
+        part_end = min(part_start + S3_TRANSFER_PART_SIZE, file_size)
+        byte_range = f"bytes={part_start - IV_LENGTH}-{part_end - 1}"  # (the range is inclusive)
+        part = _do_retrieve(S3_BUCKET, key_path, Range=byte_range)['Body'].read()
+        decrypt_part(part, part_start - IV_LENGTH)
+    
+    part_starts = range(start, file_size, S3_TRANSFER_PART_SIZE)
+    if not part_starts:
+        return
+    with ThreadPool(min(S3_TRANSFER_THREADS, len(part_starts))) as pool:
+        pool.map(retrieve_part, part_starts)
 
 
-def s3_retrieve_plaintext(key_path: str, number_retries=3) -> bytes:
+def s3_retrieve_plaintext(key_path: str) -> bytes:
     """ Retrieves a file as-is as bytes. """
-    return _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
+    return _do_retrieve(S3_BUCKET, key_path)['Body'].read()
 
 
-def _do_retrieve(bucket_name: str, key_path: str, number_retries=3):
-    """ Run-logic to do a data retrieval for a file in an S3 bucket."""
+def _do_retrieve(bucket_name: str, key_path: str, **kwargs):
+    """ Run-logic to do a data retrieval for a file in an S3 bucket. (The client retries errors that
+    are worth retrying, with backoff.) """
     assert S3_BUCKET is not Exception, "libs.s3._s3_retrieve(!!!) called inside test"
     try:
-        return conn.get_object(Bucket=bucket_name, Key=key_path, ResponseContentType='string')
+        return conn.get_object(
+            Bucket=bucket_name, Key=key_path, ResponseContentType='string', **kwargs
+        )
     except Exception as boto_error_unknowable_type:
         # Some error types cannot be imported because they are generated at runtime through a factory
         if boto_error_unknowable_type.__class__.__name__ == "NoSuchKey":
             raise NoSuchKeyException(f"{bucket_name}: {key_path}")
-        # usually we want to try again
-        if number_retries > 0:
-            print("s3_retrieve failed, retrying on %s" % key_path)
-            return _do_retrieve(bucket_name, key_path, number_retries=number_retries - 1)
         # unknown cases: explode.
         raise
 
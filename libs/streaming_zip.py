@@ -1,12 +1,27 @@
 import json
+from collections import deque
+from datetime import datetime, timedelta
+from io import BytesIO
 from multiprocessing.pool import ThreadPool
-from typing import Generator, Iterable, Tuple
-from zipfile import ZIP_STORED, ZipFile
+from tarfile import BLOCKSIZE, TarInfo
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Generator, Iterable, Optional, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
-from constants.data_stream_constants import (IMAGE_FILE, SURVEY_ANSWERS, SURVEY_TIMINGS,
-    VOICE_RECORDING)
+from django.db.models import Q, QuerySet
+
+from config.settings import CONCURRENT_NETWORK_OPS, DATA_DOWNLOAD_PREFETCH_BYTES
+from constants.data_access_api_constants import (COMPRESSION_DEFLATE, COMPRESSION_NONE,
+    COMPRESSION_ZSTD)
+from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM, ROLLUP_TIMESLICE_QUANTUM
+from constants.data_stream_constants import (CHUNKABLE_FILES, IMAGE_FILE, ROLLUP_DATA_STREAMS,
+    SURVEY_ANSWERS, SURVEY_TIMINGS, VOICE_RECORDING)
+from database.data_access_models import ChunkRegistry
 from database.study_models import Study
-from libs.s3 import s3_retrieve
+from libs.chunk_cache import chunk_cache
+from libs.file_processing.utility_functions_csvs import trim_csv_to_time_range
+from libs.file_processing.utility_functions_simple import compress
 from libs.streaming_bytes_io import StreamingBytesIO
 
 
@@ -55,22 +70,233 @@ def determine_file_name(chunk):
                             str(chunk["time_bin"]).replace(":", "_"), extension)
 
 
-def batch_retrieve_s3(chunk: dict) -> Tuple[dict, bytes]:
-    """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(
-        chunk["chunk_path"],
-        Study.objects.get(id=chunk["study_id"]),
-        raw_path=True,
-    )
+class TimeWindow:
+    """ Row level trimming of chunked data to a time range (either end may be None).  Chunks cover
+    an hour (rollup chunks cover a day), only the chunks at the ends of the time range contain rows
+    outside of it; the rows of those chunks are trimmed, all other chunks are left untouched.  Files
+    that are not chunked data are never trimmed. """
+    
+    def __init__(self, start: Optional[datetime], end: Optional[datetime]):
+        self.start = start
+        self.end = end
+        self.start_ms = None if start is None else int(start.timestamp() * 1000)
+        self.end_ms = None if end is None else int(end.timestamp() * 1000)
+    
+    def filter_chunks(self, chunks: QuerySet) -> QuerySet:
+        """ Filters by time bin, chunks that contain the start of the time range are included.
+        (Files that are not chunked data have the exact time as their time bin.) """
+        if self.start is not None:
+            start_seconds = self.start.timestamp()
+            first_time_bin = self.start - timedelta(seconds=start_seconds % CHUNK_TIMESLICE_QUANTUM)
+            first_rollup_time_bin = \
+                self.start - timedelta(seconds=start_seconds % ROLLUP_TIMESLICE_QUANTUM)
+            chunks = chunks.filter(
+                Q(time_bin__gte=self.start)
+                | Q(time_bin__gte=first_time_bin, data_type__in=CHUNKABLE_FILES)
+                | Q(time_bin__gte=first_rollup_time_bin, data_type__in=ROLLUP_DATA_STREAMS.values())
+            )
+        if self.end is not None:
+            chunks = chunks.filter(time_bin__lte=self.end)
+        return chunks
+    
+    def needs_trimming(self, chunk: dict) -> bool:
+        if chunk["data_type"] in CHUNKABLE_FILES:
+            chunk_duration = CHUNK_TIMESLICE_QUANTUM
+        elif chunk["data_type"] in ROLLUP_DATA_STREAMS.values():
+            chunk_duration = ROLLUP_TIMESLICE_QUANTUM
+        else:
+            return False
+        chunk_start = chunk["time_bin"]
+        chunk_end = chunk_start + timedelta(seconds=chunk_duration)
+        return (self.start is not None and chunk_start < self.start) or \
+            (self.end is not None and chunk_end > self.end)
+    
+    def trim(self, chunk: dict, file_contents: bytes) -> bytes:
+        if not self.needs_trimming(chunk):
+            return file_contents
+        return trim_csv_to_time_range(file_contents, self.start_ms, self.end_ms)
+
+
+# Older ChunkRegistries don't have a file size, assume this size for read-ahead purposes.
+UNKNOWN_FILE_SIZE_ESTIMATE = 4 * 1024 * 1024
+
+
+class ChunkPrefetcher:
+    """ Downloads chunks on a thread pool ahead of the consumer, and yields (chunk, file contents)
+    in the order of the chunks.  Downloads are started as long as the total size of the files that
+    have been started but not consumed is below prefetch_bytes, so memory usage is bounded no matter
+    how slowly the consumer (e.g. a researcher's download) reads.  A file is considered consumed
+    when the next one is requested.
+    
+    If provided, process is called on (chunk, file contents) on the thread pool, and its return
+    value is yielded in place of the file contents. """
+    
+    def __init__(
+        self, chunks: Iterable[dict], pool: ThreadPool, prefetch_bytes: int,
+        process: Callable[[dict, bytes], Any] = None
+    ):
+        self.chunks = chunks
+        self.pool = pool
+        self.prefetch_bytes = prefetch_bytes
+        self.process = process
+        # every chunk needs its study's encryption key, the studies are retrieved once here instead
+        # of once per file (and always on this thread, the download threads don't use the database.)
+        self.studies: Dict[int, Study] = {}
+        
+        # throughput metrics
+        self._lock = Lock()
+        self.file_count = 0
+        self.download_bytes = 0
+        self.download_seconds = 0.0  # summed across threads
+        self.wait_seconds = 0.0  # time spent waiting on downloads, as opposed to the consumer
+    
+    def get_study(self, study_id: int) -> Study:
+        if study_id not in self.studies:
+            self.studies[study_id] = Study.objects.get(id=study_id)
+        return self.studies[study_id]
+    
+    def retrieve(self, chunk: dict, study: Study) -> Tuple[dict, Any]:
+        t_start = perf_counter()
+        file_contents = chunk_cache.retrieve(chunk, study)
+        with self._lock:
+            self.download_seconds += perf_counter() - t_start
+            self.download_bytes += len(file_contents)
+        if self.process is not None:
+            return chunk, self.process(chunk, file_contents)
+        return chunk, file_contents
+    
+    def __iter__(self) -> Generator[Tuple[dict, Any], None, None]:
+        in_flight = deque()  # (reserved byte count, AsyncResult)
+        reserved_bytes = 0
+        chunks = iter(self.chunks)
+        chunks_remaining = True
+        
+        while True:
+            # there is always at least one download in flight, even if it exceeds prefetch_bytes
+            while chunks_remaining and (not in_flight or reserved_bytes < self.prefetch_bytes):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    chunks_remaining = False
+                    break
+                size = chunk.get("file_size") or UNKNOWN_FILE_SIZE_ESTIMATE
+                study = self.get_study(chunk["study_id"])
+                in_flight.append((size, self.pool.apply_async(self.retrieve, (chunk, study))))
+                reserved_bytes += size
+            
+            if not in_flight:
+                return
+            
+            size, result = in_flight.popleft()
+            t_start = perf_counter()
+            chunk_and_contents = result.get()
+            self.wait_seconds += perf_counter() - t_start
+            self.file_count += 1
+            yield chunk_and_contents
+            reserved_bytes -= size
+    
+    def print_summary(self, total_seconds: float):
+        per_download = self.download_bytes / self.download_seconds if self.download_seconds else 0
+        print(
+            f"data download: {self.file_count} files, {self.download_bytes} bytes in "
+            f"{total_seconds:.1f} seconds, {self.download_bytes / (total_seconds or 1):.0f} bytes/s "
+            f"overall, {per_download:.0f} bytes/s per download, "
+            f"{self.wait_seconds:.1f} seconds waiting on downloads."
+        )
+
+
+class ZipArchiveWriter:
+    """ Writes a zip file to a StreamingBytesIO, one entry at a time.  Entries are prepared (i.e.
+    compressed and checksummed) independently of the zip file, so that can happen on a thread pool,
+    then they are appended to the zip file in order. """
+    content_type = "application/zip"
+    file_extension = "zip"
+    
+    def __init__(self, compression: int = ZIP_STORED):
+        self.compression = compression
+        self.output = StreamingBytesIO()
+        self.zip_file = ZipFile(self.output, mode="w", compression=compression, allowZip64=True)
+    
+    def prepare(self, file_name: str, file_contents: bytes) -> Tuple[ZipInfo, bytes]:
+        """ Returns the ZipInfo and the bytes of a zip entry (a local file header followed by the
+        possibly-compressed file contents).  Thread-safe. """
+        entry = BytesIO()
+        with ZipFile(entry, mode="w", compression=self.compression, allowZip64=True) as zip_file:
+            zip_file.writestr(file_name, file_contents)
+            # the entry is everything written before the zip file is closed
+            return zip_file.getinfo(file_name), entry.getvalue()
+    
+    def write(self, prepared_entry: Tuple[ZipInfo, bytes]) -> bytes:
+        """ Appends a prepared entry to the zip file, returns the new bytes of the zip file. """
+        zip_info, entry = prepared_entry
+        zip_info.header_offset = self.output.tell()
+        self.output.write(entry)
+        # the zip file needs to know about the entry to write the central directory when it is
+        # closed, this is the bookkeeping that ZipFile.writestr does.
+        self.zip_file.filelist.append(zip_info)
+        self.zip_file.NameToInfo[zip_info.filename] = zip_info
+        self.zip_file.start_dir = self.output.tell()
+        return self.flush()
+    
+    def close(self) -> bytes:
+        self.zip_file.close()
+        return self.flush()
+    
+    def flush(self) -> bytes:
+        data = self.output.getvalue()
+        self.output.empty()
+        return data
+
+
+class TarZstdArchiveWriter:
+    """ Writes a zstd-compressed tar file.  Each entry is compressed as a separate zstd frame, the
+    concatenation of zstd frames is a valid zstd stream, so entries can be compressed on a thread
+    pool and then concatenated in order. """
+    content_type = "application/zstd"
+    file_extension = "tar.zst"
+    
+    def prepare(self, file_name: str, file_contents: bytes) -> bytes:
+        """ Returns a compressed tar entry (a header followed by the file contents, padded to the
+        tar block size).  Thread-safe. """
+        tar_info = TarInfo(file_name)
+        tar_info.size = len(file_contents)
+        tar_info.mtime = int(time())
+        padding = b"\0" * (-len(file_contents) % BLOCKSIZE)
+        return compress(tar_info.tobuf() + file_contents + padding)
+    
+    def write(self, prepared_entry: bytes) -> bytes:
+        return prepared_entry
+    
+    def close(self) -> bytes:
+        # a tar file ends with two empty blocks
+        return compress(b"\0" * BLOCKSIZE * 2)
+
+
+def get_archive_writer(compression: str):
+    if compression == COMPRESSION_ZSTD:
+        return TarZstdArchiveWriter()
+    if compression == COMPRESSION_DEFLATE:
+        return ZipArchiveWriter(ZIP_DEFLATED)
+    return ZipArchiveWriter(ZIP_STORED)
 
 
 class ZipGenerator:
     """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
     data. This is a generator, advantage is it starts returning data (file by file, but wrapped
     in zip compression) almost immediately.
-    NOTE: does not compress! """
+    By default the zip file is not compressed, compression can be COMPRESSION_DEFLATE (a compressed
+    zip file) or COMPRESSION_ZSTD (a zstd-compressed tar file).  Files are compressed on the thread
+    pool, as they are downloaded.
+    If sync_cursor is provided the files_list must be in sync cursor order (and include the
+    last_updated field), the sync cursor of the last file is added to the zip file.
+    If time_window is provided the chunks at its ends are trimmed to the rows within it, trimmed
+    files are left out of the registry. """
     
-    def __init__(self, files_list: Iterable[str], construct_registry: bool, threads: int = 3):
+    def __init__(
+        self, files_list: Iterable[dict], construct_registry: bool,
+        threads: int = CONCURRENT_NETWORK_OPS, prefetch_bytes: int = DATA_DOWNLOAD_PREFETCH_BYTES,
+        compression: str = COMPRESSION_NONE, sync_cursor: str = None,
+        time_window: TimeWindow = None,
+    ):
         self.construct_registry = construct_registry
         self.files_list = files_list
         self.processed_files = set()
@@ -78,53 +304,88 @@ class ZipGenerator:
         self.file_registry = {}
         self.total_bytes = 0
         self.threads = threads
+        self.prefetch_bytes = prefetch_bytes
+        self.archive = get_archive_writer(compression)
+        self.sync_cursor = sync_cursor
+        self.time_window = time_window
+        chunk_cache.refresh_purged_participants()
+    
+    @property
+    def content_type(self) -> str:
+        return self.archive.content_type
+    
+    @property
+    def file_name(self) -> str:
+        return "data." + self.archive.file_extension
+    
+    def prepare_file(self, chunk: dict, file_contents: bytes):
+        """ Runs on the thread pool. """
+        if self.time_window is not None:
+            file_contents = self.time_window.trim(chunk, file_contents)
+        return self.archive.prepare(determine_file_name(chunk), file_contents)
+    
+    def get_entries(self, chunk: dict, prepared_entry: Any) -> Iterable[Any]:
+        """ Returns the prepared archive entries to write for a chunk, in order, given the output of
+        prepare_file for it. """
+        file_name = determine_file_name(chunk)
+        if file_name in self.processed_files:
+            self.duplicate_files.add((file_name, chunk['chunk_path'], ))
+            return ()
+        self.processed_files.add(file_name)
+        return (prepared_entry,)
+    
+    def get_final_entries(self) -> Iterable[Any]:
+        """ Returns any prepared archive entries to write after all chunks. """
+        return ()
     
     def __iter__(self) -> Generator[bytes, None, None]:
+        t_start = perf_counter()
         pool = ThreadPool(self.threads)
-        zip_output = StreamingBytesIO()
-        zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+        prefetcher = ChunkPrefetcher(
+            self.files_list, pool, self.prefetch_bytes, process=self.prepare_file
+        )
         try:
-            # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-            # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-            # is the size of the batches that are handed to the pool. We always want to add the next
-            # file to retrieve to the pool asap, so we want a chunk size of 1.
-            # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-            chunks_and_content = pool.imap_unordered(batch_retrieve_s3, self.files_list, chunksize=1)
-            
-            for chunk, file_contents in chunks_and_content:
-                if self.construct_registry:
+            # the prefetcher yields tuples of the chunk and the prepared archive entry of the file,
+            # in the order of files_list.
+            for chunk, processed_file in prefetcher:
+                # the hash of a trimmed file is not the chunk hash
+                if self.construct_registry and \
+                        (self.time_window is None or not self.time_window.needs_trimming(chunk)):
                     self.file_registry[chunk['chunk_path']] = chunk["chunk_hash"]
+                if self.sync_cursor is not None:
+                    self.sync_cursor = ChunkRegistry.encode_sync_cursor(
+                        chunk["last_updated"], chunk["pk"]
+                    )
                 
-                file_name = determine_file_name(chunk)
-                if file_name in self.processed_files:
-                    self.duplicate_files.add((file_name, chunk['chunk_path'], ))
-                    continue
-                self.processed_files.add(file_name)
-                
-                zip_input.writestr(file_name, file_contents)
-                
-                # These can be large, and we don't want them sticking around in memory as we wait
-                # for the yield, and they could be many megabytes and it is about to be duplicated.
-                del file_contents, chunk
-                
-                # write data to your stream
-                one_file_in_a_zip = zip_output.getvalue()
+                for prepared_entry in self.get_entries(chunk, processed_file):
+                    one_file_in_a_zip = self.archive.write(prepared_entry)
+                    # These can be large, we don't want them sticking around in memory as we wait
+                    # for the yield, they could be many megabytes and are about to be duplicated.
+                    del prepared_entry
+                    
+                    self.total_bytes += len(one_file_in_a_zip)
+                    yield one_file_in_a_zip
+                    del one_file_in_a_zip
+                del processed_file, chunk
+            
+            for prepared_entry in self.get_final_entries():
+                one_file_in_a_zip = self.archive.write(prepared_entry)
                 self.total_bytes += len(one_file_in_a_zip)
                 yield one_file_in_a_zip
-                # print "%s: %sK, %sM" % (random_id, total_bytes / 1024, total_bytes / 1024 / 1024)
-
-                del one_file_in_a_zip
-                zip_output.empty()
             
             # construct the registry file
             if self.construct_registry:
-                zip_input.writestr("registry", json.dumps(self.file_registry))
-                yield zip_output.getvalue()
-                zip_output.empty()
+                registry = json.dumps(self.file_registry).encode()
+                yield self.archive.write(self.archive.prepare("registry", registry))
+            
+            # the sync cursor goes in the zip file last, it is only valid for a complete download.
+            if self.sync_cursor is not None:
+                sync_cursor = self.sync_cursor.encode()
+                yield self.archive.write(self.archive.prepare("sync_cursor", sync_cursor))
             
             # close, then yield all remaining data in the zip.
-            zip_input.close()
-            yield zip_output.getvalue()
+            yield self.archive.close()
+            prefetcher.print_summary(perf_counter() - t_start)
         
         except DummyError:
             # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterable, Iterator, Optional
+
+from config.settings import TABLEAU_RESULT_CACHE_MAX_BYTES
+
+
+class TableauResultCache:
+    """ A least recently used, in-memory cache of complete Tableau API responses, per process.
+    
+    Keys contain the version stamp of the study's SummaryStatisticDaily rows (see
+    get_summary_statistics_version), which changes whenever data processing or forest create,
+    update, or delete a row, so entries never need to be invalidated: after a change the new key
+    misses, and outdated entries age out of the cache.  Responses larger than max_entry_bytes are
+    not cached.  A max_bytes of 0 disables the cache. """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.size = 0
+        self._lock = Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            contents = self.entries.get(key)
+            if contents is not None:
+                self.entries.move_to_end(key)  # mark as recently used
+            return contents
+    
+    def put(self, key: str, contents: bytes):
+        if not self.enabled or len(contents) > self.max_entry_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = contents
+            self.size += len(contents)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+    
+    def stream_and_put(self, key: str, stream: Iterable[bytes]) -> Iterator[bytes]:
+        """ Passes through a streamed response, caches it if it is complete and small enough. """
+        if not self.enabled:
+            yield from stream
+            return
+        
+        pieces = []
+        size = 0
+        for piece in stream:
+            yield piece
+            if pieces is not None:
+                size += len(piece)
+                if size > self.max_entry_bytes:
+                    pieces = None  # too large, stop collecting
+                else:
+                    pieces.append(piece)
+        if pieces is not None:
+            self.put(key, b"".join(pieces))
+    
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+
+tableau_result_cache = TableauResultCache(TABLEAU_RESULT_CACHE_MAX_BYTES)
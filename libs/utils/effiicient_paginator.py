@@ -1,8 +1,11 @@
+from itertools import islice
 from typing import List
 
 from django.db.models import QuerySet
 from orjson import dumps as orjson_dumps
 
+from libs.streaming_zip import determine_file_name
+
 
 class EfficientQueryPaginator:
     """ Contains the base logic functions that as-efficiently-as-possible, preferring memory
@@ -48,7 +51,7 @@ class EfficientQueryPaginator:
                 for result in self.value_query.filter(pk__in=pks):
                     yield result
                 pks = []
-    
+        
         # after iteration, any remaining pks
         if pks:
             for result in self.value_query.filter(pk__in=pks):
@@ -78,27 +81,70 @@ class EfficientQueryPaginator:
         yield b"]"
 
 
-class TableauApiPaginator(EfficientQueryPaginator):
-    """ This class handles a compatibility issue and some weird python behavior. """
+class StreamingQueryPaginator:
+    """ Streams the results of an ordered query in a single pass: the query is run once, over a
+    server-side cursor (on postgres), so there is no pk query, there are no pk__in queries, the
+    ordering of the query is kept, and memory use is bounded by the page size.  Rows are read as
+    values_list tuples; output_names are the json keys of the fields, in the same order. """
     
-    def stream_orjson_paginate(self):
-        """ we need to rename the patient_id field, because we can't annotate our way out of this
-        one due to a Django limitation. """
+    def __init__(
+        self,
+        filtered_query: QuerySet,
+        page_size: int,
+        values_list: List[str],
+        output_names: List[str] = None,
+        limit: int = 0,
+    ):
+        if output_names is not None and len(output_names) != len(values_list):
+            raise Exception("output_names must match values_list")
         
-        if "patient_id" in self.values:
-            yield b"["
-            for i, page in enumerate(self.paginate()):
-                if i != 0:
-                    yield b","
-                for values_dict in page:
-                    values_dict["participant_id"] = values_dict.pop("patient_id")
-                yield orjson_dumps(page)[1:-1]
-            yield b"]"
-        else:
-            # For some reason we can't call the super implementation, so I have copy-pasted.
-            yield b"["
-            for i, page in enumerate(self.paginate()):
-                if i != 0:
-                    yield b","
-                yield orjson_dumps(page)[1:-1]
-            yield b"]"
+        self.page_size = page_size
+        self.output_names = output_names or values_list
+        self.value_query = filtered_query.values_list(*values_list)
+        if limit:
+            self.value_query = self.value_query[:limit]
+    
+    def paginate(self):
+        """ Yields lists of up to page_size rows. """
+        rows = self.value_query.iterator(chunk_size=self.page_size)
+        while True:
+            page = list(islice(rows, self.page_size))
+            if not page:
+                return
+            yield page
+    
+    def stream_orjson_paginate(self):
+        """ streams a page by page orjson'd bytes of json list elements, each row is an object """
+        names = self.output_names
+        yield b"["
+        for i, page in enumerate(self.paginate()):
+            if i != 0:
+                yield b","
+            # (dict(zip()) is how django builds values() dicts, orjson serializes the page at once)
+            yield orjson_dumps([dict(zip(names, row)) for row in page])[1:-1]
+        yield b"]"
+
+
+class DataManifestPaginator(EfficientQueryPaginator):
+    """ Streams the data access manifest, values must be CHUNK_FIELDS.  Each entry gets the name of
+    the file as it is in a data download, and only the fields a client needs are kept. """
+    
+    def stream_orjson_paginate(self):
+        yield b"["
+        for i, page in enumerate(self.paginate()):
+            if i != 0:
+                yield b","
+            yield orjson_dumps([
+                {
+                    "chunk_id": values_dict["pk"],
+                    "file_name": determine_file_name(values_dict),
+                    "chunk_path": values_dict["chunk_path"],
+                    "chunk_hash": values_dict["chunk_hash"],
+                    "file_size": values_dict["file_size"],
+                    "data_type": values_dict["data_type"],
+                    "participant_id": values_dict["participant__patient_id"],
+                    "time_bin": values_dict["time_bin"],
+                }
+                for values_dict in page
+            ])[1:-1]
+        yield b"]"
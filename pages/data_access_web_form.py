@@ -5,7 +5,7 @@ from markupsafe import Markup
 
 from authentication.admin_authentication import (authenticate_researcher_login,
     get_researcher_allowed_studies_as_query_set)
-from constants.data_stream_constants import ALL_DATA_STREAMS
+from constants.data_stream_constants import DATA_ACCESS_STREAMS
 from libs.internal_types import ResearcherRequest
 
 
@@ -17,7 +17,7 @@ def data_api_web_form_page(request: ResearcherRequest):
         request,
         "data_api_web_form.html",
         context=dict(
-            ALL_DATA_STREAMS=ALL_DATA_STREAMS,
+            ALL_DATA_STREAMS=DATA_ACCESS_STREAMS,
             users_by_study=participants_by_study(request),
         )
     )
@@ -0,0 +1,106 @@
+""" Compares the query plans and run times of data access api ChunkRegistry queries with and without
+the composite ChunkRegistry indexes, over a synthetic ChunkRegistry of several million rows.  The
+rows are inserted, and the indexes dropped, inside of a transaction that is rolled back, so the
+database is left as it was; run it on a postgres development database, in a django shell. """
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from database.data_access_models import ChunkRegistry
+from database.study_models import Study
+from database.user_models_participant import Participant
+
+
+STUDIES = 20
+PARTICIPANTS_PER_STUDY = 50
+DATA_TYPES = (
+    "accelerometer", "gps", "gyro", "magnetometer", "power_state", "proximity", "reachability",
+    "wifi", "bluetooth", "calls",
+)
+HOURS = 24 * 30  # one chunk per participant per data type per hour, 7.2 million rows in total
+COMPOSITE_INDEXES = (
+    "chunk_study_type_time", "chunk_participant_type_time", "chunk_study_last_updated"
+)
+
+
+class Rollback(Exception): pass
+
+
+def create_synthetic_chunk_registries() -> Study:
+    studies = [
+        Study.create_with_object_id(name=f"benchmark study {i}", encryption_key="a" * 32)
+        for i in range(STUDIES)
+    ]
+    for study in studies:
+        Participant.objects.bulk_create(
+            Participant(study=study, patient_id=f"bm{study.pk}_{i}", os_type="ANDROID", password="")
+            for i in range(PARTICIPANTS_PER_STUDY)
+        )
+    # generating the rows in the database is far faster than sending them.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO database_chunkregistry (created_on, last_updated, is_chunkable, chunk_path,
+                chunk_hash, data_type, time_bin, file_size, study_id, participant_id)
+            SELECT now(), now() - hour * interval '1 hour', true,
+                'bm/' || participant.id || '/' || data_type || '/' || hour, '', data_type,
+                '2023-01-01'::timestamptz + hour * interval '1 hour', 1000, participant.study_id,
+                participant.id
+            FROM database_participant participant,
+                unnest(%s::text[]) data_type,
+                generate_series(0, {HOURS - 1}) hour
+            WHERE participant.study_id IN %s
+            """,
+            [list(DATA_TYPES), tuple(study.pk for study in studies)],
+        )
+        cursor.execute("ANALYZE database_chunkregistry")
+    return studies[0]
+
+
+def benchmark_queries(name: str, study: Study):
+    participant_ids = list(study.participants.values_list("pk", flat=True)[:3])
+    patient_ids = list(study.participants.values_list("patient_id", flat=True)[:3])
+    start = datetime(2023, 1, 10, tzinfo=timezone.utc)
+    end = datetime(2023, 1, 12, tzinfo=timezone.utc)
+    queries = {
+        "study, data types, time range": ChunkRegistry.get_chunks_time_range(
+            study.pk, data_types=["gps", "wifi"], start=start, end=end
+        ),
+        "participant pks, data types, time range": ChunkRegistry.get_chunks_time_range(
+            study.pk, participant_ids=participant_ids, data_types=["gps"], start=start, end=end
+        ),
+        "patient ids (join), data types, time range": ChunkRegistry.get_chunks_time_range(
+            study.pk, user_ids=patient_ids, data_types=["gps"], start=start, end=end
+        ),
+        "updated users for study": ChunkRegistry.get_updated_users_for_study(
+            study, timezone.now() - timedelta(hours=6)
+        ),
+    }
+    print(f"\n{name}:")
+    for query_name, query in queries.items():
+        t_start = perf_counter()
+        row_count = len(list(query.values_list("pk")))
+        seconds = perf_counter() - t_start
+        print(f"  {query_name}: {row_count} rows in {seconds * 1000:.1f}ms")
+        # the scan nodes show which indexes, if any, are used
+        for line in query.explain().splitlines():
+            if "Scan" in line:
+                print(f"    {line.strip()}")
+
+
+try:
+    with transaction.atomic():
+        t_start = perf_counter()
+        benchmark_study = create_synthetic_chunk_registries()
+        print(f"created {ChunkRegistry.objects.count()} rows in {perf_counter() - t_start:.1f}s")
+        benchmark_queries("with composite indexes", benchmark_study)
+        with connection.cursor() as cursor:
+            for index_name in COMPOSITE_INDEXES:
+                cursor.execute(f"DROP INDEX {index_name}")
+            cursor.execute("ANALYZE database_chunkregistry")
+        benchmark_queries("without composite indexes", benchmark_study)
+        raise Rollback()
+except Rollback:
+    pass
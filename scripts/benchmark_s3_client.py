@@ -0,0 +1,103 @@
+""" Compares S3 throughput and connection reuse of a default boto3 client against
+libs.s3.get_s3_client when many threads share one client, the way data processing and data
+downloads use it.  Runs against a local S3
+stand-in (an in-memory http server with a fixed per-request latency), so no AWS access is needed
+and the numbers are repeatable.  Run it in a django shell. """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Value
+from multiprocessing.pool import ThreadPool
+from time import perf_counter, sleep
+
+import boto3
+from botocore.client import Config
+
+from libs.s3 import get_s3_client, S3OperationStats
+
+
+THREADS = 32
+FILE_COUNT = 500
+FILE_SIZE = 256 * 1024
+LATENCY_SECONDS = 0.05
+BUCKET = "benchmark"
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    """ Just enough of put_object and get_object (path style urls) for the benchmark. """
+    protocol_version = "HTTP/1.1"  # keep-alive, like S3
+    files = {}
+    connections = Value("i", 0)  # a handler is created for every new connection
+    
+    def setup(self):
+        with self.connections.get_lock():
+            self.connections.value += 1
+        super().setup()
+    
+    def do_PUT(self):
+        sleep(LATENCY_SECONDS)
+        self.files[self.path.split("?")[0]] = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("ETag", '"etag"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+    
+    def do_GET(self):
+        sleep(LATENCY_SECONDS)
+        body = self.files[self.path.split("?")[0]]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+def run_benchmark(name: str, client):
+    data = b"x" * FILE_SIZE
+    LocalS3Handler.connections.value = 0
+    
+    def upload(i: int):
+        client.put_object(Bucket=BUCKET, Key=f"file_{i}", Body=data)
+    
+    def download(i: int):
+        return len(client.get_object(Bucket=BUCKET, Key=f"file_{i}")["Body"].read())
+    
+    with ThreadPool(THREADS) as pool:
+        for operation in (upload, download):
+            t_start = perf_counter()
+            pool.map(operation, range(FILE_COUNT))
+            seconds = perf_counter() - t_start
+            print(
+                f"{name} {operation.__name__}: {FILE_COUNT / seconds:.1f} files/s, "
+                f"{FILE_COUNT * FILE_SIZE / seconds / 1024 / 1024:.1f} MiB/s"
+            )
+    # connections beyond the pool size are opened and discarded on every request, with S3 that
+    # means a TLS handshake for every request.
+    print(f"{name}: {LocalS3Handler.connections.value} connections opened")
+
+
+# the server runs in its own process so that it doesn't compete with the clients for the GIL.
+server = ThreadingHTTPServer(("127.0.0.1", 0), LocalS3Handler)
+server_process = Process(target=server.serve_forever, daemon=True)
+server_process.start()
+endpoint_url = f"http://127.0.0.1:{server.server_address[1]}"
+print(f"{THREADS} threads, {FILE_COUNT} files of {FILE_SIZE // 1024}KiB, {LATENCY_SECONDS}s latency")
+
+run_benchmark(
+    "default client",
+    boto3.client(
+        "s3", endpoint_url=endpoint_url, region_name="us-east-1", aws_access_key_id="x",
+        aws_secret_access_key="x", config=Config(s3={"addressing_style": "path"}),
+    ),
+)
+
+stats = S3OperationStats()
+run_benchmark(
+    "get_s3_client",
+    get_s3_client(
+        max_pool_connections=THREADS, stats=stats, endpoint_url=endpoint_url,
+        aws_access_key_id="x", aws_secret_access_key="x",
+    ),
+)
+stats.print_summary()
+server_process.terminate()
@@ -0,0 +1,51 @@
+from multiprocessing.pool import ThreadPool
+
+from django.utils import timezone
+
+from config.settings import CONCURRENT_NETWORK_OPS
+from constants.data_stream_constants import ROLLUP_DATA_STREAMS
+from database.user_models_participant import Participant
+from libs.chunk_cache import chunk_cache
+from libs.file_processing.file_processing_core import update_rollups
+from libs.file_processing.rollups import summarize_minutes
+
+
+# Creates the rollup chunks of data that was processed before rollups existed.  Data processing
+# keeps rollups up to date as new data arrives, this only needs to run once; running it again
+# recomputes the same rollups.  Hourly chunks are summarized in batches, so memory use is bounded.
+HOURS_PER_BATCH = 24 * 7
+
+filters = {}
+
+# stick study object ids here to process particular studies
+study_object_ids = []
+if study_object_ids:
+    filters["study__object_id__in"] = study_object_ids
+
+participants = Participant.objects.filter(
+    chunk_registries__data_type__in=ROLLUP_DATA_STREAMS, **filters
+).distinct().select_related("study")
+
+print("start:", timezone.now())
+chunk_cache.refresh_purged_participants()
+pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+for participant in participants:
+    print(participant.patient_id)
+    study_object_id = participant.study.object_id
+    chunks = participant.chunk_registries.filter(data_type__in=ROLLUP_DATA_STREAMS) \
+        .order_by("data_type", "time_bin").values("chunk_path", "chunk_hash", "file_size")
+    
+    def summarize_chunk(chunk: dict):
+        contents = chunk_cache.retrieve(chunk, study_object_id)
+        return chunk["chunk_path"], summarize_minutes(contents)
+    
+    minute_rollups = {}
+    for chunk_path, rollup_rows in pool.imap(summarize_chunk, list(chunks)):
+        minute_rollups[chunk_path] = rollup_rows
+        if len(minute_rollups) >= HOURS_PER_BATCH:
+            update_rollups(participant, minute_rollups, pool)
+            minute_rollups = {}
+    update_rollups(participant, minute_rollups, pool)
+
+pool.close()
+print("end:", timezone.now())
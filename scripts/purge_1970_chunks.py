@@ -3,7 +3,7 @@ from datetime import datetime
 from dateutil.tz import UTC
 
 from constants.data_stream_constants import AMBIENT_AUDIO, IMAGE_FILE, VOICE_RECORDING
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, ChunkTimeBinExtent
 
 
 # Onnela Lab, the first deployment, went live after this date, and it may be early by a whole year.
@@ -48,5 +48,7 @@ if bad_chunks:
     if y_n.lower() == "y":
         print("success case")
         ChunkRegistry.objects.filter(pk__in=[chunk.pk for chunk in bad_chunks]).delete()
+        for participant in {chunk.participant for chunk in bad_chunks}:
+            ChunkTimeBinExtent.recalculate(participant)
 else:
     print("No obviously corrupted chunk registries were found.")
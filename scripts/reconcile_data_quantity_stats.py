@@ -0,0 +1,3 @@
+# this is a stub for the weekly reconciliation task, all the logic is in libs.file_processing.data_qty_stats
+from libs.file_processing.data_qty_stats import reconcile_all_data_quantity_stats
+reconcile_all_data_quantity_stats()
@@ -2,10 +2,13 @@ from datetime import datetime, timedelta
 
 from config.settings import FILE_PROCESS_PAGE_SIZE
 from constants.celery_constants import DATA_PROCESSING_CELERY_QUEUE
+from constants.data_processing_constants import DATA_PROCESSING_TASK_SECONDS
 from database.user_models_participant import Participant
 from libs.celery_control import (FalseCeleryApp, get_processing_active_job_ids,
     processing_celery_app, safe_apply_async)
-from libs.file_processing.file_processing_core import do_process_user_file_chunks
+from libs.file_processing.processing_pipeline import ParticipantProcessingPipeline
+from libs.file_processing.processing_scheduler import (get_processing_work_units,
+    print_processing_backlog)
 from libs.sentry import make_error_sentry, SentryTypes
 
 
@@ -28,18 +31,20 @@ def create_file_processing_tasks():
     expiry = (datetime.utcnow() + timedelta(minutes=5)).replace(second=30, microsecond=0)
     
     with make_error_sentry(sentry_type=SentryTypes.data_processing):
-        participant_set = set(
-            Participant.objects.filter(files_to_process__isnull=False)
-                .distinct()
-                # .order_by("id")  # For debugging, forces overlap conflicts.
-                .order_by("?")     # don't want a single user blocking everyone because they are at the front.
-                .values_list("id", flat=True)
-        )
+        # Tasks are queued in priority order, and workers take the next task from the shared queue
+        # as soon as they are idle.  Each task is a bounded unit of work (see
+        # DATA_PROCESSING_TASK_SECONDS) so the queue drains evenly, large backlogs are picked up
+        # again on subsequent runs.
+        work_units = get_processing_work_units()
+        print_processing_backlog(work_units)
         
         # sometimes celery just fails to exist, set should be redundant.
         active_set = set(get_processing_active_job_ids())
         
-        participants_to_process = participant_set - active_set
+        participants_to_process = [
+            work_unit.participant_id for work_unit in work_units
+            if work_unit.participant_id not in active_set
+        ]
         print("Queueing these participants:", ",".join(str(p) for p in participants_to_process))
         
         for participant_id in participants_to_process:
@@ -66,39 +71,17 @@ def celery_process_file_chunks(participant_id):
     # this probably has something to do with the fact that celery forks, so possibly picking
     # a different mode would impact this.  Or we can just exit the python process.
     try:
-        time_start = datetime.now()
         participant = Participant.objects.get(id=participant_id)
-        
-        number_bad_files = 0
         error_sentry = make_error_sentry(
             sentry_type=SentryTypes.data_processing, tags={'user_id': participant.patient_id}
         )
         print(f"processing files for {participant.patient_id}")
         
-        while True:
-            previous_number_bad_files = number_bad_files
-            starting_length = participant.files_to_process.exclude(deleted=True).count()
-            
-            print(f"{datetime.now()} processing {participant.patient_id}, {starting_length} files remaining")
-            number_bad_files += do_process_user_file_chunks(
-                page_size=FILE_PROCESS_PAGE_SIZE,
-                error_handler=error_sentry,
-                position=number_bad_files,
-                participant=participant,
-            )
-            # If no files were processed, quit processing
-            if participant.files_to_process.exclude(deleted=True).count() == starting_length:
-                if previous_number_bad_files == number_bad_files:
-                    # 2 Cases:
-                    #   1) every file broke, blow up. (would cause infinite loop otherwise).
-                    #   2) no new files.
-                    break
-                else:
-                    continue
-            
-            # put maximum time limit per user
-            if (time_start - datetime.now()).total_seconds() > 60*60*3:
-                break
+        # the pipeline keeps downloads, parsing, and uploads running concurrently for the whole
+        # run.  The time limit makes this a bounded unit of work, any remaining files are queued
+        # again by create_file_processing_tasks.
+        pipeline = ParticipantProcessingPipeline(participant, error_sentry, FILE_PROCESS_PAGE_SIZE)
+        pipeline.run(time_limit_seconds=DATA_PROCESSING_TASK_SECONDS)
     except Exception as e:
         # raise the exception if not running in celery.
         if processing_celery_app is FalseCeleryApp:
@@ -7,7 +7,7 @@ from multiprocessing.pool import ThreadPool
 from os import makedirs
 from os.path import dirname, exists as file_exists, join as path_join
 from time import sleep
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 from dateutil.tz import UTC
 from django.db import transaction
@@ -15,6 +15,7 @@ from django.db.models import Sum
 from django.utils import timezone
 from pkg_resources import get_distribution
 
+from config.settings import CONCURRENT_NETWORK_OPS
 from constants.celery_constants import FOREST_QUEUE
 from constants.data_access_api_constants import CHUNK_FIELDS
 from constants.forest_constants import (CLEANUP_ERROR as CLN_ERR, ForestFiles, ForestTaskStatus,
@@ -24,12 +25,12 @@ from database.data_access_models import ChunkRegistry
 from database.tableau_api_models import ForestTask, SummaryStatisticDaily
 from database.user_models_participant import Participant
 from libs.celery_control import forest_celery_app, safe_apply_async
+from libs.chunk_cache import chunk_cache
 from libs.copy_study import format_study
 from libs.internal_types import ChunkRegistryQuerySet
 from libs.intervention_utils import intervention_survey_data
-from libs.s3 import s3_retrieve
 from libs.sentry import make_error_sentry, SentryTypes
-from libs.streaming_zip import determine_file_name
+from libs.streaming_zip import determine_file_name, TimeWindow
 from libs.utils.date_utils import get_timezone_shortcode
 
 from forest.jasmine.traj2stats import gps_stats_main
@@ -132,10 +133,9 @@ def celery_run_forest(forest_task_id):
     # ChunkRegistry time_bin hourly chunks are in UTC, and only have hourly datapoints for all
     # automated data, but manually entered data is more specific with minutes, seconds, etc.  We
     # want our query for source data to use the study's timezone such that starts of days align to
-    # local midnight and end-of-day to 11:59.59pm. Weird fractional timezones will be noninclusive
-    # of their first hour of data between midnight and midnight + 1 hour, except for manually
-    # entered data streams which will instead align to the calendar date in the study timezone. Any
-    # such "missing" fraction of an hour is instead included at the end of the previous day.
+    # local midnight and end-of-day to 11:59.59pm. In weird fractional timezones the hourly chunks
+    # that span local midnight are trimmed to the rows within the time range (see download_data),
+    # manually entered data streams align to the calendar date in the study timezone.
     starttime_midnight = datetime.combine(task.data_date_start, MIN_TIME, task.participant.study.timezone)
     endtime_11_59pm = datetime.combine(task.data_date_end, MAX_TIME, task.participant.study.timezone)
     log("starttime_midnight: ", starttime_midnight.isoformat())
@@ -194,19 +194,19 @@ def run_forest(forest_task: ForestTask):
 
 
 def download_data(forest_task: ForestTask, start: datetime, end: datetime):
-    chunks = ChunkRegistry.objects.filter(
+    # chunks that contain the start or end of the time range are trimmed to the rows within it.
+    time_window = TimeWindow(start, end)
+    chunks = time_window.filter_chunks(ChunkRegistry.objects.filter(
         participant=forest_task.participant,
-        time_bin__gte=start,
-        time_bin__lte=end,
         data_type__in=ForestFiles.lookup(forest_task.forest_tree)
-    )
+    ))
     file_size = chunks.aggregate(Sum('file_size')).get('file_size__sum')
     if file_size is None:
         raise NoSentryException(NO_DATA_ERROR)
     forest_task.update_only(total_file_size=file_size)
     
     # Download data
-    download_data_files(forest_task, chunks)
+    download_data_files(forest_task, chunks, time_window)
     forest_task.update_only(process_download_end_time=timezone.now())
     log("task.process_download_end_time:", forest_task.process_download_end_time.isoformat())
     
@@ -282,29 +282,39 @@ def clean_up_files(forest_task: ForestTask):
     )
 
 
-def download_data_files(task: ForestTask, chunks: ChunkRegistryQuerySet) -> None:
-    """ Download only the files needed for the forest task. """
+def download_data_files(
+    task: ForestTask, chunks: ChunkRegistryQuerySet, time_window: TimeWindow = None
+) -> None:
+    """ Download only the files needed for the forest task.  Files that are in the chunk cache
+    (e.g. from an earlier task on the same participant's data) are hard linked into the task's
+    input folder, which pins them in the cache until clean_up_files; only the missing files are
+    downloaded, in parallel. """
     ensure_folders_exist(task)
+    chunk_cache.refresh_purged_participants()
     # this is an iterable, this is intentional, retain it.
     params = (
-        (task, chunk) for chunk in chunks.values("study__object_id", *CHUNK_FIELDS)
+        (task, chunk, time_window) for chunk in chunks.values("study__object_id", *CHUNK_FIELDS)
     )
     # and run!
-    with ThreadPool(4) as pool:
+    with ThreadPool(CONCURRENT_NETWORK_OPS) as pool:
         for _ in pool.imap_unordered(func=batch_create_file, iterable=params):
             pass
+    chunk_cache.print_summary()
 
 
-def batch_create_file(task_and_chunk_tuple: Tuple[ForestTask, Dict]):
+def batch_create_file(task_and_chunk_tuple: Tuple[ForestTask, Dict, Optional[TimeWindow]]):
     """ Wrapper for basic file download operations so that it can be run in a ThreadPool. """
-    # weird unpack of variables, do s3_retrieve.
-    forest_task, chunk = task_and_chunk_tuple
-    contents = s3_retrieve(chunk["chunk_path"], chunk["study__object_id"], raw_path=True)
+    # weird unpack of variables, retrieve the file (through the chunk cache).
+    forest_task, chunk, time_window = task_and_chunk_tuple
     # file ops, sometimes we have to add folder structure (surveys)
     file_name = path_join(forest_task.data_input_path, determine_file_name(chunk))
     makedirs(dirname(file_name), exist_ok=True)
-    with open(file_name, "xb") as f:
-        f.write(contents)
+    if time_window is not None and time_window.needs_trimming(chunk):
+        file_contents = chunk_cache.retrieve(chunk, chunk["study__object_id"])
+        with open(file_name, "xb") as f:
+            f.write(time_window.trim(chunk, file_contents))
+    else:
+        chunk_cache.retrieve_to_file(chunk, chunk["study__object_id"], file_name)
 
 
 def get_interventions_data(forest_task: ForestTask):
@@ -14,7 +14,8 @@ from services.celery_forest import create_forest_celery_tasks
 from services.celery_push_notifications import create_push_notification_tasks
 from services.scripts_runner import (
     create_task_ios_no_decryption_key_task, create_task_participant_data_deletion,
-    create_task_upload_logs, create_task_update_celery_version
+    create_task_reconcile_data_quantity_stats, create_task_upload_logs,
+    create_task_update_celery_version
 )
 
 
@@ -36,7 +37,7 @@ TASKS = {
     HOURLY: [create_task_ios_no_decryption_key_task],
     FOUR_HOURLY: [],
     DAILY: [create_task_upload_logs],
-    WEEKLY: [],
+    WEEKLY: [create_task_reconcile_data_quantity_stats],
     MONTHLY: [],
 }
 
@@ -2,7 +2,9 @@ import importlib
 from modulefinder import Module
 
 from constants.celery_constants import SCRIPTS_QUEUE
+from database.study_models import Study
 from libs.celery_control import safe_apply_async, scripts_celery_app
+from libs.file_processing.data_qty_stats import reconcile_all_data_quantity_stats
 from libs.sentry import make_error_sentry, SentryTypes
 
 
@@ -80,4 +82,34 @@ def celery_update_forest_version():
     with make_error_sentry(sentry_type=SentryTypes.data_processing):
         print("running script update_forest_version.")
         from scripts import update_forest_version
-        ImportRepeater.ensure_run(update_forest_version)
\ No newline at end of file
+        ImportRepeater.ensure_run(update_forest_version)
+
+
+## Data quantity stats reconciliation
+
+def create_task_reconcile_data_quantity_stats():
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        print("Queueing data quantity stats reconciliation task.")
+        safe_apply_async(celery_reconcile_data_quantity_stats)
+
+
+@scripts_celery_app.task(queue=SCRIPTS_QUEUE)
+def celery_reconcile_data_quantity_stats():
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        print("running script reconcile_data_quantity_stats.")
+        from scripts import reconcile_data_quantity_stats
+        ImportRepeater.ensure_run(reconcile_data_quantity_stats)
+
+
+# the data quantity stats are bucketed by the days of the study's timezone
+def create_task_reconcile_study_data_quantity_stats(study: Study):
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        print(f"Queueing data quantity stats reconciliation task for study {study.name}.")
+        safe_apply_async(celery_reconcile_study_data_quantity_stats, args=[study.pk])
+
+
+@scripts_celery_app.task(queue=SCRIPTS_QUEUE)
+def celery_reconcile_study_data_quantity_stats(study_id: int):
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        print(f"running data quantity stats reconciliation for study {study_id}.")
+        reconcile_all_data_quantity_stats(study_id)
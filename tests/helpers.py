@@ -1,6 +1,7 @@
 import subprocess
 import uuid
 from datetime import date, datetime, timedelta
+from io import BytesIO
 from typing import List, Tuple
 
 from django.db.models import (AutoField, CharField, DateField, FloatField, ForeignKey, IntegerField,
@@ -662,6 +663,14 @@ def compare_dictionaries(reference, comparee, ignore=None):
     return False
 
 
+class DummyAsyncResult():
+    def __init__(self, value) -> None:
+        self.value = value
+    
+    def get(self, timeout=None):
+        return self.value
+
+
 class DummyThreadPool():
     """ a dummy threadpool object because the test suite has weird problems with ThreadPool """
     def __init__(self, *args, **kwargs) -> None:
@@ -673,6 +682,10 @@ class DummyThreadPool():
         # does not use kwargs
         return map(func, iterable)
     
+    def apply_async(self, func, args=(), kwds={}, **kwargs):
+        # runs immediately
+        return DummyAsyncResult(func(*args, **kwds))
+    
     # @staticmethod
     def terminate(self):
         pass
@@ -682,6 +695,46 @@ class DummyThreadPool():
         pass
 
 
+class DummyS3Client():
+    """ An in-memory stand-in for the parts of the boto3 S3 client that libs.s3 uses for file
+    transfers, including ranged downloads and multipart uploads. """
+    def __init__(self) -> None:
+        self.files = {}
+        self.multipart_uploads = {}
+    
+    def put_object(self, Body: bytes, Bucket: str, Key: str):
+        self.files[Key] = Body
+    
+    def get_object(self, Bucket: str, Key: str, Range: str = None, **kwargs):
+        data = self.files[Key]
+        if Range is None:
+            return {"Body": BytesIO(data)}
+        # e.g. "bytes=0-1023", the range is inclusive.
+        start, end = (int(position) for position in Range[len("bytes="):].split("-"))
+        end = min(end, len(data) - 1)
+        return {
+            "Body": BytesIO(data[start:end + 1]), "ContentRange": f"bytes {start}-{end}/{len(data)}"
+        }
+    
+    def create_multipart_upload(self, Bucket: str, Key: str):
+        upload_id = generate_easy_alphanumeric_string()
+        self.multipart_uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+    
+    def upload_part(self, Body: bytes, Bucket: str, Key: str, PartNumber: int, UploadId: str):
+        self.multipart_uploads[UploadId][PartNumber] = Body
+        return {"ETag": f"etag{PartNumber}"}
+    
+    def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict
+    ):
+        parts = self.multipart_uploads.pop(UploadId)
+        self.files[Key] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+    
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self.multipart_uploads.pop(UploadId)
+
+
 def render_test_html_file(response: HttpResponse, url: str):
     print("\nwriting url:", url)
     
@@ -1,9 +1,12 @@
 import json
+import tarfile
+import unittest
 from copy import copy
 from datetime import date, datetime, timedelta
 from io import BytesIO
 from typing import List
 from unittest.mock import MagicMock, patch
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
 import time_machine
 from django.core.exceptions import ValidationError
@@ -37,6 +40,7 @@ from constants.testing_constants import (ADMIN_ROLES, ALL_TESTING_ROLES, ANDROID
     IOS_CERT, MIDNIGHT_EVERY_DAY, THURS_OCT_6_NOON_2022_NY)
 from constants.url_constants import LOGIN_REDIRECT_SAFE, urlpatterns
 from constants.user_constants import ALL_RESEARCHER_TYPES, IOS_API, ResearcherRole
+from database.dashboard_models import DashboardDataQuantity
 from database.data_access_models import ChunkRegistry, FileToProcess
 from database.profiling_models import DataAccessRecord
 from database.schedule_models import (AbsoluteSchedule, ArchivedEvent, Intervention, ScheduledEvent,
@@ -45,10 +49,14 @@ from database.security_models import ApiKey
 from database.study_models import DeviceSettings, Study, StudyField
 from database.survey_models import Survey
 from database.system_models import FileAsText, GenericEvent
+from database.tableau_api_models import SummaryStatisticDaily
 from database.user_models_participant import (Participant, ParticipantDeletionEvent,
     ParticipantFCMHistory)
 from database.user_models_researcher import Researcher, StudyRelation
+from libs.columnar_export import COLUMNAR_EXPORT_AVAILABLE, pyarrow_ipc, pyarrow_parquet
 from libs.copy_study import format_study
+from libs.file_processing.data_qty_stats import reconcile_data_quantity_stats
+from libs.file_processing.utility_functions_simple import decompress
 from libs.rsa import get_RSA_cipher
 from libs.schedules import (get_start_and_end_of_java_timings_week,
     repopulate_absolute_survey_schedule_events, repopulate_relative_survey_schedule_events)
@@ -527,7 +535,7 @@ class TestResearcherRedirectionLogic(BasicSessionTestCase):
             except AssertionError:
                 # case - we have a mildly illegal url that needs to be tested along with the others
                 assert url in ("manage_studies/", "manage_studies")
-
+            
             found_something = False
             for urlpattern in urlpatterns:
                 if urlpattern.pattern.match(url.lstrip("/")):
@@ -1054,14 +1062,16 @@ class TestDashboardStream(ResearcherSessionTest):
                 self.generate_chunkregistry(
                     self.session_study,
                     participant,
-                    "junk",  # data_stream
+                    ACCELEROMETER,  # data_stream
                     file_size=123456+i,
                     time_bin=timezone.localtime().replace(hour=i, minute=0, second=0, microsecond=0),
                 )
+                reconcile_data_quantity_stats(participant)
         
         for data_stream in DASHBOARD_DATA_STREAMS:
             if create_chunkregistries:  # force correct data type
                 ChunkRegistry.objects.all().update(data_type=data_stream)
+                DashboardDataQuantity.objects.all().update(data_type=data_stream)
             
             html1 = self.smart_get_status_code(200, self.session_study.id, data_stream).content
             html2 = self.smart_post_status_code(200, self.session_study.id, data_stream).content
@@ -1107,6 +1117,7 @@ class TestDashboardPatientDisplay(ResearcherSessionTest):
                 file_size=123456,
                 time_bin=timezone.localtime().replace(hour=i, minute=0, second=0, microsecond=0),
             )
+        reconcile_data_quantity_stats(self.default_participant)
         
         # need to be post and get requests, it was just built that way
         html1 = self.smart_get_status_code(
@@ -1126,6 +1137,30 @@ class TestDashboardPatientDisplay(ResearcherSessionTest):
         self.assert_present(self.default_participant.patient_id, html2)
         self.assert_present(comma_separated, html1)
         self.assert_present(comma_separated, html2)
+    
+    def test_displays_only_requested_days(self):
+        self.set_session_study_relation()
+        today = timezone.localtime().replace(hour=12, minute=0, second=0, microsecond=0)
+        for days_ago, file_size in ((0, 111111), (10, 222222)):
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, ACCELEROMETER,
+                file_size=file_size, time_bin=today - timedelta(days=days_ago),
+            )
+        reconcile_data_quantity_stats(self.default_participant)
+        
+        # the default is the last week of data, which does not include the older day
+        html = self.smart_get_status_code(
+            200, self.session_study.id, self.default_participant.patient_id).content
+        self.assert_present("111,111", html)
+        self.assert_not_present("222,222", html)
+        
+        older_day = (today - timedelta(days=10)).strftime(API_DATE_FORMAT)
+        html = self.smart_get_status_code(
+            200, self.session_study.id, self.default_participant.patient_id,
+            data={"start": older_day, "end": older_day},
+        ).content
+        self.assert_present("222,222", html)
+        self.assert_not_present("111,111", html)
 
 
 #
@@ -2046,6 +2081,23 @@ class TestSetStudyTimezone(ResearcherSessionTest):
         self.smart_post(self.session_study.id, new_timezone_name="Pacific/Noumea")
         self.session_study.refresh_from_db()
         self.assertEqual(self.session_study.timezone_name, "Pacific/Noumea")
+    
+    def test_data_quantity_stats_are_rebuilt(self):
+        self.set_session_study_relation(ResearcherRole.study_admin)
+        # 8pm UTC on the 13th is the morning of the 14th in Noumea
+        time_bin = datetime(2018, 10, 13, 20, tzinfo=timezone.utc)
+        self.generate_chunkregistry(
+            self.session_study, self.default_participant, "gps", time_bin=time_bin, file_size=10
+        )
+        reconcile_data_quantity_stats(self.default_participant)
+        self.smart_post(self.session_study.id, new_timezone_name="Pacific/Noumea")
+        
+        stats = dict(SummaryStatisticDaily.objects.values_list("date", "beiwe_gps_bytes"))
+        self.assertEqual(stats, {date(2018, 10, 13): None, date(2018, 10, 14): 10})
+        self.assertEqual(
+            list(DashboardDataQuantity.objects.values_list("date", "bytes")),
+            [(date(2018, 10, 14), 10)],
+        )
 
 
 class TestAddResearcherToStudy(ResearcherSessionTest):
@@ -3532,15 +3584,15 @@ class TestDownloadStudyInterventions(DataApiTest):
 
 class TestGetData(DataApiTest):
     """ WARNING: there are heisenbugs in debugging the download data api endpoint.
-
+    
     There is a generator that is conditionally present (`handle_database_query`), it can swallow
     errors. As a generater iterating over it consumes it, so printing it breaks the code.
     
     You Must Patch libs.streaming_zip.ThreadPool
         The database connection breaks throwing errors on queries that should succeed.
         The iterator inside the zip file generator generally fails, and the zip file is empty.
-
-    You Must Patch libs.streaming_zip.s3_retrieve
+    
+    You Must Patch libs.chunk_cache.s3_retrieve
         Otherwise s3_retrieve will fail due to the patch is tests.common.
     """
     
@@ -3640,6 +3692,27 @@ class TestGetData(DataApiTest):
         threadpool.return_value = DummyThreadPool()
         self._test_data_streams()
     
+    @patch("libs.streaming_zip.ThreadPool")
+    def test_compression(self, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        self._test_compression()
+    
+    @patch("libs.streaming_zip.ThreadPool")
+    def test_sync_cursor(self, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        self._test_sync_cursor()
+    
+    @patch("libs.streaming_zip.ThreadPool")
+    def test_trim_rows(self, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        self._test_trim_rows()
+    
+    @unittest.skipUnless(COLUMNAR_EXPORT_AVAILABLE, "pyarrow is not installed")
+    @patch("libs.streaming_zip.ThreadPool")
+    def test_output_format(self, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        self._test_output_format()
+    
     # but don't patch ThreadPool for this one
     def test_downloads_and_file_naming_heisenbug(self):
         # As far as I can tell the ThreadPool seems to screw up the connection to the test
@@ -3663,6 +3736,12 @@ class TestGetData(DataApiTest):
                     "threading via a ThreadPool or DummyThreadPool"
                 )
     
+    # also not patched
+    def test_downloads_and_file_naming_thread_pool(self):
+        # The download threads don't use the database, only the thread iterating over the
+        # ZipGenerator does, so the queries see the test database and the files are present.
+        self._test_downloads_and_file_naming()
+    
     def _test_basics(self, as_site_admin: bool):
         if as_site_admin:
             self.session_researcher.update(site_admin=True)
@@ -3686,7 +3765,7 @@ class TestGetData(DataApiTest):
         self.assertEqual(i2, 2)
         self.assert_present(b"registry{}", file_content)
     
-    @patch("libs.streaming_zip.s3_retrieve")
+    @patch("libs.chunk_cache.s3_retrieve")
     def _test_downloads_and_file_naming(self, s3_retrieve: MagicMock):
         # basics
         s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
@@ -3700,7 +3779,210 @@ class TestGetData(DataApiTest):
             self.assertIn(output_name.encode(), file_contents)
             self.assertIn(s3_retrieve.return_value, file_contents)
     
-    @patch("libs.streaming_zip.s3_retrieve")
+    @patch("libs.chunk_cache.s3_retrieve")
+    def _test_compression(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS * 100
+        self.set_session_study_relation(ResearcherRole.researcher)
+        basic_args = ("accelerometer", "some_file_path.csv", "2020-10-05 02:00Z")
+        output_name = self.FILE_NAMES["accelerometer"][2]
+        
+        # zip files, with the registry
+        for compression in (None, "none", "deflate"):
+            file_contents = self.generate_chunkregistry_and_download(
+                *basic_args, registry="{}", compression=compression
+            )
+            with ZipFile(BytesIO(file_contents)) as zip_file:
+                self.assertIsNone(zip_file.testzip())  # checks crcs
+                self.assertEqual(zip_file.namelist(), [output_name, "registry"])
+                self.assertEqual(zip_file.read(output_name), s3_retrieve.return_value)
+                compress_type = zip_file.getinfo(output_name).compress_type
+            self.assertEqual(compress_type, ZIP_DEFLATED if compression == "deflate" else ZIP_STORED)
+            if compression == "deflate":
+                self.assertLess(len(file_contents), len(s3_retrieve.return_value))
+        
+        # zstd-compressed tar file
+        file_contents = self.generate_chunkregistry_and_download(*basic_args, compression="zstd")
+        self.assertLess(len(file_contents), len(s3_retrieve.return_value))
+        with tarfile.open(fileobj=BytesIO(decompress(file_contents))) as tar_file:
+            self.assertEqual(tar_file.getnames(), [output_name])
+            self.assertEqual(tar_file.extractfile(output_name).read(), s3_retrieve.return_value)
+        
+        self.generate_chunkregistry_and_download(*basic_args, compression="rar", status_code=400)
+    
+    @patch("libs.chunk_cache.s3_retrieve")
+    def _test_sync_cursor(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
+        self.set_session_study_relation(ResearcherRole.researcher)
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        
+        def sync(sync_cursor: str):
+            resp: FileResponse = self.smart_post(
+                study_pk=self.session_study.id, sync_cursor=sync_cursor
+            )
+            self.assertEqual(resp.status_code, 200)
+            with ZipFile(BytesIO(b"".join(resp.streaming_content))) as zip_file:
+                names = zip_file.namelist()
+                self.assertEqual(names[-1], "sync_cursor")  # and there is no registry
+                return names[:-1], zip_file.read("sync_cursor").decode()
+        
+        chunk_1 = self.generate_chunkregistry(
+            self.session_study, self.default_participant, "gps", time_bin=an_hour_ago
+        )
+        chunk_2 = self.generate_chunkregistry(
+            self.session_study, self.default_participant, "wifi", time_bin=an_hour_ago
+        )
+        # last_updated is set on save, chunks that were just updated are left for the next sync
+        ChunkRegistry.objects.filter(pk=chunk_1.pk).update(last_updated=an_hour_ago)
+        
+        names, cursor_1 = sync("")
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(f"{self.PATIENT_NAME}/gps/"))
+        self.assertEqual(cursor_1, ChunkRegistry.encode_sync_cursor(an_hour_ago, chunk_1.pk))
+        
+        # nothing new, the cursor is returned unchanged
+        self.assertEqual(sync(cursor_1), ([], cursor_1))
+        
+        # chunks with the same last_updated are ordered by pk
+        ChunkRegistry.objects.filter(pk=chunk_2.pk).update(last_updated=an_hour_ago)
+        names, cursor_2 = sync(cursor_1)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(f"{self.PATIENT_NAME}/wifi/"))
+        self.assertEqual(cursor_2, ChunkRegistry.encode_sync_cursor(an_hour_ago, chunk_2.pk))
+        
+        # an updated chunk is downloaded again
+        ChunkRegistry.objects.filter(pk=chunk_1.pk).update(
+            last_updated=an_hour_ago + timedelta(minutes=1)
+        )
+        names, _ = sync(cursor_2)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(f"{self.PATIENT_NAME}/gps/"))
+        
+        # from the start again
+        names, _ = sync("")
+        self.assertEqual(len(names), 2)
+        
+        for bad_cursor in ("1234", "a_1", "1_2_3"):
+            resp = self.smart_post(study_pk=self.session_study.id, sync_cursor=bad_cursor)
+            self.assertEqual(resp.status_code, 400)
+    
+    @patch("libs.chunk_cache.s3_retrieve")
+    def _test_trim_rows(self, s3_retrieve: MagicMock):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        files = {}
+        for hour in (10, 11, 12):
+            time_bin = datetime(2020, 10, 5, hour, tzinfo=timezone.utc)
+            start_ms = int(time_bin.timestamp() * 1000)
+            files[f"gps_{hour}.csv"] = b"timestamp,UTC time,latitude\n" + b"\n".join(
+                b"%d,x,1" % (start_ms + minute * 60000) for minute in (0, 20, 40)
+            )
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, "gps", path=f"gps_{hour}.csv",
+                time_bin=time_bin, hash_value=f"hash_{hour}",
+            )
+        # files that aren't chunked data are not trimmed, they are only included by their time bin
+        for minute in (10, 50):
+            files[f"answers_{minute}.csv"] = b"survey answers"
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, "survey_answers",
+                path=f"a/b/c/answers_{minute}.csv",
+                time_bin=datetime(2020, 10, 5, 10, minute, tzinfo=timezone.utc),
+            )
+        s3_retrieve.side_effect = lambda path, *args, **kwargs: files[path.rsplit("/", 1)[-1]]
+        
+        def download(**post_params) -> dict:
+            resp: FileResponse = self.smart_post(
+                study_pk=self.session_study.id, time_start="2020-10-05T10:30:00",
+                time_end="2020-10-05T12:15:00", registry="{}", **post_params
+            )
+            self.assertEqual(resp.status_code, 200)
+            with ZipFile(BytesIO(b"".join(resp.streaming_content))) as zip_file:
+                return {name: zip_file.read(name) for name in zip_file.namelist()}
+        
+        # the chunk that contains the start of the time range is only downloaded with trim_rows
+        gps_names = [
+            f"{self.PATIENT_NAME}/gps/2020-10-05 {hour}_00_00+00_00.csv" for hour in (10, 11, 12)
+        ]
+        untrimmed = download()
+        self.assertNotIn(gps_names[0], untrimmed)
+        self.assertEqual(untrimmed[gps_names[1]], files["gps_11.csv"])
+        self.assertEqual(untrimmed[gps_names[2]], files["gps_12.csv"])
+        
+        trimmed = download(trim_rows="true")
+        data_types = sorted(name.split("/")[1] for name in trimmed if name != "registry")
+        self.assertEqual(data_types, ["gps", "gps", "gps", "survey_answers"])
+        header, *rows = files["gps_10.csv"].split(b"\n")
+        self.assertEqual(trimmed[gps_names[0]], b"\n".join([header, rows[2]]))
+        self.assertEqual(trimmed[gps_names[1]], files["gps_11.csv"])
+        header, *rows = files["gps_12.csv"].split(b"\n")
+        self.assertEqual(trimmed[gps_names[2]], b"\n".join([header, rows[0]]))
+        # trimmed files are not in the registry
+        registry = json.loads(trimmed["registry"])
+        self.assertEqual(registry["gps_11.csv"], "hash_11")
+        self.assertNotIn("gps_10.csv", registry)
+        self.assertNotIn("gps_12.csv", registry)
+        
+        resp = self.smart_post(study_pk=self.session_study.id, trim_rows="yes")
+        self.assertEqual(resp.status_code, 400)
+    
+    @patch("libs.chunk_cache.s3_retrieve")
+    def _test_output_format(self, s3_retrieve: MagicMock):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        gps_header = b"timestamp,UTC time,latitude,longitude\n"
+        files = {
+            "gps_1.csv": gps_header + b"1000,x,42.123456,-71.1\n2000,x,42.2,-71.2",
+            "gps_2.csv": gps_header + b"3000,x,42.3,-71.3",
+            "accel.csv": b"timestamp,UTC time,accuracy,x,y,z\n1000,x,unknown,0.5,1,-2",
+            "a/b/c/answers.csv": b"survey answers",
+        }
+        for path, data_type, hour in (
+            ("gps_1.csv", "gps", 1), ("gps_2.csv", "gps", 2), ("accel.csv", "accelerometer", 1),
+            ("a/b/c/answers.csv", "survey_answers", 1)
+        ):
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, data_type, path=path,
+                time_bin=datetime(2020, 10, 5, hour, tzinfo=timezone.utc),
+            )
+        s3_retrieve.side_effect = lambda path, *args, **kwargs: files[path]
+        
+        for output_format in ("parquet", "arrow"):
+            resp: FileResponse = self.smart_post(
+                study_pk=self.session_study.id, output_format=output_format
+            )
+            self.assertEqual(resp.status_code, 200)
+            with ZipFile(BytesIO(b"".join(resp.streaming_content))) as zip_file:
+                contents = {name: zip_file.read(name) for name in zip_file.namelist()}
+            
+            # the gps chunks are one file, named after the first chunk, without the UTC time column
+            prefix = f"{self.PATIENT_NAME}/gps/2020-10-05 01_00_00+00_00"
+            gps_table = self.read_table(contents[f"{prefix}.{output_format}"], output_format)
+            self.assertEqual(gps_table.column_names, ["timestamp", "latitude", "longitude"])
+            self.assertEqual(gps_table.column("timestamp").to_pylist(), [1000, 2000, 3000])
+            self.assertEqual(str(gps_table.schema.field("timestamp").type), "int64")
+            self.assertEqual(gps_table.column("latitude").to_pylist()[0], 42.123456)  # not float32
+            
+            prefix = f"{self.PATIENT_NAME}/accelerometer/2020-10-05 01_00_00+00_00"
+            accel_table = self.read_table(contents[f"{prefix}.{output_format}"], output_format)
+            self.assertEqual(str(accel_table.schema.field("x").type), "float")  # float32
+            self.assertEqual(accel_table.column("accuracy").to_pylist(), ["unknown"])
+            
+            # other files are included as they are, there is no registry
+            self.assertEqual(len(contents), 3)
+            answers = [name for name in contents if name.split("/")[1] == "survey_answers"]
+            self.assertEqual(contents[answers[0]], b"survey answers")
+        
+        for bad_params in (
+            {"output_format": "xlsx"}, {"output_format": "parquet", "sync_cursor": ""}
+        ):
+            resp = self.smart_post(study_pk=self.session_study.id, **bad_params)
+            self.assertEqual(resp.status_code, 400)
+    
+    @staticmethod
+    def read_table(file_contents: bytes, output_format: str):
+        if output_format == "parquet":
+            return pyarrow_parquet.read_table(BytesIO(file_contents))
+        return pyarrow_ipc.open_file(file_contents).read_all()
+    
+    @patch("libs.chunk_cache.s3_retrieve")
     def _test_data_streams(self, s3_retrieve: MagicMock):
         # basics
         s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
@@ -3734,7 +4016,7 @@ class TestGetData(DataApiTest):
         )
         self.assertEqual(file_contents, self.EMPTY_ZIP)
     
-    @patch("libs.streaming_zip.s3_retrieve")
+    @patch("libs.chunk_cache.s3_retrieve")
     def _test_registry_doesnt_download(self, s3_retrieve: MagicMock):
         # basics
         s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
@@ -3772,7 +4054,7 @@ class TestGetData(DataApiTest):
             *basic_args, registry="", status_code=400
         )
     
-    @patch("libs.streaming_zip.s3_retrieve")
+    @patch("libs.chunk_cache.s3_retrieve")
     def _test_time_bin(self, s3_retrieve: MagicMock):
         # basics
         s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
@@ -3850,7 +4132,7 @@ class TestGetData(DataApiTest):
             *basic_args, query_time_bin_start="2020-10-05 01:00:00", status_code=400
         )
     
-    @patch("libs.streaming_zip.s3_retrieve")
+    @patch("libs.chunk_cache.s3_retrieve")
     def _test_user_query(self, s3_retrieve: MagicMock):
         # basics
         s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
@@ -3907,6 +4189,7 @@ class TestGetData(DataApiTest):
         query_patient_ids: str = None,
         query_data_streams: str = None,
         force_web_form: bool = False,
+        compression: str = None,
     ):
         post_kwargs = {"study_pk": self.session_study.id}
         generate_kwargs = {"time_bin": time_bin, "path": file_path}
@@ -3925,6 +4208,9 @@ class TestGetData(DataApiTest):
         if force_web_form:
             post_kwargs["web_form"] = ""
         
+        if compression is not None:
+            post_kwargs["compression"] = compression
+        
         if query_data_streams is not None:
             post_kwargs["data_streams"] = query_data_streams
             tracking["query_params"]["data_streams"] = query_data_streams
@@ -3974,6 +4260,109 @@ class TestGetData(DataApiTest):
         return b"".join(bytes_list)
 
 
+class TestGetDataManifest(DataApiTest):
+    PATIENT_NAME = CommonTestCase.DEFAULT_PARTICIPANT_NAME
+    ENDPOINT_NAME = "data_access_api.get_data_manifest"
+    
+    def test_no_data(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        resp = self.smart_post(study_pk=self.session_study.id)
+        self.assertEqual(json.loads(b"".join(resp.streaming_content)), [])
+    
+    def test_manifest(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        time_bin = datetime(2020, 10, 5, 2, tzinfo=timezone.utc)
+        gps = self.generate_chunkregistry(
+            self.session_study, self.default_participant, "gps", path="gps.csv", time_bin=time_bin,
+            file_size=10,
+        )
+        self.generate_chunkregistry(
+            self.session_study, self.default_participant, "wifi", path="wifi.csv", time_bin=time_bin
+        )
+        resp = self.smart_post(study_pk=self.session_study.id, data_streams='["gps"]')
+        self.assertEqual(
+            json.loads(b"".join(resp.streaming_content)),
+            [{
+                "chunk_id": gps.pk,
+                "file_name": f"{self.PATIENT_NAME}/gps/2020-10-05 02_00_00+00_00.csv",
+                "chunk_path": "gps.csv",
+                "chunk_hash": gps.chunk_hash,
+                "file_size": 10,
+                "data_type": "gps",
+                "participant_id": self.default_participant.patient_id,
+                "time_bin": "2020-10-05T02:00:00+00:00",
+            }]
+        )
+        record = DataAccessRecord.objects.get()
+        query_params = json.loads(record.query_params)
+        self.assertTrue(query_params["manifest"])
+        self.assertEqual(query_params["data_types"], ["gps"])
+        self.assertIsNone(record.error)
+        
+        # query validation is the same as get_data, and failures are recorded
+        self.smart_post_status_code(404, study_pk=self.session_study.id, data_streams='["bad"]')
+        record = DataAccessRecord.objects.order_by("-created_on").first()
+        self.assertIn("did not pass query validation", record.error)
+    
+    def test_manifest_rollups(self):
+        # rollup chunks are only included when their data stream is requested
+        self.set_session_study_relation(ResearcherRole.researcher)
+        time_bin = datetime(2020, 10, 5, tzinfo=timezone.utc)
+        for data_type in ("accelerometer", "accelerometer_minutes"):
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, data_type, path=f"{data_type}.csv",
+                time_bin=time_bin,
+            )
+        for data_streams, data_types in (
+            (None, ["accelerometer"]),
+            ('["accelerometer_minutes"]', ["accelerometer_minutes"]),
+            ('["accelerometer", "accelerometer_minutes"]',
+             ["accelerometer", "accelerometer_minutes"]),
+        ):
+            post_params = {} if data_streams is None else {"data_streams": data_streams}
+            resp = self.smart_post(study_pk=self.session_study.id, **post_params)
+            manifest = json.loads(b"".join(resp.streaming_content))
+            self.assertEqual(sorted(chunk["data_type"] for chunk in manifest), data_types)
+
+
+class TestGetDataFiles(DataApiTest):
+    ENDPOINT_NAME = "data_access_api.get_data_files"
+    
+    @patch("libs.chunk_cache.s3_retrieve")
+    @patch("libs.streaming_zip.ThreadPool")
+    def test_get_data_files(self, threadpool: MagicMock, s3_retrieve: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        s3_retrieve.side_effect = lambda chunk_path, *args, **kwargs: chunk_path.encode()
+        self.set_session_study_relation(ResearcherRole.researcher)
+        chunks = [
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, data_type, path=f"{data_type}.csv"
+            )
+            for data_type in ("gps", "wifi", "calls")
+        ]
+        other_study_chunk = self.generate_chunkregistry(
+            self.generate_study("other study"), self.default_participant, "texts"
+        )
+        chunk_ids = [chunks[0].pk, chunks[2].pk, other_study_chunk.pk, 0]
+        resp = self.smart_post(
+            study_pk=self.session_study.id, chunk_ids=json.dumps(chunk_ids), compression="deflate"
+        )
+        self.assertEqual(resp.status_code, 200)
+        with ZipFile(BytesIO(b"".join(resp.streaming_content))) as zip_file:
+            names = zip_file.namelist()  # no registry
+            self.assertEqual(len(names), 2)
+            self.assertEqual(zip_file.read(names[0]), b"gps.csv")
+            self.assertEqual(zip_file.read(names[1]), b"calls.csv")
+        record = DataAccessRecord.objects.get()
+        self.assertEqual(json.loads(record.query_params)["chunk_ids"], chunk_ids)
+    
+    def test_bad_chunk_ids(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        for chunk_ids in (None, "", "[1, 2", '{"a": 1}', '["1"]', json.dumps(list(range(501)))):
+            post_kwargs = {} if chunk_ids is None else {"chunk_ids": chunk_ids}
+            self.smart_post_status_code(400, study_pk=self.session_study.id, **post_kwargs)
+
+
 #
 ## mobile_api
 #
@@ -4438,6 +4827,28 @@ class TestMobileUpload(ParticipantSessionTest):
         )
     # TODO: add invalid decrypted key length test...
     
+    @patch("api.mobile_api.DEFER_UPLOAD_DECRYPTION", True)
+    @patch("libs.participant_file_uploads.s3_upload_plaintext")
+    def test_deferred_decryption(self, s3_upload_plaintext: MagicMock):
+        self.smart_post_status_code(200, file_name="whatever.csv", file="some_content")
+        self.assert_one_file_to_process
+        ftp = FileToProcess.objects.get()
+        self.assertTrue(ftp.deferred_decryption)
+        self.assertEqual(ftp.s3_file_path, f"{self.session_study.object_id}/whatever.csv")
+        # the upload is stored exactly as it was received
+        s3_upload_plaintext.assert_called_once_with(
+            f"RAW_UPLOADS/{self.session_study.object_id}/whatever.csv", b"some_content"
+        )
+        # no decryption means no decryption errors
+        self.assertEqual(GenericEvent.objects.count(), 0)
+    
+    @patch("api.mobile_api.DEFER_UPLOAD_DECRYPTION", True)
+    @patch("libs.participant_file_uploads.s3_upload_plaintext")
+    def test_deferred_decryption_no_file_content(self, s3_upload_plaintext: MagicMock):
+        self.smart_post_status_code(200, file_name="whatever.csv", file="")
+        self.assert_no_files_to_process
+        s3_upload_plaintext.assert_not_called()
+    
     def test_deleted_participant(self):
         self.INJECT_DEVICE_TRACKER_PARAMS = False
         self.default_participant.update(deleted=True)
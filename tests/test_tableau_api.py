@@ -1,7 +1,10 @@
 from datetime import date, timedelta
+from unittest.mock import patch
 
 import orjson
+from django.db import connection
 from django.http import StreamingHttpResponse
+from django.test.utils import CaptureQueriesContext
 
 from authentication.tableau_authentication import (check_tableau_permissions,
     TableauAuthenticationFailed, TableauPermissionDenied)
@@ -9,6 +12,7 @@ from constants.tableau_api_constants import (SERIALIZABLE_FIELD_NAMES, X_ACCESS_
     X_ACCESS_KEY_SECRET)
 from database.security_models import ApiKey
 from database.user_models_researcher import StudyRelation
+from libs.tableau_result_cache import TableauResultCache
 from tests.common import ResearcherSessionTest, TableauAPITest
 from tests.helpers import compare_dictionaries
 
@@ -228,6 +232,82 @@ class TestGetTableauDaily(TableauAPITest):
         compare_me['participant_id'] = self.default_participant.patient_id  # revert to participant 1
         assert compare_dictionaries(response_object[0], compare_me)
     
+    def test_summary_statistics_daily_pages_in_one_query(self):
+        for days_ago in range(5):
+            self.generate_summary_statistic_daily(a_date=self.today - timedelta(days=days_ago))
+        
+        # the rows are streamed a page at a time from one query, in order
+        with patch("api.tableau_api.TABLEAU_PAGE_SIZE", 2), \
+                CaptureQueriesContext(connection) as queries:
+            resp = self.smart_get_200_auto_headers(**self.params_all_defaults)
+            response_object = orjson.loads(b"".join(resp.streaming_content))
+        # (the other query is the version stamp of the study's summary statistics)
+        summary_queries = [
+            q for q in queries if "summarystatisticdaily" in q["sql"] and "COUNT" not in q["sql"]
+        ]
+        self.assertEqual(len(summary_queries), 1)
+        self.assertEqual(
+            [row["date"] for row in response_object],
+            [(self.today - timedelta(days=days_ago)).isoformat() for days_ago in range(5)],
+        )
+        for row in response_object:
+            self.assertEqual(row["participant_id"], self.default_participant.patient_id)
+            self.assertEqual(row["study_id"], self.session_study.object_id)
+        
+        params = {"limit": 3, "order_direction": "ascending", **self.params_all_defaults}
+        with patch("api.tableau_api.TABLEAU_PAGE_SIZE", 2):
+            resp = self.smart_get_200_auto_headers(**params)
+            response_object = orjson.loads(b"".join(resp.streaming_content))
+        self.assertEqual(
+            [row["date"] for row in response_object],
+            [(self.today - timedelta(days=days_ago)).isoformat() for days_ago in (4, 3, 2)],
+        )
+    
+    def test_summary_statistics_daily_etag(self):
+        self.generate_summary_statistic_daily()
+        resp = self.smart_get_200_auto_headers(**self.params_all_defaults)
+        etag = resp["ETag"]
+        content = b"".join(resp.streaming_content)
+        
+        # the same query gets a 304 until the data changes
+        resp = self.smart_get_status_code(
+            304, self.session_study.object_id, data=self.params_all_defaults,
+            HTTP_IF_NONE_MATCH=etag, **self.raw_headers
+        )
+        self.assertEqual(resp["ETag"], etag)
+        # a different query has a different etag
+        params = {"limit": 1, **self.params_all_defaults}
+        resp = self.smart_get_200_auto_headers(**params, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(resp["ETag"], etag)
+        
+        self.generate_summary_statistic_daily(a_date=self.yesterday)
+        resp = self.smart_get_status_code(
+            200, self.session_study.object_id, data=self.params_all_defaults,
+            HTTP_IF_NONE_MATCH=etag, **self.raw_headers
+        )
+        self.assertNotEqual(resp["ETag"], etag)
+        self.assertNotEqual(b"".join(resp.streaming_content), content)
+    
+    def test_summary_statistics_daily_result_cache(self):
+        self.generate_summary_statistic_daily()
+        with patch("api.tableau_api.tableau_result_cache", TableauResultCache(1024 * 1024)):
+            resp = self.smart_get_200_auto_headers(**self.params_all_defaults)
+            content = b"".join(resp.streaming_content)
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.smart_get_200_auto_headers(**self.params_all_defaults)
+            self.assertEqual(resp.content, content)
+            summary_queries = [
+                q for q in queries
+                if "summarystatisticdaily" in q["sql"] and "COUNT" not in q["sql"]
+            ]
+            self.assertEqual(summary_queries, [])
+            
+            # new data changes the version, the query runs again
+            self.generate_summary_statistic_daily(a_date=self.yesterday)
+            resp = self.smart_get_200_auto_headers(**self.params_all_defaults)
+            response_object = orjson.loads(b"".join(resp.streaming_content))
+            self.assertEqual(len(response_object), 2)
+    
     def test_summary_statistics_daily_wrong_date(self):
         self.generate_summary_statistic_daily()
         params = self.params_all_defaults
@@ -1,35 +1,80 @@
+import errno
+import os
 import time
 import unittest
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from os.path import join as path_join
+from tempfile import TemporaryDirectory
 from unittest.mock import MagicMock, patch
 
 import dateutil
+from billiard.pool import Pool
+from botocore.stub import Stubber
+from Cryptodome.Cipher import AES
+from cronutils.error_handler import null_error_handler
 from dateutil.tz import gettz
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+from constants.common_constants import BEIWE_PROJECT_ROOT
+from constants.data_processing_constants import ROLLUP_HEADER
 from constants.schedule_constants import EMPTY_WEEKLY_SURVEY_TIMINGS
 from constants.testing_constants import MIDNIGHT_EVERY_DAY
-from database.data_access_models import IOSDecryptionKey
+from constants.user_constants import ANDROID_API, IOS_API
+from database.dashboard_models import DashboardDataQuantity
+from database.data_access_models import (ChunkRegistry, ChunkTimeBinExtent, FileToProcess,
+    IOSDecryptionKey)
 from database.profiling_models import EncryptionErrorMetadata, LineEncryptionError, UploadTracking
 from database.schedule_models import (ArchivedEvent, BadWeeklyCount, InterventionDate,
     ScheduledEvent, WeeklySchedule)
+from database.system_models import GenericEvent
 from database.tableau_api_models import ForestTask, SummaryStatisticDaily
 from database.user_models_participant import (Participant, ParticipantDeletionEvent,
     ParticipantFieldValue, PushNotificationDisabledEvent)
-from libs.file_processing.exceptions import BadTimecodeError
-from libs.file_processing.utility_functions_simple import binify_from_timecode
+from libs.chunk_cache import ChunkCache
+from libs.columnar_export import COLUMNAR_EXPORT_AVAILABLE, ColumnarExportGenerator, csv_to_table
+from libs.encryption import DeviceDataDecryptor
+from libs.file_processing.columnar_csvs import (binify_columnar_rows, ColumnarRows,
+    COLUMNAR_PROCESSING_AVAILABLE, parse_columnar_csv)
+from libs.file_processing.csv_merger import construct_s3_chunk_path, CsvMerger
+from libs.file_processing.data_qty_stats import reconcile_data_quantity_stats
+from libs.file_processing.exceptions import BadTimecodeError, ChunkNotSortedError
+from libs.file_processing.file_for_processing import SomeException
+from libs.file_processing.file_processing_core import (binify_csv_rows, binify_file_contents,
+    process_unchunkable_file, wait_for_uploads)
+from libs.file_processing.processing_pipeline import ParticipantProcessingPipeline
+from libs.file_processing.processing_scheduler import (get_processing_backlog_by_study,
+    get_processing_work_units)
+from libs.file_processing.rollups import (is_rollup_source, merge_rollup_rows,
+    parse_s3_chunk_path, summarize_minutes)
+from libs.file_processing.utility_functions_csvs import (construct_csv_string, csv_to_list,
+    trim_csv_to_time_range)
+from libs.file_processing.utility_functions_simple import (binify_from_timecode,
+    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp, merge_sorted_rows)
+from libs.participant_file_uploads import decrypt_deferred_upload, get_cached_private_key
 from libs.participant_purge import (confirm_deleted, get_all_file_path_prefixes,
     run_next_queued_participant_data_deletion)
+from libs.rsa import get_RSA_cipher
+from libs.s3 import (get_s3_client, s3_retrieve, s3_retrieve_to_file, s3_upload,
+    S3OperationStats)
 from libs.schedules import (export_weekly_survey_timings, get_next_weekly_event_and_schedule,
     NoSchedulesException)
+from libs.security import chunk_hash, decode_base64, encode_base64
+from libs.streaming_zip import ChunkPrefetcher
 from tests.common import CommonTestCase
+from tests.helpers import (DummyAsyncResult, DummyS3Client, DummyThreadPool,
+    ReferenceObjectMixin)
 
 
 # timezones should be compared using the 'is' operator
 THE_ONE_TRUE_TIMEZONE = gettz("America/New_York")
 THE_OTHER_ACCEPTABLE_TIMEZONE = gettz("UTC")
 
-COUNT_OF_PATHS_RETURNED_FROM_GET_ALL_FILE_PATH_PREFIXES = 4
+COUNT_OF_PATHS_RETURNED_FROM_GET_ALL_FILE_PATH_PREFIXES = 5
 
 class TestTimingsSchedules(CommonTestCase):
     
@@ -158,6 +203,995 @@ class TestBinifyFromTimecode(unittest.TestCase):
         self.assertRaises(BadTimecodeError, binify_from_timecode, timestamp.encode())
 
 
+class TestMergeSortedRows(unittest.TestCase):
+    OLD_ROWS = [
+        [b"100", b"a"], [b"200", b"a"], [b"200", b"b"], [b"broken", b"x"], [b"300", b"a"],
+    ]
+    NEW_ROWS = [[b"50", b"z"], [b"200", b"a"], [b"200", b"c"], [b"300", b"a"], [b"400", b"a"]]
+    
+    def test_identical_to_sort_and_construct(self):
+        all_rows = [list(row) for row in self.OLD_ROWS + self.NEW_ROWS]
+        ensure_sorted_by_timestamp(all_rows)
+        self.assertEqual(
+            construct_csv_string(b"header", all_rows),
+            b"header\n" + b"\n".join(merge_sorted_rows(self.OLD_ROWS, self.NEW_ROWS)),
+        )
+    
+    def test_unsorted_rows(self):
+        old_rows = [[b"200", b"a"], [b"100", b"a"]]
+        self.assertRaises(ChunkNotSortedError, list, merge_sorted_rows(old_rows, self.NEW_ROWS))
+
+
+class TestTrimCsvToTimeRange(unittest.TestCase):
+    HEADER = b"timestamp,UTC time,value"
+    CSV = HEADER + b"\n100,a,1\n200,b,2\nbroken,c,3\n300,d,4\n400,e,5"
+    
+    def test_trim(self):
+        self.assertEqual(
+            trim_csv_to_time_range(self.CSV, 200, 300), self.HEADER + b"\n200,b,2\n300,d,4"
+        )
+        self.assertEqual(trim_csv_to_time_range(self.CSV, 350), self.HEADER + b"\n400,e,5")
+        self.assertEqual(trim_csv_to_time_range(self.CSV, end_ms=100), self.HEADER + b"\n100,a,1")
+        self.assertEqual(trim_csv_to_time_range(self.CSV, 500), self.HEADER)
+        self.assertEqual(trim_csv_to_time_range(self.HEADER, 0, 1), self.HEADER)
+
+
+class TestRollups(unittest.TestCase):
+    HEADER = b"timestamp,UTC time,accuracy,x,y,z"
+    
+    def test_summarize_minutes(self):
+        csv = self.HEADER + b"\n60000,a,unknown,3,4,0\n60500,b,unknown,-3,-4,0\nbroken,c,1,1,1,1" \
+            b"\n120000,d,unknown,1,nan,0\n180000,e,unknown,0,0,2"
+        self.assertEqual(
+            summarize_minutes(csv),
+            [(60000, b"60000,1970-01-01T00:01:00,2,0,3,0,4,0,0,5,0"),
+             (180000, b"180000,1970-01-01T00:03:00,1,0,0,0,0,2,0,2,0")]
+        )
+        self.assertEqual(summarize_minutes(b"timestamp,UTC time,event\n60000,a,b"), [])
+        self.assertEqual(summarize_minutes(b""), [])
+    
+    def test_merge_rollup_rows(self):
+        existing = ROLLUP_HEADER + b"\n0,old\n60000,old\n3600000,old"
+        self.assertEqual(
+            merge_rollup_rows(existing, {0: [(120000, b"120000,new")]}),
+            ROLLUP_HEADER + b"\n120000,new\n3600000,old"
+        )
+        self.assertEqual(
+            merge_rollup_rows(None, {1: [(3600000, b"3600000,new")]}),
+            ROLLUP_HEADER + b"\n3600000,new"
+        )
+    
+    def test_parse_s3_chunk_path(self):
+        chunk_path = construct_s3_chunk_path("study", "patient", "gyro", 427609)
+        self.assertEqual(parse_s3_chunk_path(chunk_path), ("study", "patient", "gyro", 427609))
+        self.assertTrue(is_rollup_source(chunk_path))
+        self.assertFalse(is_rollup_source(chunk_path.replace("gyro", "gps")))
+        self.assertFalse(is_rollup_source("patient/gyro/something.csv"))
+
+
+@unittest.skipUnless(COLUMNAR_PROCESSING_AVAILABLE, "numpy is not installed")
+class TestColumnarCsvs(unittest.TestCase):
+    HEADER = b"timestamp,accuracy,x,y,z"
+    # unsorted, spans two hourly bins, contains a duplicate row and a too-early row, a row with a
+    # leading comma, and ends with an empty line.
+    FILE_CONTENTS = HEADER + b"\n" + b"\n".join([
+        b"1539399600001,unknown,0.5,0.25,-1.0",
+        b"1539395563219,unknown,0.01904296875,-0.00531005859375,-0.99017333984375",
+        b"1539395563009,unknown,0.1,0.2,0.3",
+        b"1539395563219,unknown,0.01904296875,-0.00531005859375,-0.99017333984375",
+        b"1539395563219,unknown,0.7,0.8,0.9",
+        b"1006851200000,unknown,0.1,0.2,0.3",
+        b",unknown,0.1,0.2,0.3",
+        b"",
+    ])
+    
+    def row_based_chunks(self, file_contents: bytes, old_chunk: bytes = None):
+        header, rows = csv_to_list(file_contents)
+        ret = {}
+        for data_bin, rows in binify_csv_rows(rows, "study", "patient", "accelerometer", header).items():
+            updated_header = convert_unix_to_human_readable_timestamps(header, rows)
+            if old_chunk:
+                _, old_rows = csv_to_list(old_chunk)
+                rows = list(old_rows) + rows
+            ensure_sorted_by_timestamp(rows)
+            ret[data_bin] = construct_csv_string(updated_header, rows)
+        return ret
+    
+    def columnar_chunks(self, file_contents: bytes, old_chunk: bytes = None):
+        header, columnar_rows = parse_columnar_csv(file_contents)
+        ret = {}
+        binified = binify_columnar_rows(columnar_rows, "study", "patient", "accelerometer", header)
+        for data_bin, pieces in binified.items():
+            rows = ColumnarRows.concatenate(pieces).with_utc_time_column()
+            if old_chunk:
+                rows = ColumnarRows.concatenate((parse_columnar_csv(old_chunk)[1], rows))
+            ret[data_bin] = rows.to_csv(b"timestamp,UTC time,accuracy,x,y,z")
+        return ret
+    
+    def test_identical_to_row_based_output(self):
+        row_based = self.row_based_chunks(self.FILE_CONTENTS)
+        self.assertEqual(len(row_based), 2)
+        self.assertEqual(row_based, self.columnar_chunks(self.FILE_CONTENTS))
+    
+    def test_identical_to_row_based_output_with_existing_chunk(self):
+        old_chunk = b"timestamp,UTC time,accuracy,x,y,z\n" \
+            b"1539395563219,2018-10-13T01:52:43.219,unknown,0.7,0.8,0.9\n" \
+            b"1539395560000,2018-10-13T01:52:40.000,unknown,1,2,3"
+        self.assertEqual(
+            self.row_based_chunks(self.FILE_CONTENTS, old_chunk),
+            self.columnar_chunks(self.FILE_CONTENTS, old_chunk),
+        )
+    
+    def test_utc_time_column_pads_milliseconds(self):
+        _, rows = parse_columnar_csv(b"timestamp,x\n1539395563009,1\n1539395563000")
+        self.assertEqual(
+            rows.with_utc_time_column().lines.tolist(),
+            [b"1539395563009,2018-10-13T01:52:43.009,1", b"1539395563000,2018-10-13T01:52:43.000"],
+        )
+    
+    def test_irregular_rows_fall_back(self):
+        for bad_line in (b"153939556321,1,2,3", b"15393955632190,1,2,3", b"1539395563a19,1,2,3"):
+            header, rows = parse_columnar_csv(self.HEADER + b"\n" + bad_line)
+            self.assertEqual(header, self.HEADER)
+            self.assertIsNone(rows)
+    
+    def test_header_only(self):
+        header, rows = parse_columnar_csv(self.HEADER)
+        self.assertEqual(header, self.HEADER)
+        self.assertEqual(len(rows), 0)
+
+
+class TestParsingProcessPool(unittest.TestCase):
+    ACCELEROMETER_FILE = TestColumnarCsvs.FILE_CONTENTS
+    GPS_FILE = b"timestamp, latitude, longitude, altitude, accuracy\n" \
+        b"1539395563219,1.5,2.5,3,4\n1539395563009,1.5,2.5,3,4\n1539399600001,1.5,2.5,3,4"
+    CALL_LOG_FILE = b"hashed phone number,call type,timestamp,duration in seconds\n" \
+        b"abc=,Outgoing Call,1539395563219,30\nabc=,Incoming Call,1539395560000,12"
+    FILES = [
+        (ACCELEROMETER_FILE, "accelerometer", "ANDROID", "patient/accel/1539395563219.csv"),
+        (ACCELEROMETER_FILE + b"\n153939556abc,unknown,1,2,3", "accelerometer", "ANDROID",
+            "patient/accel/1539395563220.csv"),
+        (GPS_FILE, "gps", "ANDROID", "patient/gps/1539395563219.csv"),
+        (CALL_LOG_FILE, "calls", "ANDROID", "patient/callLog/1539395563219.csv"),
+    ]
+    
+    @staticmethod
+    def chunks(binified_data: dict) -> dict:
+        ret = {}
+        for data_bin, rows in binified_data.items():
+            if isinstance(rows[0], ColumnarRows):
+                ret[data_bin] = ColumnarRows.concatenate(rows).with_utc_time_column().to_csv(b"")
+            else:
+                convert_unix_to_human_readable_timestamps(b"", rows)
+                ensure_sorted_by_timestamp(rows)
+                ret[data_bin] = construct_csv_string(b"", rows)
+        return ret
+    
+    def test_identical_to_single_process(self):
+        pool = Pool(2)
+        try:
+            for file_contents, data_type, os_type, path in self.FILES:
+                parameters = (file_contents, data_type, os_type, path, "study", "patient")
+                in_process = binify_file_contents(*parameters)
+                in_pool = pool.apply_async(binify_file_contents, parameters).get()
+                self.assertEqual(in_process[1], in_pool[1])
+                self.assertEqual(self.chunks(in_process[0]), self.chunks(in_pool[0]))
+        finally:
+            pool.terminate()
+
+
+class TestProcessingScheduler(CommonTestCase):
+    
+    def generate_files_to_process(self, participant, count: int, age: timedelta):
+        for i in range(count):
+            self.generate_file_to_process(
+                f"{self.default_study.object_id}/{participant.patient_id}/gps/{i}.csv",
+                participant=participant,
+            )
+        FileToProcess.objects.filter(participant=participant).update(created_on=timezone.now() - age)
+    
+    def test_no_files(self):
+        self.assertEqual(get_processing_work_units(), [])
+        self.assertEqual(get_processing_backlog_by_study(), {})
+    
+    def test_priority_order(self):
+        small_old = self.generate_participant(self.default_study, "smallold")
+        small_new = self.generate_participant(self.default_study, "smallnew")
+        large_old = self.generate_participant(self.default_study, "largeold")
+        self.generate_files_to_process(small_old, 2, timedelta(hours=2))
+        self.generate_files_to_process(small_new, 2, timedelta(minutes=10))
+        self.generate_files_to_process(large_old, 20, timedelta(hours=2))
+        work_units = get_processing_work_units()
+        self.assertEqual(
+            [work_unit.participant_id for work_unit in work_units],
+            [small_old.pk, large_old.pk, small_new.pk],
+        )
+        self.assertEqual([work_unit.file_count for work_unit in work_units], [2, 20, 2])
+    
+    def test_large_backlog_is_not_starved(self):
+        large_old = self.generate_participant(self.default_study, "largeold")
+        small_new = self.generate_participant(self.default_study, "smallnew")
+        self.generate_files_to_process(large_old, 20, timedelta(days=1))
+        self.generate_files_to_process(small_new, 1, timedelta(minutes=10))
+        self.assertEqual(get_processing_work_units()[0].participant_id, large_old.pk)
+    
+    def test_deleted_files_are_excluded(self):
+        self.generate_files_to_process(self.default_participant, 3, timedelta(hours=1))
+        FileToProcess.objects.filter(s3_file_path__endswith="/0.csv").update(deleted=True)
+        work_units = get_processing_work_units()
+        self.assertEqual(len(work_units), 1)
+        self.assertEqual(work_units[0].file_count, 2)
+    
+    def test_backlog_by_study(self):
+        participant_2 = self.generate_participant(self.default_study, "prtcpnt2")
+        self.generate_files_to_process(self.default_participant, 10, timedelta(hours=1))
+        self.generate_files_to_process(participant_2, 30, timedelta(hours=2))
+        backlog = get_processing_backlog_by_study()
+        self.assertEqual(list(backlog), [self.default_study.pk])
+        metrics = backlog[self.default_study.pk]
+        self.assertEqual(metrics["participants"], 2)
+        self.assertEqual(metrics["files"], 40)
+        self.assertEqual(metrics["largest_participant_files"], 30)
+        self.assertAlmostEqual(metrics["oldest_file_age_seconds"], 7200, delta=5)
+
+
+class TestChunkRegistryBulkOperations(CommonTestCase):
+    GPS_HEADER = b"timestamp,latitude,longitude,altitude,accuracy"
+    FIRST_TIME_BIN = 427609  # 2018-10-13T01:00:00
+    
+    def setUp(self):
+        super().setUp()
+        self.fake_s3 = {}
+        for target in ("libs.chunk_cache.s3_retrieve",
+                       "libs.file_processing.batched_network_operations.s3_upload",
+                       "libs.file_processing.file_processing_core.s3_upload"):
+            patcher = patch(target)
+            self.addCleanup(patcher.stop)
+            patcher.start().side_effect = self.fake_s3_operation
+    
+    def fake_s3_operation(self, path, *args, raw_path=False):
+        # s3_retrieve takes (path, study_object_id), s3_upload takes (path, contents, study_object_id)
+        if len(args) == 2:
+            self.fake_s3[path] = args[0]
+        return self.fake_s3[path]
+    
+    def binified_data(self, number_of_bins: int) -> dict:
+        ret = {}
+        for time_bin in range(self.FIRST_TIME_BIN, self.FIRST_TIME_BIN + number_of_bins):
+            timestamp = str(time_bin * 3600 * 1000 + 1).encode()
+            ret[(self.default_study.object_id, self.default_participant.patient_id, "gps",
+                 time_bin, self.GPS_HEADER)] = ([[timestamp, b"1", b"2", b"3", b"4"]], [time_bin])
+        return ret
+    
+    def chunk_path(self, time_bin: int) -> str:
+        return construct_s3_chunk_path(
+            self.default_study.object_id, self.default_participant.patient_id, "gps", time_bin
+        )
+    
+    def upload_binified_data(self, binified_data: dict) -> int:
+        """ The merge and upload stages of data processing for one page of files. """
+        pool = ThreadPool(4)
+        self.addCleanup(pool.terminate)
+        with CaptureQueriesContext(connection) as queries:
+            uploads = CsvMerger(
+                binified_data, null_error_handler, {}, self.default_participant, upload_pool=pool
+            )
+            wait_for_uploads(uploads)
+        return len(queries)
+    
+    def test_new_and_existing_chunks(self):
+        existing_path = self.chunk_path(self.FIRST_TIME_BIN)
+        self.fake_s3[existing_path] = b"timestamp,UTC time,latitude,longitude,altitude,accuracy\n" \
+            b"1539392400000,2018-10-13T01:00:00.000,5,6,7,8"
+        existing = self.generate_chunkregistry(
+            self.default_study, self.default_participant, "gps", path=existing_path, file_size=1,
+            is_chunkable=True,
+        )
+        self.upload_binified_data(self.binified_data(3))
+        
+        self.assertEqual(ChunkRegistry.objects.count(), 3)
+        existing.refresh_from_db()
+        self.assertEqual(existing.file_size, len(self.fake_s3[existing_path]))
+        self.assertEqual(self.fake_s3[existing_path].count(b"\n"), 2)
+        for time_bin in (self.FIRST_TIME_BIN + 1, self.FIRST_TIME_BIN + 2):
+            new = ChunkRegistry.objects.get(chunk_path=self.chunk_path(time_bin))
+            self.assertEqual(new.file_size, len(self.fake_s3[new.chunk_path]))
+            self.assertEqual(new.participant_id, self.default_participant.pk)
+            self.assertEqual(new.data_type, "gps")
+            self.assertTrue(new.is_chunkable)
+    
+    def test_bins_of_the_same_chunk(self):
+        # the header changed partway through a page, both bins are merged into one upload
+        binified_data = self.binified_data(1)
+        timestamp = str(self.FIRST_TIME_BIN * 3600 * 1000 + 2).encode()
+        binified_data[(self.default_study.object_id, self.default_participant.patient_id, "gps",
+                       self.FIRST_TIME_BIN, self.GPS_HEADER + b",extra")] = \
+            ([[timestamp, b"5", b"6", b"7", b"8"]], [self.FIRST_TIME_BIN + 1])
+        chunk_path = self.chunk_path(self.FIRST_TIME_BIN)
+        
+        self.upload_binified_data(binified_data)  # a new chunk
+        self.assertEqual(self.fake_s3[chunk_path].count(b"\n"), 2)
+        self.assertEqual(ChunkRegistry.objects.get().file_size, len(self.fake_s3[chunk_path]))
+        self.upload_binified_data(binified_data)  # an existing chunk
+        self.assertEqual(self.fake_s3[chunk_path].count(b"\n"), 4)
+        self.assertEqual(ChunkRegistry.objects.get().file_size, len(self.fake_s3[chunk_path]))
+    
+    def test_query_count_does_not_scale_with_bins(self):
+        few_bins_query_count = self.upload_binified_data(self.binified_data(2))
+        # 2 existing chunks and 18 new chunks.
+        many_bins_query_count = self.upload_binified_data(self.binified_data(20))
+        self.assertEqual(ChunkRegistry.objects.count(), 20)
+        self.assertLessEqual(many_bins_query_count, few_bins_query_count + 2)
+    
+    def expected_gps_bytes(self) -> dict:
+        study_timezone = self.default_study.timezone
+        expected = {}
+        for chunk in ChunkRegistry.objects.filter(data_type="gps"):
+            day = chunk.time_bin.astimezone(study_timezone).date()
+            expected[day] = expected.get(day, 0) + chunk.file_size
+        return expected
+    
+    def test_data_quantity_stats(self):
+        self.upload_binified_data(self.binified_data(30))  # spans two days
+        self.upload_binified_data(self.binified_data(2))  # updates existing chunks
+        stats = dict(SummaryStatisticDaily.objects.values_list("date", "beiwe_gps_bytes"))
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats, self.expected_gps_bytes())
+        self.assertEqual(self.dashboard_gps_bytes(), self.expected_gps_bytes())
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant), 0)
+        
+        # reconciliation corrects drift, e.g. from a deleted chunk
+        ChunkRegistry.objects.filter(chunk_path=self.chunk_path(self.FIRST_TIME_BIN)).delete()
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant), 1)
+        stats = dict(SummaryStatisticDaily.objects.values_list("date", "beiwe_gps_bytes"))
+        self.assertEqual(stats, self.expected_gps_bytes())
+        self.assertEqual(self.dashboard_gps_bytes(), self.expected_gps_bytes())
+        
+        # heatmap cells of days without data are removed
+        ChunkRegistry.objects.all().delete()
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant), 2)
+        self.assertFalse(DashboardDataQuantity.objects.exists())
+    
+    def dashboard_gps_bytes(self) -> dict:
+        return dict(DashboardDataQuantity.objects.filter(
+            participant=self.default_participant, data_type="gps"
+        ).values_list("date", "bytes"))
+    
+    def test_data_quantity_stats_unchunked_files(self):
+        path = f"{self.default_participant.patient_id}/voiceRecording/1539392400000.mp4"
+        file_for_processing = MagicMock(
+            data_type="audio_recordings", file_contents=b"x" * 10,
+            file_to_process=self.generate_file_to_process(path),
+        )
+        process_unchunkable_file(file_for_processing, set())
+        file_for_processing.file_contents = b"x" * 15  # uploaded again
+        process_unchunkable_file(file_for_processing, set())
+        stats = SummaryStatisticDaily.objects.get()
+        self.assertEqual(stats.beiwe_audio_recordings_bytes, 15)
+    
+    def test_time_bin_extents(self):
+        study = self.default_study
+        first_time_bin = datetime.fromtimestamp(self.FIRST_TIME_BIN * 3600, tz=timezone.utc)
+        last_time_bin = first_time_bin + timedelta(hours=2)
+        self.upload_binified_data(self.binified_data(3))
+        extent = ChunkTimeBinExtent.objects.get()
+        self.assertEqual(extent.earliest_time_bin, first_time_bin)
+        self.assertEqual(extent.latest_time_bin, last_time_bin)
+        self.assertEqual(study.get_earliest_data_time_bin(), first_time_bin)
+        self.assertEqual(study.get_latest_data_time_bin(), last_time_bin)
+        
+        # time bins from before the epoch or from the future are excluded by default
+        epoch_time_bin = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        future_time_bin = timezone.now() + timedelta(days=365)
+        for time_bin in (epoch_time_bin, future_time_bin):
+            self.generate_chunkregistry(study, self.default_participant, "gps", time_bin=time_bin)
+        self.assertEqual(ChunkTimeBinExtent.recalculate(self.default_participant), 1)
+        self.assertEqual(study.get_earliest_data_time_bin(), first_time_bin)
+        self.assertEqual(study.get_latest_data_time_bin(), last_time_bin)
+        self.assertEqual(study.get_earliest_data_time_bin(only_after_epoch=False), epoch_time_bin)
+        self.assertEqual(study.get_latest_data_time_bin(only_before_now=False), future_time_bin)
+        
+        ChunkRegistry.objects.all().delete()
+        self.assertEqual(ChunkTimeBinExtent.recalculate(self.default_participant), 1)
+        self.assertFalse(ChunkTimeBinExtent.objects.exists())
+        self.assertIsNone(study.get_earliest_data_time_bin())
+    
+    def test_rollups(self):
+        def accelerometer_bin(time_bin: int, minute: int, x: bytes) -> dict:
+            timestamp = str(time_bin * 3600 * 1000 + minute * 60 * 1000).encode()
+            return {
+                (self.default_study.object_id, self.default_participant.patient_id,
+                 "accelerometer", time_bin, b"timestamp,accuracy,x,y,z"):
+                    ([[timestamp, b"unknown", x, b"0", b"0"]], [time_bin])
+            }
+        
+        self.upload_binified_data(accelerometer_bin(self.FIRST_TIME_BIN, 0, b"1"))
+        self.upload_binified_data(accelerometer_bin(self.FIRST_TIME_BIN + 1, 0, b"3"))
+        # more data in an hour that has a rollup already, the hour's rows are recomputed.
+        self.upload_binified_data(accelerometer_bin(self.FIRST_TIME_BIN, 0, b"3"))
+        
+        rollup = ChunkRegistry.objects.get(data_type="accelerometer_minutes")
+        self.assertEqual(rollup.time_bin, datetime(2018, 10, 13, tzinfo=timezone.utc))
+        self.assertEqual(rollup.file_size, len(self.fake_s3[rollup.chunk_path]))
+        self.assertEqual(
+            self.fake_s3[rollup.chunk_path],
+            ROLLUP_HEADER + b"\n1539392400000,2018-10-13T01:00:00,2,2,1,0,0,0,0,2,1"
+            b"\n1539396000000,2018-10-13T02:00:00,1,3,0,0,0,0,0,3,0"
+        )
+        # gps has no rollups
+        self.upload_binified_data(self.binified_data(1))
+        self.assertEqual(ChunkRegistry.objects.filter(data_type__endswith="_minutes").count(), 1)
+
+
+# the pipeline queries the database from its producer thread, which can only see committed data.
+class TestProcessingPipeline(TransactionTestCase, ReferenceObjectMixin):
+    FIRST_TIME_BIN = 427609  # 2018-10-13T01:00:00
+    
+    def setUp(self):
+        super().setUp()
+        self.fake_s3 = {}
+        self.events = []  # (list.append is thread-safe)
+        self.failing_paths = set()
+        for target, side_effect in (
+            ("libs.file_processing.file_for_processing.s3_retrieve", self.fake_s3_retrieve),
+            ("libs.chunk_cache.s3_retrieve", self.fake_s3_retrieve),
+            ("libs.file_processing.batched_network_operations.s3_upload", self.fake_s3_upload),
+            ("libs.file_processing.file_processing_core.s3_upload", self.fake_s3_upload),
+        ):
+            patcher = patch(target)
+            self.addCleanup(patcher.stop)
+            patcher.start().side_effect = side_effect
+        
+        def record_retirement(instance: FileToProcess, **kwargs):
+            self.events.append(("retire", instance.s3_file_path))
+        post_delete.connect(record_retirement, sender=FileToProcess)
+        self.addCleanup(post_delete.disconnect, record_retirement, sender=FileToProcess)
+        
+        # one gps file per hour, so every file has its own chunk
+        self.file_paths = []
+        self.chunk_paths = []
+        for time_bin in range(self.FIRST_TIME_BIN, self.FIRST_TIME_BIN + 6):
+            timestamp = time_bin * 3600 * 1000 + 1
+            path = f"{self.default_participant.patient_id}/gps/{timestamp}.csv"
+            self.fake_s3[path] = b"timestamp,latitude,longitude,altitude,accuracy\n" \
+                b"%d,1,2,3,4" % timestamp
+            self.generate_file_to_process(path, os_type=ANDROID_API)
+            self.file_paths.append(path)
+            self.chunk_paths.append(construct_s3_chunk_path(
+                self.default_study.object_id, self.default_participant.patient_id, "gps", time_bin
+            ))
+    
+    def fake_s3_retrieve(self, path, study_object_id, raw_path=False):
+        if path in self.failing_paths:
+            raise Exception("download failed")
+        return self.fake_s3[path]
+    
+    def fake_s3_upload(self, path, contents, study_object_id, raw_path=False):
+        time.sleep(0.01)
+        self.fake_s3[path] = contents
+        self.events.append(("upload", path))
+    
+    def pipeline(self) -> ParticipantProcessingPipeline:
+        return ParticipantProcessingPipeline(self.default_participant, null_error_handler, 2)
+    
+    def test_pages_are_finished_before_the_next_page_is_merged(self):
+        pipeline = self.pipeline()
+        for name in ("merge_page", "finish_page"):
+            def record(page, name=name, function=getattr(pipeline, name)):
+                function(page)
+                self.events.append((name, page))
+            setattr(pipeline, name, record)
+        pipeline.run()
+        
+        page_events = [event for event in self.events if event[0].endswith("_page")]
+        pages = [page for name, page in page_events if name == "merge_page"]
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(
+            page_events, [(name, page) for page in pages for name in ("merge_page", "finish_page")]
+        )
+        self.assertEqual(pipeline.number_processed_files, 6)
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(ChunkRegistry.objects.count(), 6)
+    
+    def test_files_are_retired_after_their_uploads(self):
+        self.pipeline().run()
+        for first_file in range(0, 6, 2):
+            page = range(first_file, first_file + 2)
+            upload_positions = [self.events.index(("upload", self.chunk_paths[i])) for i in page]
+            retire_positions = [self.events.index(("retire", self.file_paths[i])) for i in page]
+            self.assertLess(max(upload_positions), min(retire_positions))
+    
+    def test_time_limit(self):
+        pipeline = self.pipeline()
+        pipeline.run(time_limit_seconds=1e-9)  # reached after the first page
+        self.assertFalse(pipeline.producer.is_alive())
+        self.assertEqual(pipeline.number_processed_files, 2)
+        self.assertEqual(FileToProcess.objects.count(), 4)
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+    
+    def test_download_error(self):
+        self.failing_paths.add(self.file_paths[2])
+        pipeline = self.pipeline()
+        with self.assertRaises(SomeException):
+            pipeline.run()
+        self.assertFalse(pipeline.producer.is_alive())
+        # the first page was merged before the error, it is finished.
+        self.assertEqual(
+            set(FileToProcess.objects.values_list("s3_file_path", flat=True)),
+            set(self.file_paths[2:]),
+        )
+        self.assertEqual(
+            set(ChunkRegistry.objects.values_list("chunk_path", flat=True)),
+            set(self.chunk_paths[:2]),
+        )
+    
+    def test_stop_unblocks_producer(self):
+        pipeline = ParticipantProcessingPipeline(self.default_participant, null_error_handler, 1)
+        pipeline.producer.start()
+        while not pipeline.download_queue.full():
+            time.sleep(0.01)
+        time.sleep(0.05)  # the producer is now waiting to put the next file on the queue
+        self.assertTrue(pipeline.producer.is_alive())
+        pipeline.stop()
+        self.assertFalse(pipeline.producer.is_alive())
+
+
+class TestDeviceDataDecryptor(CommonTestCase):
+    AES_KEY = b"0123456789abcdef"
+    IV = b"fedcba9876543210"
+    
+    with open(f"{BEIWE_PROJECT_ROOT}/tests/files/private_key", 'rb') as f:
+        PRIVATE_KEY = get_RSA_cipher(f.read())
+    
+    def setUp(self):
+        super().setUp()
+        patcher = patch("database.user_models_participant.Participant.get_private_key")
+        self.addCleanup(patcher.stop)
+        patcher.start().return_value = self.PRIVATE_KEY
+    
+    @property
+    def key_line(self) -> bytes:
+        # the apps encrypt the base64 encoded AES key with raw RSA.
+        key_int = pow(
+            int.from_bytes(encode_base64(self.AES_KEY), "big"), self.PRIVATE_KEY.e, self.PRIVATE_KEY.n
+        )
+        return encode_base64(key_int.to_bytes(self.PRIVATE_KEY.size_in_bytes(), "big"))
+    
+    def encrypt_line(self, line: bytes) -> bytes:
+        padding = 16 - len(line) % 16
+        encrypted = AES.new(self.AES_KEY, mode=AES.MODE_CBC, IV=self.IV) \
+            .encrypt(line + bytes([padding]) * padding)
+        return encode_base64(self.IV) + b":" + encode_base64(encrypted)
+    
+    def decrypt(self, *lines: bytes) -> DeviceDataDecryptor:
+        return DeviceDataDecryptor(
+            "some_file.csv", b"\n".join((self.key_line, *lines)), self.default_participant
+        )
+    
+    def test_decrypt(self):
+        lines = [b"1539395563219,unknown,0.1,0.2,0.3", b"", b"x" * 16, b"y" * 100]
+        decryptor = self.decrypt(*(self.encrypt_line(line) for line in lines))
+        self.assertEqual(decryptor.decrypted_file, b"\n".join(lines))
+        self.assertEqual(decryptor.error_count, 0)
+    
+    def test_data_overflowing_block_alignment(self):
+        # bytes past the last 16 byte block are dropped
+        iv, encrypted = self.encrypt_line(b"a line").split(b":")
+        overflowed = iv + b":" + encode_base64(decode_base64(encrypted) + b"12345")
+        decryptor = self.decrypt(overflowed, self.encrypt_line(b"another line"))
+        self.assertEqual(decryptor.decrypted_file, b"a line\nanother line")
+    
+    def test_line_errors(self):
+        good_line = self.encrypt_line(b"a good line")
+        decryptor = self.decrypt(
+            good_line,
+            good_line[:-3],  # truncated
+            good_line.replace(b":", b""),  # no separator
+            encode_base64(self.IV) + b":" + encode_base64(b"short"),  # less than a block of data
+            encode_base64(b"short") + b":" + good_line.split(b":")[1],  # bad iv
+            good_line,
+        )
+        self.assertEqual(decryptor.decrypted_file, b"a good line\na good line")
+        self.assertEqual(
+            decryptor.error_types, [
+                LineEncryptionError.PADDING_ERROR,
+                LineEncryptionError.MALFORMED_CONFIG,
+                LineEncryptionError.LINE_EMPTY,
+                LineEncryptionError.IV_MISSING,
+            ]
+        )
+        self.assertEqual(EncryptionErrorMetadata.objects.get().number_errors, 4)
+    
+    @patch("libs.participant_file_uploads.s3_delete")
+    @patch("libs.participant_file_uploads.s3_upload")
+    @patch("libs.participant_file_uploads.smart_s3_list_study_files")
+    @patch("libs.participant_file_uploads.s3_retrieve_plaintext")
+    @patch("libs.participant_file_uploads.get_client_private_key")
+    def test_decrypt_deferred_upload(
+        self, get_client_private_key: MagicMock, s3_retrieve_plaintext: MagicMock,
+        smart_s3_list_study_files: MagicMock, s3_upload: MagicMock, s3_delete: MagicMock
+    ):
+        get_cached_private_key.cache_clear()
+        get_client_private_key.return_value = self.PRIVATE_KEY
+        smart_s3_list_study_files.return_value = []
+        s3_retrieve_plaintext.return_value = b"\n".join(
+            (self.key_line, self.encrypt_line(b"a line"), self.encrypt_line(b"another line"))
+        )
+        path = f"{self.default_study.object_id}/{self.default_participant.patient_id}/gps/123.csv"
+        ftp = self.generate_file_to_process(path)
+        ftp.update(deferred_decryption=True)
+        
+        self.assertEqual(decrypt_deferred_upload(ftp), b"a line\nanother line")
+        ftp.refresh_from_db()
+        self.assertFalse(ftp.deferred_decryption)
+        self.assertEqual(ftp.s3_file_path, path)
+        s3_retrieve_plaintext.assert_called_once_with(f"RAW_UPLOADS/{path}")
+        s3_upload.assert_called_once_with(
+            path.split("/", 1)[1], b"a line\nanother line", self.default_participant
+        )
+        s3_delete.assert_called_once_with(f"RAW_UPLOADS/{path}")
+    
+    @patch("libs.participant_file_uploads.s3_delete")
+    @patch("libs.participant_file_uploads.s3_upload")
+    @patch("libs.participant_file_uploads.s3_retrieve_plaintext")
+    @patch("libs.participant_file_uploads.get_client_private_key")
+    def test_decrypt_deferred_upload_bad_key(
+        self, get_client_private_key: MagicMock, s3_retrieve_plaintext: MagicMock,
+        s3_upload: MagicMock, s3_delete: MagicMock
+    ):
+        get_cached_private_key.cache_clear()
+        get_client_private_key.return_value = self.PRIVATE_KEY
+        s3_retrieve_plaintext.return_value = b"some_content"
+        path = f"{self.default_study.object_id}/{self.default_participant.patient_id}/gps/123.csv"
+        ftp = self.generate_file_to_process(path)
+        ftp.update(deferred_decryption=True)
+        
+        # same outcome as the upload endpoint: a problem upload, and nothing to process.
+        self.assertIsNone(decrypt_deferred_upload(ftp))
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(GenericEvent.objects.count(), 1)
+        self.assertTrue(s3_upload.call_args.args[0].startswith("PROBLEM_UPLOADS/"))
+        s3_delete.assert_called_once_with(f"RAW_UPLOADS/{path}")
+    
+    @patch("libs.participant_file_uploads.s3_delete")
+    @patch("libs.participant_file_uploads.s3_retrieve")
+    @patch("libs.participant_file_uploads.s3_upload")
+    @patch("libs.participant_file_uploads.smart_s3_list_study_files")
+    @patch("libs.participant_file_uploads.s3_retrieve_plaintext")
+    @patch("libs.participant_file_uploads.get_client_private_key")
+    def test_decrypt_deferred_upload_ios_split_file_out_of_order(
+        self, get_client_private_key: MagicMock, s3_retrieve_plaintext: MagicMock,
+        smart_s3_list_study_files: MagicMock, s3_upload: MagicMock, s3_retrieve: MagicMock,
+        s3_delete: MagicMock
+    ):
+        get_cached_private_key.cache_clear()
+        get_client_private_key.return_value = self.PRIVATE_KEY
+        smart_s3_list_study_files.return_value = []
+        self.default_participant.update(os_type=IOS_API)
+        path = f"{self.default_study.object_id}/{self.default_participant.patient_id}/gps/123.csv"
+        
+        # the segment without the decryption key is processed first (the first line of a file is
+        # never data), it can't be decrypted yet and becomes a problem upload.
+        segment = b"\n".join((self.encrypt_line(b"not a key"), self.encrypt_line(b"another line")))
+        s3_retrieve_plaintext.return_value = segment
+        ftp = self.generate_file_to_process(path)
+        ftp.update(deferred_decryption=True)
+        self.assertIsNone(decrypt_deferred_upload(ftp))
+        problem_file_path = s3_upload.call_args.args[0]
+        self.assertTrue(problem_file_path.startswith(f"PROBLEM_UPLOADS/{path}"))
+        self.assertEqual(GenericEvent.objects.count(), 1)
+        
+        # the segment with the key is merged with it
+        s3_upload.reset_mock()
+        s3_retrieve.return_value = segment
+        s3_retrieve_plaintext.return_value = self.key_line + b"\n" + self.encrypt_line(b"a line")
+        ftp = self.generate_file_to_process(path)
+        ftp.update(deferred_decryption=True)
+        self.assertEqual(decrypt_deferred_upload(ftp), b"a line\nanother line")
+        s3_retrieve.assert_called_once_with(
+            problem_file_path, self.default_participant, raw_path=True
+        )
+        s3_upload.assert_called_once_with(
+            path.split("/", 1)[1], b"a line\nanother line", self.default_participant
+        )
+        self.assertFalse(GenericEvent.objects.exists())
+
+
+class TestS3Client(unittest.TestCase):
+    
+    def test_client_configuration(self):
+        client = get_s3_client(max_pool_connections=25)
+        self.assertEqual(client.meta.config.max_pool_connections, 25)
+        self.assertEqual(client.meta.config.retries["mode"], "adaptive")
+        self.assertTrue(client.meta.config.tcp_keepalive)
+    
+    def test_operation_stats(self):
+        stats = S3OperationStats()
+        client = get_s3_client(stats=stats)
+        with Stubber(client) as stubber:
+            stubber.add_response("put_object", {}, {"Bucket": "a", "Key": "b", "Body": b"12345"})
+            stubber.add_response("get_object", {"ContentLength": 3}, {"Bucket": "a", "Key": "b"})
+            client.put_object(Bucket="a", Key="b", Body=b"12345")
+            client.get_object(Bucket="a", Key="b")
+        
+        operations = stats.as_dict()
+        self.assertEqual(operations["PutObject"]["calls"], 1)
+        self.assertEqual(operations["PutObject"]["bytes"], 5)
+        self.assertEqual(operations["GetObject"]["calls"], 1)
+        self.assertEqual(operations["GetObject"]["bytes"], 3)
+        stats.reset()
+        self.assertEqual(stats.as_dict(), {})
+
+
+class TestS3Transfers(CommonTestCase):
+    # tiny parts, so that the tests exercise ranged downloads and multipart uploads.
+    PART_SIZE = 64
+    
+    def setUp(self):
+        super().setUp()
+        self.s3_client = DummyS3Client()
+        for target, value in (
+            ("libs.s3.conn", self.s3_client),
+            ("libs.s3.S3_BUCKET", "bucket"),
+            ("libs.s3.S3_TRANSFER_PART_SIZE", self.PART_SIZE),
+            ("libs.s3.S3_TRANSFER_THRESHOLD", 2 * self.PART_SIZE),
+        ):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+    
+    def test_small_file(self):
+        s3_upload("some/file.csv", b"a small file", self.default_study)
+        self.assertEqual(self.s3_client.multipart_uploads, {})
+        self.assertEqual(s3_retrieve("some/file.csv", self.default_study), b"a small file")
+    
+    def test_large_file(self):
+        data = bytes(range(256)) * 4 + b"end"
+        s3_upload("some/file.csv", data, self.default_study)
+        stored = self.s3_client.files[f"{self.default_study.object_id}/some/file.csv"]
+        self.assertEqual(len(stored), len(data) + 16)  # the iv
+        self.assertEqual(s3_retrieve("some/file.csv", self.default_study), data)
+        
+        with TemporaryDirectory() as temp_dir:
+            file_path = path_join(temp_dir, "file.csv")
+            s3_retrieve_to_file("some/file.csv", self.default_study, file_path)
+            with open(file_path, "rb") as f:
+                self.assertEqual(f.read(), data)
+    
+    def test_file_sizes_around_part_boundaries(self):
+        for size in range(2 * self.PART_SIZE - 20, 3 * self.PART_SIZE + 20):
+            data = bytes(i % 251 for i in range(size))
+            s3_upload("some/file.csv", data, self.default_study)
+            self.assertEqual(s3_retrieve("some/file.csv", self.default_study), data)
+    
+    def test_failed_multipart_upload_is_aborted(self):
+        with patch.object(self.s3_client, "upload_part", side_effect=Exception("failed")):
+            with self.assertRaises(Exception):
+                s3_upload("some/file.csv", b"x" * 1000, self.default_study)
+        self.assertEqual(self.s3_client.multipart_uploads, {})
+        self.assertEqual(self.s3_client.files, {})
+
+
+class TestChunkPrefetcher(CommonTestCase):
+    
+    def setUp(self):
+        super().setUp()
+        for target, value in (("libs.s3.conn", DummyS3Client()), ("libs.s3.S3_BUCKET", "bucket")):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+    
+    def test_order_and_prefetch_budget(self):
+        # a pool that starts nothing until a result is requested, so that what has been started
+        # when the consumer receives a file is exactly what the prefetcher reserved.
+        started = []
+        
+        class LazyPool:
+            def apply_async(self, func, args=()):
+                started.append(args[0]["chunk_path"])
+                return DummyAsyncResult(func(*args))
+        
+        chunks = []
+        for i in range(6):
+            s3_upload(f"chunk_{i}", f"content {i}".encode(), self.default_study, raw_path=True)
+            chunks.append(
+                {"chunk_path": f"chunk_{i}", "study_id": self.default_study.id, "file_size": 10}
+            )
+        
+        prefetcher = ChunkPrefetcher(chunks, LazyPool(), prefetch_bytes=25)
+        consumed = []
+        for chunk, file_contents in prefetcher:
+            consumed.append(chunk["chunk_path"])
+            self.assertEqual(file_contents, f"content {len(consumed) - 1}".encode())
+            # 3 files of 10 bytes reach the 25 byte budget, the first file is still held.
+            self.assertLessEqual(len(started) - len(consumed), 2)
+        self.assertEqual(consumed, [f"chunk_{i}" for i in range(6)])
+        self.assertEqual(prefetcher.file_count, 6)
+        self.assertEqual(len(prefetcher.studies), 1)
+    
+    def test_oversized_file_is_still_downloaded(self):
+        s3_upload("big", b"x" * 100, self.default_study, raw_path=True)
+        chunks = [{"chunk_path": "big", "study_id": self.default_study.id, "file_size": 100}]
+        prefetcher = ChunkPrefetcher(chunks, DummyThreadPool(), prefetch_bytes=10)
+        self.assertEqual([contents for _, contents in prefetcher], [b"x" * 100])
+
+
+@unittest.skipUnless(COLUMNAR_EXPORT_AVAILABLE, "pyarrow is not installed")
+class TestColumnarExport(unittest.TestCase):
+    CHUNK = {"participant_id": 1, "participant__patient_id": "patient", "data_type": "gyro",
+             "survey_id": None, "chunk_path": "path.csv", "time_bin": "2020-10-05 01:00:00+00:00"}
+    
+    def test_csv_to_table(self):
+        table = csv_to_table(b"timestamp,UTC time,x,y\n1000,a,1,0.5\n2000,b,2,", "gyro")
+        self.assertEqual(table.column_names, ["timestamp", "x", "y"])
+        self.assertEqual([str(field.type) for field in table.schema], ["int64", "float", "float"])
+        self.assertRaises(ValueError, csv_to_table, b"not,chunked\n1,2", "gyro")
+    
+    def test_files_are_split(self):
+        generator = ColumnarExportGenerator([], "parquet")
+        first = csv_to_table(b"timestamp,UTC time,x\n1000,a,1", "gyro")
+        changed_header = csv_to_table(b"timestamp,UTC time,x,y\n2000,a,1,2", "gyro")
+        self.assertEqual(generator.get_entries(self.CHUNK, first), [])
+        self.assertEqual(generator.get_entries(self.CHUNK, first), [])
+        # a changed header completes the current file
+        self.assertEqual(len(generator.get_entries(self.CHUNK, changed_header)), 1)
+        # as does a different participant
+        self.assertEqual(len(generator.get_entries({**self.CHUNK, "participant_id": 2}, first)), 1)
+        self.assertEqual(len(generator.get_final_entries()), 1)
+        self.assertEqual(generator.get_final_entries(), [])
+        
+        generator.max_file_bytes = 1
+        self.assertEqual(len(generator.get_entries(self.CHUNK, first)), 1)
+
+
+class TestChunkCache(CommonTestCase):
+    
+    def setUp(self):
+        super().setUp()
+        self.s3_client = DummyS3Client()
+        for target, value in (("libs.s3.conn", self.s3_client), ("libs.s3.S3_BUCKET", "bucket")):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache = ChunkCache(temp_dir.name, max_bytes=1000)
+    
+    def chunk(self, contents: bytes, chunk_path: str = "chunk") -> dict:
+        s3_upload(chunk_path, contents, self.default_study, raw_path=True)
+        return {
+            "chunk_path": chunk_path,
+            "chunk_hash": chunk_hash(contents).decode(),
+            "file_size": len(contents),
+        }
+    
+    def test_hit_and_miss(self):
+        chunk = self.chunk(b"some data")
+        self.assertEqual(self.cache.retrieve(chunk, self.default_study), b"some data")
+        self.s3_client.files.clear()  # a second retrieve must not touch s3
+        self.assertEqual(self.cache.retrieve(chunk, self.default_study), b"some data")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+    
+    def test_changed_chunk_is_not_a_hit(self):
+        self.cache.retrieve(self.chunk(b"old data"), self.default_study)
+        chunk = self.chunk(b"new data")
+        self.assertEqual(self.cache.retrieve(chunk, self.default_study), b"new data")
+        self.assertEqual(self.cache.hits, 0)
+    
+    def test_disabled(self):
+        cache = ChunkCache(self.cache.directory, max_bytes=0)
+        chunk = self.chunk(b"some data")
+        cache.retrieve(chunk, self.default_study)
+        self.assertIsNone(cache.get(chunk))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+    
+    def test_eviction_by_byte_budget(self):
+        chunks = [self.chunk(bytes([i]) * 100, f"chunk_{i}") for i in range(15)]
+        for i, chunk in enumerate(chunks):
+            self.cache.put(chunk, bytes([i]) * 100)
+            # keep the first chunk recently used
+            self.assertIsNotNone(self.cache.get(chunks[0]))
+            # modification times can be too coarse to order files written in a tight loop
+            os.utime(self.cache.get_path(chunk), (i, i))
+        cached = [i for i, chunk in enumerate(chunks) if self.cache.get(chunk) is not None]
+        self.assertLessEqual(len(cached) * 100, 1000)
+        self.assertIn(0, cached)
+        self.assertIn(14, cached)
+        self.assertNotIn(1, cached)
+    
+    def test_failed_put_leaves_no_files(self):
+        chunk = self.chunk(b"some data", "CHUNKED_DATA/study/patient/gps/file.csv")
+        with patch("libs.chunk_cache.os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.cache.put(chunk, b"some data")
+        for _, _, file_names in os.walk(self.cache.directory):
+            self.assertEqual(file_names, [])
+    
+    def test_retrieve_to_file(self):
+        chunk = self.chunk(b"some data")
+        with TemporaryDirectory() as temp_dir:
+            for name in ("first", "second"):
+                file_path = path_join(temp_dir, name)
+                self.cache.retrieve_to_file(chunk, self.default_study, file_path)
+                with open(file_path, "rb") as f:
+                    self.assertEqual(f.read(), b"some data")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+    
+    def test_retrieve_to_file_duplicate_file_name(self):
+        first_chunk = self.chunk(b"first data", "first_chunk")
+        second_chunk = self.chunk(b"second data", "second_chunk")
+        with TemporaryDirectory() as temp_dir:
+            file_path = path_join(temp_dir, "file")
+            self.cache.retrieve_to_file(first_chunk, self.default_study, file_path)
+            with self.assertRaises(FileExistsError):
+                self.cache.retrieve_to_file(second_chunk, self.default_study, file_path)
+            # the cached file, which is linked to file_path, must not be overwritten
+            self.assertEqual(self.cache.get(first_chunk), b"first data")
+    
+    def test_retrieve_to_file_without_hard_links(self):
+        chunk = self.chunk(b"some data")
+        self.cache.retrieve(chunk, self.default_study)
+        with TemporaryDirectory() as temp_dir, \
+                patch("libs.chunk_cache.os.link", side_effect=OSError(errno.EXDEV, "")):
+            file_path = path_join(temp_dir, "file")
+            self.cache.retrieve_to_file(chunk, self.default_study, file_path)
+            with open(file_path, "rb") as f:
+                self.assertEqual(f.read(), b"some data")
+            self.assertEqual(os.stat(file_path).st_nlink, 1)
+            with self.assertRaises(FileExistsError):
+                self.cache.retrieve_to_file(chunk, self.default_study, file_path)
+            self.assertEqual(os.listdir(temp_dir), ["file"])
+    
+    def test_purge_participant(self):
+        chunks = [
+            self.chunk(b"some data", f"CHUNKED_DATA/study/{patient_id}/gps/file.csv")
+            for patient_id in ("patient1", "patient2")
+        ]
+        chunks.append(self.chunk(b"some data", "study/patient1/voiceRecording/file.mp4"))
+        for chunk in chunks:
+            self.cache.retrieve(chunk, self.default_study)
+        self.cache.purge_participant("study", "patient1")
+        self.assertIsNone(self.cache.get(chunks[0]))
+        self.assertEqual(self.cache.get(chunks[1]), b"some data")
+        self.assertIsNone(self.cache.get(chunks[2]))
+    
+    def test_refresh_purged_participants(self):
+        # the participant's data was deleted on another server, this server's cache has its files
+        chunk_path = "CHUNKED_DATA/{}/{}/gps/file.csv".format(
+            self.default_study.object_id, self.default_participant.patient_id
+        )
+        chunk = self.chunk(b"some data", chunk_path)
+        self.cache.retrieve(chunk, self.default_study)
+        self.cache.refresh_purged_participants()
+        self.assertEqual(self.cache.get(chunk), b"some data")
+        
+        self.default_participant_deletion_event
+        self.cache.purged_refreshed_at = None
+        self.cache.refresh_purged_participants()
+        self.assertEqual(os.listdir(self.cache.directory), [])
+        # and the participant's files are never cached again
+        self.cache.retrieve(chunk, self.default_study)
+        self.assertIsNone(self.cache.get(chunk))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+    
+    def test_eviction_skips_pinned_files(self):
+        chunks = [self.chunk(bytes([i]) * 100, f"chunk_{i}") for i in range(15)]
+        with TemporaryDirectory() as temp_dir:
+            # the least recently used chunk is linked into a task's input folder
+            self.cache.retrieve_to_file(chunks[0], self.default_study, path_join(temp_dir, "0"))
+            os.utime(self.cache.get_path(chunks[0]), (0, 0))
+            for i, chunk in enumerate(chunks[1:], start=1):
+                self.cache.put(chunk, bytes([i]) * 100)
+                os.utime(self.cache.get_path(chunk), (i, i))
+            self.assertTrue(os.path.exists(self.cache.get_path(chunks[0])))
+            self.assertFalse(os.path.exists(self.cache.get_path(chunks[1])))
+        
+        # the task's files were cleaned up, the chunk is no longer pinned
+        self.cache.max_bytes = 100
+        self.cache.evict()
+        self.assertFalse(os.path.exists(self.cache.get_path(chunks[0])))
+
+
 class TestParticipantDataDeletion(CommonTestCase):
     
     def assert_default_participant_end_state(self):
@@ -187,17 +1221,20 @@ class TestParticipantDataDeletion(CommonTestCase):
         # to and parameters to s3_delete_many_versioned.
         self.assertEqual(s3_delete_many_versioned.call_count, delete_versioned_count)
         
-        path_keys, path_participant, path_chunked, path_problems = get_all_file_path_prefixes(self.default_participant)
+        path_keys, path_participant, path_chunked, path_problems, path_raw_uploads = \
+            get_all_file_path_prefixes(self.default_participant)
         if list_files_count == COUNT_OF_PATHS_RETURNED_FROM_GET_ALL_FILE_PATH_PREFIXES:
             self.assertEqual(s3_list_files.call_args_list[0].args[0], path_keys)
             self.assertEqual(s3_list_files.call_args_list[1].args[0], path_participant)
             self.assertEqual(s3_list_files.call_args_list[2].args[0], path_chunked)
             self.assertEqual(s3_list_files.call_args_list[3].args[0], path_problems)
+            self.assertEqual(s3_list_files.call_args_list[4].args[0], path_raw_uploads)
         if list_versions_count == COUNT_OF_PATHS_RETURNED_FROM_GET_ALL_FILE_PATH_PREFIXES:
             self.assertEqual(s3_list_versions.call_args_list[0].args[0], path_keys)
             self.assertEqual(s3_list_versions.call_args_list[1].args[0], path_participant)
             self.assertEqual(s3_list_versions.call_args_list[2].args[0], path_chunked)
             self.assertEqual(s3_list_versions.call_args_list[3].args[0], path_problems)
+            self.assertEqual(s3_list_versions.call_args_list[4].args[0], path_raw_uploads)
     
     def test_no_participants_at_all(self):
         self.assertFalse(Participant.objects.exists())
@@ -224,7 +1261,11 @@ class TestParticipantDataDeletion(CommonTestCase):
     ):
         self.default_participant_deletion_event  # includes default_participant creation
         self.assertEqual(Participant.objects.count(), 1)
-        run_next_queued_participant_data_deletion()
+        with patch("libs.participant_purge.chunk_cache") as chunk_cache:
+            run_next_queued_participant_data_deletion()
+        chunk_cache.purge_participant.assert_called_once_with(
+            self.default_study.object_id, self.default_participant.patient_id
+        )
         self.assertEqual(Participant.objects.count(), 1)  # we don't actually delete the db object just the data...
         self.default_participant.refresh_from_db()
         self.assert_default_participant_end_state()
@@ -360,6 +1401,24 @@ class TestParticipantDataDeletion(CommonTestCase):
         self.assertRaises(AssertionError, confirm_deleted, self.default_participant_deletion_event)
         SummaryStatisticDaily.objects.all().delete()
         confirm_deleted(self.default_participant_deletion_event)
+        
+        # ChunkTimeBinExtent
+        ChunkTimeBinExtent.objects.create(
+            study=self.default_study, participant=self.default_participant, data_type="gps",
+            earliest_time_bin=timezone.now(), latest_time_bin=timezone.now(),
+        )
+        self.assertRaises(AssertionError, confirm_deleted, self.default_participant_deletion_event)
+        ChunkTimeBinExtent.objects.all().delete()
+        confirm_deleted(self.default_participant_deletion_event)
+        
+        # DashboardDataQuantity
+        DashboardDataQuantity.objects.create(
+            study=self.default_study, participant=self.default_participant, data_type="gps",
+            date=date.today(), bytes=1,
+        )
+        self.assertRaises(AssertionError, confirm_deleted, self.default_participant_deletion_event)
+        DashboardDataQuantity.objects.all().delete()
+        confirm_deleted(self.default_participant_deletion_event)
     
     def test_related_fields(self):
         # this test will fail whenever there is a new related model added to the codebase for a
@@ -370,6 +1429,8 @@ class TestParticipantDataDeletion(CommonTestCase):
             "ParticipantDeletionEvent",  # this is why we are here...
             "ArchivedEvent",  # confirmed
             "ChunkRegistry",  # confirmed
+            "ChunkTimeBinExtent",  # confirmed
+            "DashboardDataQuantity",  # confirmed
             "EncryptionErrorMetadata",  # confirmed
             "FileToProcess",  # confirmed
             "ForestTask",  # confirmed
@@ -205,6 +205,8 @@ path("get-interventions/v1", other_researcher_apis.download_study_interventions)
 
 # data_access_api
 path("get-data/v1", data_access_api.get_data)
+path("get-data-manifest/v1", data_access_api.get_data_manifest)
+path("get-data-files/v1", data_access_api.get_data_files)
 
 # Mobile api (includes ios targets, which require custom names)
 path('upload', mobile_api.upload)